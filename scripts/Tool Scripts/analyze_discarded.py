@@ -1,57 +1,75 @@
 import json
 import os
-import fitz
+import sys
+import argparse
+import numpy as np
+from multiprocessing import cpu_count
 from tqdm import tqdm
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_ROOT = os.path.dirname(os.path.dirname(SCRIPT_DIR))
 
+# Shared modules live one level up in scripts/
+sys.path.insert(0, os.path.dirname(SCRIPT_DIR))
+import pdf_extract
+import text_features
+
 DISCARDED_PATH = os.path.join(PROJECT_ROOT, "processed", "discarded.jsonl")
 RAW_ROOT = os.path.join(PROJECT_ROOT, "raw_pdfs")
 
-length_buckets = {
-    "<10 words": 0,
-    "10-30 words": 0,
-    "30-100 words": 0,
-    "100-300 words": 0,
-    "300+ words": 0
-}
-
-total = 0
-
-with open(DISCARDED_PATH, "r", encoding="utf-8") as f:
-    for line in tqdm(f):
-        record = json.loads(line)
-        source_path = record["source_path"]
-
-        full_path = os.path.join(RAW_ROOT, source_path)
-
-        try:
-            doc = fitz.open(full_path)
-            text = ""
-            for page in doc:
-                text += page.get_text("text") + "\n"
-            doc.close()
-
-            words = text.split()
-            wc = len(words)
-
-            if wc < 10:
-                length_buckets["<10 words"] += 1
-            elif wc < 30:
-                length_buckets["10-30 words"] += 1
-            elif wc < 100:
-                length_buckets["30-100 words"] += 1
-            elif wc < 300:
-                length_buckets["100-300 words"] += 1
-            else:
-                length_buckets["300+ words"] += 1
+MAX_WORKERS = max(1, int(cpu_count() * 0.7))
+
+
+def count_words(full_path):
+    return len(pdf_extract.extract_text(full_path).split())
+
+
+def iter_paths():
+    with open(DISCARDED_PATH, "r", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            yield os.path.join(RAW_ROOT, record["source_path"])
+
+
+def print_buckets(total, errors, bucket_counts):
+    print("\nTotal analyzed:", total)
+    print("Errors:", errors)
+    for label, count in zip(text_features.LENGTH_BUCKETS, bucket_counts):
+        print(label, ":", count)
+
 
+def main():
+    parser = argparse.ArgumentParser(description="Word-count histogram of discarded documents")
+    parser.add_argument("--features", default=None, help="read word counts from a feature file (text_features.py discarded) instead of the PDFs")
+    args = parser.parse_args()
+
+    num_buckets = len(text_features.LENGTH_BUCKETS)
+
+    if args.features is not None:
+        _, features = text_features.load_features(args.features)
+        bucket_counts = np.bincount(features["length_bucket"], minlength=num_buckets)
+        print_buckets(len(features["length_bucket"]), 0, bucket_counts.tolist())
+        return
+
+    bucket_counts = [0] * num_buckets
+    total = 0
+    errors = 0
+
+    with pdf_extract.ExtractionPool(count_words, MAX_WORKERS) as pool, \
+         pdf_extract.open_error_log() as error_file:
+
+        for full_path, ok, wc in tqdm(pool.imap_unordered(iter_paths())):
+            if not ok:
+                pdf_extract.log_error(error_file, dict(wc, source_path=full_path))
+                errors += 1
+                continue
+
+            bucket = int(np.searchsorted(text_features.LENGTH_BUCKET_EDGES, wc, side="right"))
+            bucket_counts[bucket] += 1
             total += 1
 
-        except:
-            continue
+    print_buckets(total, errors, bucket_counts)
+
 
-print("\nTotal analyzed:", total)
-for k, v in length_buckets.items():
-    print(k, ":", v)
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,21 @@
 import os
 import json
-import fitz
-import re
+import sys
+import argparse
+from functools import partial
+from multiprocessing import cpu_count
 from tqdm import tqdm
 
 # -------- PATH RESOLUTION --------
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_ROOT = os.path.dirname(os.path.dirname(SCRIPT_DIR))
 
+# Shared modules live one level up in scripts/
+sys.path.insert(0, os.path.dirname(SCRIPT_DIR))
+import corpus_store
+import pdf_extract
+import text_features
+
 DISCARDED_PATH = os.path.join(PROJECT_ROOT, "processed", "discarded.jsonl")
 DOCUMENTS_PATH = os.path.join(PROJECT_ROOT, "processed", "documents.jsonl")
 CHECKPOINT_PATH = os.path.join(PROJECT_ROOT, "processed", "recovery_checkpoint.json")
@@ -17,7 +25,7 @@ RAW_ROOT = os.path.join(PROJECT_ROOT, "raw_pdfs")
 MIN_REAL_WORDS = 15
 MIN_ALPHA_RATIO = 0.30
 
-WORD_PATTERN = re.compile(r"[A-Za-z]{3,}")
+MAX_WORKERS = max(1, int(cpu_count() * 0.7))
 
 def load_checkpoint():
     if not os.path.exists(CHECKPOINT_PATH):
@@ -30,76 +38,106 @@ def save_checkpoint(index):
         json.dump({"line_index": index}, f)
 
 def compute_metrics(text):
-    total_chars = len(text)
-    if total_chars == 0:
-        return 0, 0
+    features = text_features.compute_features([text])
+    return int(features["real_word_count"][0]), float(features["alpha_ratio"][0])
+
+def recoverable_mask(features):
+    return (features["real_word_count"] >= MIN_REAL_WORDS) & (features["alpha_ratio"] >= MIN_ALPHA_RATIO)
+
+def extract_candidate(task, prefiltered=False):
+    _, record = task
+    full_path = os.path.join(RAW_ROOT, record["source_path"])
+
+    text = pdf_extract.extract_text(full_path).strip()
+    if prefiltered:
+        return text
 
-    alpha_chars = sum(c.isalpha() for c in text)
-    alpha_ratio = alpha_chars / total_chars
+    real_word_count, alpha_ratio = compute_metrics(text)
 
-    words = WORD_PATTERN.findall(text)
-    real_word_count = len(words)
+    if real_word_count >= MIN_REAL_WORDS and alpha_ratio >= MIN_ALPHA_RATIO:
+        return text
+    return None
 
-    return real_word_count, alpha_ratio
+def count_discarded(store=None):
+    if store is not None:
+        return len(corpus_store.open_store(store))
+    with open(DISCARDED_PATH, "rb") as f:
+        return sum(block.count(b"\n") for block in iter(lambda: f.read(1 << 24), b""))
+
+def iter_discarded(start_index, store=None, keep=None):
+    records = corpus_store.iter_jsonl_or_store(DISCARDED_PATH, store, start=start_index)
+    for idx, record in enumerate(records, start_index):
+        if keep is not None and not keep[idx]:
+            continue
+        yield idx, record
 
 def main():
+    parser = argparse.ArgumentParser(description="Recover short but useful documents from discarded.jsonl")
+    parser.add_argument("--store", default=None, help="read discarded records from a corpus store instead of discarded.jsonl")
+    parser.add_argument("--features", default=None, help="use a precomputed feature file (text_features.py discarded) to pick candidates")
+    args = parser.parse_args()
+
+    # With a feature file the thresholds are applied up front, and only the
+    # rows that pass are ever opened again (from the page-text cache)
+    keep = None
+    if args.features is not None:
+        features_store, features = text_features.load_features(args.features)
+        rows = count_discarded(args.store)
+        if rows != len(features_store):
+            sys.exit(f"{args.features} has {len(features_store)} rows but the input has {rows}; rebuild it")
+        keep = recoverable_mask(features)
+        print("Candidates from feature file:", int(keep.sum()))
+
     start_index = load_checkpoint()
     print("Resuming from discarded line:", start_index)
 
     recovered = 0
     total_processed = 0
+    errors = 0
+    next_index = start_index
 
-    with open(DISCARDED_PATH, "r", encoding="utf-8") as discard_file, \
-         open(DOCUMENTS_PATH, "a", encoding="utf-8") as doc_file:
+    # Ordered results keep the line-index checkpoint exact
+    with open(DOCUMENTS_PATH, "a", encoding="utf-8") as doc_file, \
+         pdf_extract.open_error_log() as error_file, \
+         pdf_extract.ExtractionPool(partial(extract_candidate, prefiltered=keep is not None), MAX_WORKERS) as pool:
 
-        for idx, line in enumerate(tqdm(discard_file)):
-            if idx < start_index:
-                continue
+        for (idx, record), ok, value in tqdm(pool.imap(iter_discarded(start_index, args.store, keep))):
+            next_index = idx + 1
 
-            record = json.loads(line)
-            source_path = record["source_path"]
-            full_path = os.path.join(RAW_ROOT, source_path)
-
-            try:
-                doc = fitz.open(full_path)
-                text = ""
-                for page in doc:
-                    text += page.get_text("text") + "\n"
-                doc.close()
-
-                text = text.strip()
-
-                real_word_count, alpha_ratio = compute_metrics(text)
-
-                if real_word_count >= MIN_REAL_WORDS and alpha_ratio >= MIN_ALPHA_RATIO:
-                    recovered_record = {
-                        "doc_id": record["doc_id"],
-                        "dataset": record["dataset"],
-                        "folder": record["folder"],
-                        "filename": record["filename"],
-                        "source_path": record["source_path"],
-                        "char_count": len(text),
-                        "word_count": len(text.split()),
-                        "has_text": True,
-                        "text": text
-                    }
+            if not ok:
+                pdf_extract.log_error(error_file, dict(value, source_path=record["source_path"]))
+                errors += 1
+                continue
 
-                    doc_file.write(json.dumps(recovered_record) + "\n")
-                    recovered += 1
+            text = value
+            if text is not None:
+                recovered_record = {
+                    "doc_id": record["doc_id"],
+                    "dataset": record["dataset"],
+                    "folder": record["folder"],
+                    "filename": record["filename"],
+                    "source_path": record["source_path"],
+                    "char_count": len(text),
+                    "word_count": len(text.split()),
+                    "has_text": True,
+                    "text": text
+                }
 
-                total_processed += 1
+                doc_file.write(json.dumps(recovered_record) + "\n")
+                recovered += 1
 
-                if total_processed % 500 == 0:
-                    save_checkpoint(idx)
+            total_processed += 1
 
-            except Exception:
-                continue
+            if total_processed % 500 == 0:
+                doc_file.flush()
+                save_checkpoint(next_index)
 
-    save_checkpoint(total_processed)
+    save_checkpoint(next_index)
 
     print("\n====================================")
     print("Recovery complete.")
     print("Recovered documents:", recovered)
+    print("Errors:", errors)
     print("====================================")
 
 if __name__ == "__main__":
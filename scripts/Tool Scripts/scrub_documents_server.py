@@ -1,77 +1,156 @@
 import os
+import sys
 import json
-import re
+import argparse
+from contextlib import closing
 from multiprocessing import Pool, cpu_count
+from tqdm import tqdm
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_ROOT = os.path.dirname(os.path.dirname(SCRIPT_DIR))
 
+# Shared modules live one level up in scripts/
+sys.path.insert(0, os.path.dirname(SCRIPT_DIR))
+import batching
+import corpus_store
+import text_features
+
 INPUT_PATH = os.path.join(PROJECT_ROOT, "processed", "documents.jsonl")
 CLEAN_PATH = os.path.join(PROJECT_ROOT, "processed", "documents_clean.jsonl")
 SCRUBBED_PATH = os.path.join(PROJECT_ROOT, "processed", "documents_scrubbed_out.jsonl")
 
-WORD_PATTERN = re.compile(r"[A-Za-z]{3,}")
-DIGIT_PATTERN = re.compile(r"\d+")
+MAX_WORKERS = max(1, int(cpu_count() * 0.7))
+
+# Documents go to the workers in batches, and at most MAX_BATCHES_IN_FLIGHT
+# batches exist at once (read, queued, or waiting to be written), so memory
+# stays flat however large documents.jsonl grows
+BATCH_SIZE = 1000
+MAX_BATCHES_IN_FLIGHT = MAX_WORKERS * 4
+
+
+# A document is scrubbed only when it fails all three at once
+MIN_REAL_WORDS = 5
+MIN_DIGIT_TOKENS = 3
+MIN_ALPHA_RATIO = 0.2
+
 
-MAX_WORKERS = int(cpu_count() * 0.7)
+def keep_mask(features):
+    # Vectorized over a batch (or a whole feature file) at once
+    junk = (
+        (features["real_word_count"] < MIN_REAL_WORDS)
+        & (features["digit_tokens"] < MIN_DIGIT_TOKENS)
+        & (features["alpha_ratio"] < MIN_ALPHA_RATIO)
+    )
+    return (features["char_count"] > 0) & ~junk
 
 
 def compute_keep_flag(record):
-    text = record.get("text", "")
+    return bool(keep_mask(text_features.compute_features([record.get("text", "")]))[0])
 
-    total_chars = len(text)
-    if total_chars == 0:
-        return False
 
-    alpha_chars = sum(c.isalpha() for c in text)
-    alpha_ratio = alpha_chars / total_chars
+def keep_flags_for_texts(texts):
+    return keep_mask(text_features.compute_features(texts)).tolist()
 
-    real_words = WORD_PATTERN.findall(text)
-    real_word_count = len(real_words)
 
-    digit_tokens = len(DIGIT_PATTERN.findall(text))
+def keep_flags_for_lines(lines):
+    # Workers parse the JSON themselves; the parent only ever moves raw lines
+    return keep_flags_for_texts([json.loads(line).get("text", "") for line in lines])
 
-    if real_word_count < 5 and digit_tokens < 3 and alpha_ratio < 0.2:
-        return False
 
-    return True
+def iter_row_batches(store):
+    for start in range(0, len(store), BATCH_SIZE):
+        yield range(start, min(start + BATCH_SIZE, len(store)))
 
 
-def main():
-    print("Loading documents into memory...")
+def scrub_from_features(features_path, store_path=None):
+    # Row i of the feature file scores line i of the input, so no worker ever
+    # has to look at the text again
+    features_store, features = text_features.load_features(features_path)
+    keep = keep_mask(features)
 
-    with open(INPUT_PATH, "r", encoding="utf-8") as f:
-        documents = [json.loads(line) for line in f]
+    if store_path is not None:
+        records = corpus_store.open_store(store_path)
+        rows = len(records)
+        lines = (json.dumps(records.row(row)) + "\n" for row in range(rows))
+    else:
+        with open(INPUT_PATH, "rb") as f:
+            rows = sum(block.count(b"\n") for block in iter(lambda: f.read(1 << 24), b""))
+        lines = (line for batch in batching.iter_line_batches(INPUT_PATH, BATCH_SIZE) for line in batch)
 
-    print(f"Total documents loaded: {len(documents)}")
-    print(f"Using {MAX_WORKERS} workers")
+    if rows != len(features_store):
+        sys.exit(f"{features_path} has {len(features_store)} rows but the input has {rows}; rebuild it")
 
-    with Pool(MAX_WORKERS) as pool:
-        keep_flags = pool.map(compute_keep_flag, documents)
+    with open(CLEAN_PATH, "w", encoding="utf-8") as clean_file, \
+         open(SCRUBBED_PATH, "w", encoding="utf-8") as scrubbed_file:
 
-    kept = []
-    removed = []
+        for row, line in enumerate(tqdm(lines, total=rows)):
+            if keep[row]:
+                clean_file.write(line)
+            else:
+                scrubbed_file.write(line)
 
-    for record, keep in zip(documents, keep_flags):
-        if keep:
-            kept.append(record)
-        else:
-            removed.append(record)
+    print("\n====================================")
+    print("Scrub complete.")
+    print("Kept:", int(keep.sum()))
+    print("Removed:", int(len(keep) - keep.sum()))
+    print("====================================")
 
-    print("Writing clean documents...")
-    with open(CLEAN_PATH, "w", encoding="utf-8") as f:
-        for record in kept:
-            f.write(json.dumps(record) + "\n")
 
-    print("Writing scrubbed documents...")
-    with open(SCRUBBED_PATH, "w", encoding="utf-8") as f:
-        for record in removed:
-            f.write(json.dumps(record) + "\n")
+def main():
+    parser = argparse.ArgumentParser(description="Split documents.jsonl into clean and scrubbed-out sets")
+    parser.add_argument("--store", default=None, help="read documents from a corpus store instead of documents.jsonl")
+    parser.add_argument("--features", default=None, help="use a precomputed feature file (text_features.py documents) instead of re-scoring text")
+    args = parser.parse_args()
+
+    if args.features is not None:
+        scrub_from_features(args.features, args.store)
+        return
+
+    print(f"Using {MAX_WORKERS} workers, {BATCH_SIZE} documents per batch")
+
+    kept = 0
+    removed = 0
+
+    if args.store is not None:
+        store = corpus_store.open_store(args.store)
+        batches = iter_row_batches(store)
+        func = keep_flags_for_texts
+
+        # Only the text goes to the workers; records are rebuilt from the
+        # mapped store at write time
+        def payload(rows):
+            return [store.get(row, "text") or "" for row in rows]
+
+        def output(rows, i):
+            return json.dumps(store.row(rows[i])) + "\n"
+    else:
+        batches = batching.iter_line_batches(INPUT_PATH, BATCH_SIZE)
+        func = keep_flags_for_lines
+
+        payload = None
+
+        def output(lines, i):
+            return lines[i]
+
+    with open(CLEAN_PATH, "w", encoding="utf-8") as clean_file, \
+         open(SCRUBBED_PATH, "w", encoding="utf-8") as scrubbed_file, \
+         Pool(MAX_WORKERS) as pool:
+
+        # Batches come back in input order, so output order matches input
+        with closing(batching.bounded_imap(pool, func, batches, MAX_BATCHES_IN_FLIGHT, payload)) as results:
+            for batch, flags in tqdm(results, unit="batch"):
+                for i, keep in enumerate(flags):
+                    if keep:
+                        clean_file.write(output(batch, i))
+                        kept += 1
+                    else:
+                        scrubbed_file.write(output(batch, i))
+                        removed += 1
 
     print("\n====================================")
     print("Scrub complete.")
-    print("Kept:", len(kept))
-    print("Removed:", len(removed))
+    print("Kept:", kept)
+    print("Removed:", removed)
     print("====================================")
 
 
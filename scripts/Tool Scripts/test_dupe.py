@@ -1,13 +1,18 @@
 import os
 
+# Extraction now refuses duplicates up front (see scripts/dedupe_index.py);
+# this remains as an after-the-fact audit of a folder tree.
+
 dataset9 = "raw_pdfs/Dataset 9"
 
-all_files = []
+total_files = 0
+unique_files = set()
 for folder in os.listdir(dataset9):
     folder_path = os.path.join(dataset9, folder)
     for f in os.listdir(folder_path):
-        all_files.append(f)
+        total_files += 1
+        unique_files.add(f)
 
-print("Total files:", len(all_files))
-print("Unique files:", len(set(all_files)))
-print("Duplicates detected:", len(all_files) - len(set(all_files)))
+print("Total files:", total_files)
+print("Unique files:", len(unique_files))
+print("Duplicates detected:", total_files - len(unique_files))
@@ -0,0 +1,59 @@
+import threading
+from collections import deque
+
+# Batch helpers for the line-oriented stages (scrub, chunking, features).
+# bounded_imap() is Pool.imap with a cap on read-ahead: imap's feeder thread
+# would otherwise pull the entire input into memory as fast as it can read it.
+
+
+def batched(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_line_batches(path, size):
+    # Raw lines, newline-terminated, so they can be written back untouched
+    with open(path, "r", encoding="utf-8") as f:
+        for batch in batched(f, size):
+            if not batch[-1].endswith("\n"):
+                batch[-1] += "\n"
+            yield batch
+
+
+def bounded_imap(pool, func, batches, max_in_flight, payload=None):
+    # Yields (batch, func(payload(batch))) in input order. At most
+    # max_in_flight batches are alive at once (read, queued, or waiting for
+    # the consumer), so memory is flat however long the input is.
+    #
+    # Close the generator before the pool is closed or terminated if the
+    # consumer may stop early: the feeder thread waits on the consumer, and
+    # the pool joins that thread on the way out.
+    slots = threading.Semaphore(max_in_flight)
+    stopped = threading.Event()
+    pending = deque()
+
+    def feed():
+        # Runs in the pool's feeder thread
+        for batch in batches:
+            slots.acquire()
+            if stopped.is_set():
+                return
+            pending.append(batch)
+            yield payload(batch) if payload is not None else batch
+
+    try:
+        for result in pool.imap(func, feed()):
+            batch = pending.popleft()
+            yield batch, result
+            slots.release()
+    finally:
+        # Wakes a feeder waiting for a slot so it stops instead of blocking
+        # the pool's shutdown
+        stopped.set()
+        slots.release()
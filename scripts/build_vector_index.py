@@ -1,12 +1,26 @@
 import os
+import io
 import json
+import time
+import argparse
 import numpy as np
 import faiss
 import torch
+from contextlib import closing
+from multiprocessing import Pool, cpu_count
 from tqdm import tqdm
-from sentence_transformers import SentenceTransformer
 import logging
 
+import batching
+import chunk_documents
+import chunk_store
+import chunk_table
+import corpus_store
+import embedding_backend
+import embedding_cache
+import index_partitions
+import vector_index
+
 logging.basicConfig(filename="embedding.log", level=logging.INFO)
 
 # Paths
@@ -16,115 +30,895 @@ PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
 CHUNKS_PATH = os.path.join(PROJECT_ROOT, "processed", "chunks.jsonl")
 INDEX_PATH = os.path.join(PROJECT_ROOT, "processed", "faiss.index")
 META_PATH = os.path.join(PROJECT_ROOT, "processed", "chunk_metadata.jsonl")
-CHECKPOINT_PATH = os.path.join(PROJECT_ROOT, "processed", "embedding_checkpoint.json")
+CHECKPOINT_PATH = os.path.join(PROJECT_ROOT, "processed", "embedding_checkpoint.json")  # pre-shard runs
+TOMBSTONES_PATH = os.path.join(PROJECT_ROOT, "processed", "chunk_tombstones.jsonl")
+SHARDS_DIR = os.path.join(PROJECT_ROOT, "processed", "embedding_shards")
+CURSOR_PATH = os.path.join(SHARDS_DIR, "cursor.json")
+DELETED_PATH = os.path.join(SHARDS_DIR, "deleted.jsonl")
 
-MODEL_NAME = "BAAI/bge-large-en-v1.5"
+MODEL_NAME = embedding_backend.MODEL_NAME
 BATCH_SIZE = 64
-SAVE_INTERVAL = 5000  # save FAISS every N chunks
+SHARD_CHUNKS = 16384  # vectors per shard (64 MB at 1024 dims)
 
 print("Index path:", INDEX_PATH)
-print("Checkpoint path:", CHECKPOINT_PATH)
+print("Shards path:", SHARDS_DIR)
 
 
-def load_checkpoint():
-    if not os.path.exists(CHECKPOINT_PATH):
-        return 0
-    with open(CHECKPOINT_PATH, "r") as f:
-        return json.load(f).get("last_index", 0)
+# -------- SHARDS --------
+# Vectors are never written into a growing index mid-run. Every SHARD_CHUNKS
+# vectors become a shard pair, vectors-NNNNNN.npy + meta-NNNNNN.jsonl, each
+# written to a temp file, fsynced and renamed into place, and only then does
+# cursor.json move past them. The cursor holds the number of committed
+# shards, the next chunk position and, for chunks.jsonl, the byte offset of
+# that position, so a resume seeks straight to it. Shard files past the
+# cursor are a crash's leftovers and are deleted on start. faiss.index and
+# chunk_metadata.jsonl are built from the shards once, at the end.
+def write_atomic(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
 
 
-def save_checkpoint(index_position):
-    with open(CHECKPOINT_PATH, "w") as f:
-        json.dump({"last_index": index_position}, f)
+def shard_paths(number):
+    return (
+        os.path.join(SHARDS_DIR, f"vectors-{number:06d}.npy"),
+        os.path.join(SHARDS_DIR, f"meta-{number:06d}.jsonl")
+    )
 
 
-def main():
-    print("Loading embedding model...")
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    model = SentenceTransformer(MODEL_NAME, device=device)
-    print(f"Using device: {device}")
+def load_cursor():
+    if not os.path.exists(CURSOR_PATH):
+        return {"shards": 0, "vectors": 0, "position": 0, "byte_offset": 0}
+    with open(CURSOR_PATH, "r") as f:
+        return json.load(f)
 
-    print("Loading or creating FAISS index...")
 
-    if os.path.exists(INDEX_PATH):
-        index = faiss.read_index(INDEX_PATH)
-        print("Existing index loaded.")
+def save_cursor(cursor):
+    write_atomic(CURSOR_PATH, json.dumps(cursor).encode("utf-8"))
+
+
+def clean_uncommitted(cursor):
+    for name in os.listdir(SHARDS_DIR):
+        if name in ("cursor.json", "deleted.jsonl"):
+            continue
+        stem = name.split(".")[0]
+        number = stem.rsplit("-", 1)[-1]
+        if name.endswith(".tmp") or not number.isdigit() or int(number) >= cursor["shards"]:
+            os.remove(os.path.join(SHARDS_DIR, name))
+
+
+def write_shard(cursor, vectors, metas, resume):
+    vectors_path, meta_path = shard_paths(cursor["shards"])
+
+    buffer = io.BytesIO()
+    np.save(buffer, np.ascontiguousarray(vectors, dtype=np.float32))
+    write_atomic(vectors_path, buffer.getvalue())
+    write_atomic(meta_path, "".join(json.dumps(meta) + "\n" for meta in metas).encode("utf-8"))
+
+    cursor["shards"] += 1
+    cursor["vectors"] += len(vectors)
+    cursor.update(resume)
+    save_cursor(cursor)
+
+
+def migrate_checkpoint(cursor):
+    # A run from before the shards: its index and the metadata lines that
+    # match it become shard 0, and the cursor starts from its checkpoint
+    with open(CHECKPOINT_PATH, "r") as f:
+        position = json.load(f).get("last_index", 0)
+
+    index = faiss.read_index(INDEX_PATH)
+    vectors = index.reconstruct_n(0, index.ntotal)
+
+    # Metadata could run ahead of the last index save; keep what matches
+    metas = []
+    with open(META_PATH, "r", encoding="utf-8") as f:
+        for line in f:
+            if len(metas) >= index.ntotal:
+                break
+            metas.append(json.loads(line))
+
+    byte_offset = jsonl_offset(CHUNKS_PATH, position) if os.path.exists(CHUNKS_PATH) else None
+
+    print(f"Migrating {index.ntotal} vectors from {INDEX_PATH} (checkpoint at chunk #{position})")
+    write_shard(cursor, vectors, metas, {"position": position, "byte_offset": byte_offset})
+    os.replace(CHECKPOINT_PATH, CHECKPOINT_PATH + ".migrated")
+
+
+def load_deleted():
+    # {chunk id: committed vector count at the time of the delete}
+    deleted = {}
+    if os.path.exists(DELETED_PATH):
+        with open(DELETED_PATH, "r", encoding="utf-8") as f:
+            for line in f:
+                entry = json.loads(line)
+                deleted[chunk_store.chunk_key(entry["chunk_id"])] = entry["before"]
+    return deleted
+
+
+def live_shard_rows(cursor):
+    # -> (meta paths, live rows, their chunk ids); see chunk_store.live_rows
+    meta_paths = [shard_paths(number)[1] for number in range(cursor["shards"])]
+    tombstones = chunk_documents.load_tombstones(TOMBSTONES_PATH)
+    rows, ids = chunk_store.live_rows(meta_paths, tombstones, load_deleted())
+    return meta_paths, rows, ids
+
+
+def build_index(cursor, kind="flat", params=None):
+    # faiss.index + chunk_metadata.jsonl from the live rows of every
+    # committed shard, written beside the old ones and swapped in together;
+    # then the metadata store is brought in line. Vectors go in under their
+    # chunk ids; approximate index types (vector_index.py) are trained on a
+    # sample of the shards first.
+    if cursor["shards"] == 0:
+        return None
+
+    arrays = [np.load(shard_paths(number)[0], mmap_mode="r") for number in range(cursor["shards"])]
+    meta_paths, rows, ids = live_shard_rows(cursor)
+    if len(rows) < cursor["vectors"]:
+        print(f"{cursor['vectors'] - len(rows)} superseded, tombstoned or deleted vectors left out")
+
+    # Too few vectors to train IVF centroids on: built flat instead
+    fitted = vector_index.fit_kind(kind, len(rows))
+    if fitted != kind:
+        print(f"{len(rows)} vectors is below {vector_index.MIN_IVF_VECTORS} for {kind}; building a {fitted} index")
+    index = vector_index.with_ids(vector_index.new_index(fitted, arrays[0].shape[1], len(rows), params))
+    vector_index.train(index, arrays, rows)
+
+    shard_starts = np.cumsum([0] + [len(a) for a in arrays])
+    with open(META_PATH + ".tmp", "wb") as meta_out:
+        for number in tqdm(range(cursor["shards"]), desc="Building index", unit="shard"):
+            first, last = np.searchsorted(rows, shard_starts[number:number + 2])
+            vector_index.add(index, arrays, rows[first:last], ids[first:last])
+
+            wanted = set((rows[first:last] - shard_starts[number]).tolist())
+            with open(meta_paths[number], "rb") as meta_in:
+                for line_number, line in enumerate(meta_in):
+                    if line_number in wanted:
+                        meta_out.write(line)
+
+    faiss.write_index(index, INDEX_PATH + ".tmp")
+    os.replace(INDEX_PATH + ".tmp", INDEX_PATH)
+    os.replace(META_PATH + ".tmp", META_PATH)
+
+    removed = chunk_store.sync(meta_paths, rows, ids)
+    print(f"Metadata store: {chunk_store.count()} chunks ({removed} removed)")
+    return index
+
+
+def fill_store_text(chunks_store=None, chunks_table=None):
+    # Chunk text for store rows that don't have it yet, read from the chunk
+    # source starting at the first position that needs it
+    by_position, by_key = chunk_store.missing_text()
+    if not by_position and not by_key:
+        return
+
+    start = 0 if by_key else min(by_position)
+    updates = []
+    filled = 0
+    chunks = open_chunks(chunks_store, chunks_table, start)
+    for position, record in enumerate(tqdm(chunks, desc="Storing chunk text", unit="chunk"), start):
+        key = by_position.pop(position, None)
+        if key is None and by_key:
+            key = chunk_store.chunk_key(record["chunk_id"])
+            key = key if key in by_key else None
+            by_key.discard(key)
+        if key is not None:
+            updates.append((record["text"], key))
+        if len(updates) >= chunk_store.WRITE_BATCH or not (by_position or by_key):
+            chunk_store.set_text(updates)
+            filled += len(updates)
+            updates = []
+        if not (by_position or by_key):
+            break
+
+    chunk_store.set_text(updates)
+    print(f"Stored text for {filled + len(updates)} chunks")
+
+
+CHUNK_FIELDS = [
+    "chunk_id", "doc_id", "dataset", "folder", "filename", "text",
+    "token_count", "page_start", "page_end"
+]
+
+
+# -------- BATCH SCHEDULING --------
+# Chunks are read in windows of WINDOW_SIZE, sorted by length, and cut into
+# batches whose padded size (batch size x longest chunk) stays under
+# TOKEN_BUDGET, so short emails are no longer padded out to the length of a
+# 512-token chunk next to them. Vectors go back into window order before they
+# reach the shards, so shard rows and their metadata lines stay in chunk
+# order exactly as with fixed batches.
+WINDOW_SIZE = 4096
+TOKEN_BUDGET = 16384   # padded tokens per encode() call (64 x 256)
+MAX_BATCH_SIZE = 256
+CHARS_PER_TOKEN = 4    # length estimate for chunks without a token_count
+
+
+def chunk_length(record, max_length):
+    # Tokens encode() will see, [CLS]/[SEP] included. Token-mode chunks
+    # (chunk_documents --tokens) carry an exact count; others are estimated
+    # from their length in characters.
+    if "token_count" in record:
+        tokens = record["token_count"] + 2
+    else:
+        tokens = len(record["text"]) // CHARS_PER_TOKEN + 2
+    return min(tokens, max_length)
+
+
+def plan_batches(lengths, fixed=False):
+    # -> list of index arrays into the window
+    if fixed:
+        return [np.arange(i, min(i + BATCH_SIZE, len(lengths))) for i in range(0, len(lengths), BATCH_SIZE)]
+
+    batches = []
+    current = []
+    for i in np.argsort(lengths, kind="stable"):
+        # Ascending order, so chunk i is the longest the batch would hold
+        if current and (len(current) >= MAX_BATCH_SIZE or (len(current) + 1) * lengths[i] > TOKEN_BUDGET):
+            batches.append(np.array(current))
+            current = []
+        current.append(i)
+    if current:
+        batches.append(np.array(current))
+    return batches
+
+
+def encode_window(model, texts, lengths, dimension, fixed=False):
+    # -> (embeddings in window order, padded tokens processed)
+    lengths = np.asarray(lengths)
+    embeddings = np.empty((len(texts), dimension), dtype=np.float32)
+    padded = 0
+
+    for batch in plan_batches(lengths, fixed):
+        embeddings[batch] = model.encode(
+            [texts[i] for i in batch],
+            batch_size=len(batch),
+            convert_to_numpy=True,
+            normalize_embeddings=True
+        )
+        padded += len(batch) * int(lengths[batch].max())
+
+    return embeddings, padded
+
+
+def chunk_meta(record):
+    meta = {
+        "chunk_id": record["chunk_id"],
+        "doc_id": record["doc_id"],
+        "dataset": record["dataset"],
+        "folder": record["folder"],
+        "filename": record["filename"]
+    }
+    # Page-aware chunks (chunk_documents --pages) carry their pages
+    # through, so a hit maps to pages without opening the PDF
+    if "page_start" in record:
+        meta["page_start"] = record["page_start"]
+        meta["page_end"] = record["page_end"]
+    return meta
+
+
+def jsonl_offset(path, lines):
+    # Byte offset of line number `lines`, for cursors that don't have one
+    offset = 0
+    with open(path, "rb") as f:
+        for _ in range(lines):
+            offset += len(f.readline())
+    return offset
+
+
+def iter_jsonl_from(path, byte_offset, state):
+    # chunks.jsonl from a byte offset; state["byte_offset"] is kept at the
+    # end of the last line handed out
+    state["byte_offset"] = byte_offset
+    with open(path, "rb") as f:
+        f.seek(byte_offset)
+        for line in f:
+            state["byte_offset"] += len(line)
+            yield json.loads(line)
+
+
+def open_chunks(chunks_store=None, chunks_table=None, start=0, byte_offset=None, state=None):
+    if chunks_table is not None:
+        # Offset-based table: text is sliced out of the documents store
+        return chunk_table.open_table(chunks_table).iter_records(CHUNK_FIELDS, start)
+    if chunks_store is not None:
+        # A store seeks straight to the row
+        return corpus_store.open_store(chunks_store).iter_records(CHUNK_FIELDS, start)
+
+    if byte_offset is None:
+        byte_offset = jsonl_offset(CHUNKS_PATH, start)
+    return iter_jsonl_from(CHUNKS_PATH, byte_offset, {} if state is None else state)
+
+
+def load_model(backend="fp32"):
+    print(f"Loading embedding model ({backend})...")
+    model = embedding_backend.load_model(backend)
+    print(f"Using device: {model.device}")
+    return model
+
+
+# -------- EMBEDDING CACHE --------
+# Each window is looked up in embedding_cache before anything is encoded;
+# only the misses reach the model, and they go into the cache afterwards.
+# The cache holds float16, so misses are rounded the same way before they
+# reach the index: a chunk gets the same vector whether it was a hit or not.
+# cache_key is embedding_backend.model_key(backend), or None with --no-cache.
+def probe_cache(texts, cache_key):
+    # -> (hashes, hit rows, their float16 vectors, miss rows)
+    if cache_key is None:
+        return None, [], None, list(range(len(texts)))
+
+    hashes = [embedding_cache.text_hash(text) for text in texts]
+    found = embedding_cache.lookup(cache_key, True, hashes)
+
+    hit_rows = [i for i, h in enumerate(hashes) if h in found]
+    miss_rows = [i for i, h in enumerate(hashes) if h not in found]
+    hit_vectors = np.stack([found[hashes[i]] for i in hit_rows]) if hit_rows else None
+    return hashes, hit_rows, hit_vectors, miss_rows
+
+
+def cache_misses(hashes, miss_rows, miss_vectors, cache_key):
+    if cache_key is None or not miss_rows:
+        return miss_vectors
+    embedding_cache.store(cache_key, True, [hashes[i] for i in miss_rows], miss_vectors)
+    return miss_vectors.astype(np.float16).astype(np.float32)
+
+
+def count_cache(state, lengths, hit_rows, miss_rows):
+    state["cache_hits"] = state.get("cache_hits", 0) + len(hit_rows)
+    state["cache_misses"] = state.get("cache_misses", 0) + len(miss_rows)
+    state["hit_tokens"] = state.get("hit_tokens", 0) + sum(lengths[i] for i in hit_rows)
+    state["miss_tokens"] = state.get("miss_tokens", 0) + sum(lengths[i] for i in miss_rows)
+
+
+def merge_window(num_rows, hit_rows, hit_vectors, miss_rows, miss_vectors):
+    dimension = miss_vectors.shape[1] if miss_rows else hit_vectors.shape[1]
+    embeddings = np.empty((num_rows, dimension), dtype=np.float32)
+    if hit_rows:
+        embeddings[hit_rows] = hit_vectors
+    if miss_rows:
+        embeddings[miss_rows] = miss_vectors
+    return embeddings
+
+
+# -------- WINDOW SOURCES --------
+# Both yield (embeddings, metas, encoded tokens, padded tokens, resume point)
+# per window, in chunk order; main() is the single writer for either. The
+# resume point is the chunk position (and chunks.jsonl byte offset) just past
+# the window. Token counts cover the encoded chunks only, not cache hits.
+def read_windows(chunks, tombstones, start_position, max_length, state):
+    # -> (texts, metas, estimated lengths, resume point) per window. The
+    # resume point after the last chunk read ends up in state["resume"].
+    texts = []
+    metas = []
+    lengths = []
+    next_position = start_position
+
+    for position, record in enumerate(chunks, start_position):
+        next_position = position + 1
+        if position in tombstones:
+            continue
+
+        texts.append(record["text"])
+        meta = chunk_meta(record)
+        meta["position"] = position  # for tombstones applied after embedding
+        metas.append(meta)
+        lengths.append(chunk_length(record, max_length))
+
+        if len(texts) >= WINDOW_SIZE:
+            yield texts, metas, lengths, {"position": next_position, "byte_offset": state.get("byte_offset")}
+            texts, metas, lengths = [], [], []
+
+    resume = {"position": next_position, "byte_offset": state.get("byte_offset")}
+    if texts:
+        yield texts, metas, lengths, resume
+    state["resume"] = resume
+
+
+def serial_windows(model, chunks, tombstones, start_position, fixed, state, cache_key):
+    dimension = model.get_sentence_embedding_dimension()
+
+    for texts, metas, lengths, resume in read_windows(chunks, tombstones, start_position, model.max_seq_length, state):
+        hashes, hit_rows, hit_vectors, miss_rows = probe_cache(texts, cache_key)
+        count_cache(state, lengths, hit_rows, miss_rows)
+
+        miss_lengths = [lengths[i] for i in miss_rows]
+        miss_vectors, padded = encode_window(model, [texts[i] for i in miss_rows], miss_lengths, dimension, fixed)
+        miss_vectors = cache_misses(hashes, miss_rows, miss_vectors, cache_key)
+
+        embeddings = merge_window(len(texts), hit_rows, hit_vectors, miss_rows, miss_vectors)
+        yield embeddings, metas, sum(miss_lengths), padded, resume
+
+
+# -------- PIPELINED ENCODING --------
+# --pipeline splits the work into stages joined by bounded queues:
+#   reader     (pool feeder thread) parses chunks, tokenizes each window in
+#              one fast-tokenizer call and cuts it into padded id batches
+#   encoders   N processes, each with its own model copy and T torch threads,
+#              run the transformer on those ids
+#   writer     (main thread) reassembles windows in order and adds them to
+#              the index
+# bge-large on CPU stops scaling well past a handful of intra-op threads, so
+# several encoders with a few threads each keep more cores busy than one
+# encode() with all of them. Each encoder holds ~1.3 GB of weights.
+ENCODER_THREADS = 4
+ENCODERS = max(1, cpu_count() // ENCODER_THREADS)
+MAX_SEQ_LENGTH = 512
+
+# One model per encoder process, loaded by the pool initializer
+_encoder = None
+
+
+def init_encoder(threads, backend):
+    global _encoder
+    _encoder = embedding_backend.load_model(backend, threads, device="cpu")
+    _encoder.eval()
+
+
+def encode_ids(batch):
+    # Same forward pass and normalization as encode(normalize_embeddings=True),
+    # minus the tokenization the reader already did
+    input_ids, attention_mask = batch
+    if input_ids is None:
+        return None  # a window the cache covered entirely
+    features = {
+        "input_ids": torch.from_numpy(input_ids),
+        "attention_mask": torch.from_numpy(attention_mask)
+    }
+    with torch.inference_mode():
+        embeddings = _encoder(features)["sentence_embedding"]
+        embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1)
+    return embeddings.float().numpy()
+
+
+def pipelined_windows(chunks, tombstones, start_position, fixed, state, encoders, threads, backend, cache_key):
+    tokenizer = chunk_documents.get_tokenizer()
+    windows = {}
+
+    def id_batches():
+        # Runs in the pool's feeder thread, overlapped with encoding
+        reader = read_windows(chunks, tombstones, start_position, MAX_SEQ_LENGTH, state)
+        for window, (texts, metas, estimates, resume) in enumerate(reader):
+            hashes, hit_rows, hit_vectors, miss_rows = probe_cache(texts, cache_key)
+
+            encoded = []
+            if miss_rows:
+                encoded = tokenizer(
+                    [texts[i] for i in miss_rows],
+                    truncation=True,
+                    max_length=MAX_SEQ_LENGTH,
+                    return_attention_mask=False,
+                    return_token_type_ids=False
+                )["input_ids"]
+            lengths = np.array([len(ids) for ids in encoded], dtype=np.int64)
+            plan = plan_batches(lengths, fixed)
+            windows[window] = (metas, int(lengths.sum()), resume, len(plan), hashes, hit_rows, hit_vectors, miss_rows)
+
+            # Hits are counted on the estimated lengths; they were never tokenized
+            count_cache(state, estimates, hit_rows, [])
+            state["cache_misses"] = state.get("cache_misses", 0) + len(miss_rows)
+            state["miss_tokens"] = state.get("miss_tokens", 0) + int(lengths.sum())
+
+            if not plan:
+                yield window, 0, None, None, None
+
+            for number, batch in enumerate(plan):
+                width = int(lengths[batch].max())
+                input_ids = np.zeros((len(batch), width), dtype=np.int64)
+                attention_mask = np.zeros((len(batch), width), dtype=np.int64)
+                for row, i in enumerate(batch):
+                    input_ids[row, :lengths[i]] = encoded[i]
+                    attention_mask[row, :lengths[i]] = 1
+                yield window, number, batch, input_ids, attention_mask
+
+    with Pool(encoders, initializer=init_encoder, initargs=(threads, backend)) as pool, \
+         closing(batching.bounded_imap(
+             pool, encode_ids, id_batches(), encoders * 2,
+             payload=lambda item: (item[3], item[4])
+         )) as results:
+
+        for (window, number, batch, input_ids, _), vectors in results:
+            metas, tokens, resume, num_batches, hashes, hit_rows, hit_vectors, miss_rows = windows[window]
+            if number == 0:
+                miss_vectors = None
+                padded = 0
+
+            if batch is not None:
+                if miss_vectors is None:
+                    miss_vectors = np.empty((len(miss_rows), vectors.shape[1]), dtype=np.float32)
+                miss_vectors[batch] = vectors
+                padded += input_ids.size
+
+            if number >= num_batches - 1:
+                del windows[window]
+                miss_vectors = cache_misses(hashes, miss_rows, miss_vectors, cache_key)
+                embeddings = merge_window(len(metas), hit_rows, hit_vectors, miss_rows, miss_vectors)
+                yield embeddings, metas, tokens, padded, resume
+
+
+# -------- MAIN --------
+def main(chunks_store=None, chunks_table=None, fixed_batches=False, pipeline=False,
+         encoders=ENCODERS, threads=ENCODER_THREADS, use_cache=embedding_cache.CACHE_ENABLED, backend="fp32",
+         index_kind="flat", index_params=None, partitioning=None):
+    os.makedirs(SHARDS_DIR, exist_ok=True)
+    cursor = load_cursor()
+    if cursor["shards"] == 0 and os.path.exists(CHECKPOINT_PATH) and os.path.exists(INDEX_PATH):
+        migrate_checkpoint(cursor)
+    clean_uncommitted(cursor)
+
+    # One index never mixes vectors from two backends; runs from before
+    # backends were recorded were fp32
+    if cursor["shards"] and cursor.get("backend", "fp32") != backend:
+        raise SystemExit(
+            f"Committed shards were embedded with the {cursor.get('backend', 'fp32')} backend; "
+            f"resume with --backend {cursor.get('backend', 'fp32')} or clear {SHARDS_DIR}"
+        )
+    cursor["backend"] = backend
+
+    if pipeline:
+        model = None
+        print(f"Pipelined: {encoders} encoder processes x {threads} threads ({backend})")
     else:
-        dummy = model.encode(["test"], convert_to_numpy=True)
-        dimension = dummy.shape[1]
-        index = faiss.IndexFlatIP(dimension)
-        print("New index created.")
+        model = load_model(backend)
+
+    cache_key = embedding_backend.model_key(backend) if use_cache else None
 
-    start_position = load_checkpoint()
-    print(f"Resuming from chunk #{start_position}")
+    start_position = cursor["position"]
+    print(f"Resuming from chunk #{start_position} ({cursor['vectors']} vectors in {cursor['shards']} shards)")
+
+    # Chunks superseded by an incremental re-chunk (chunk_documents
+    # --incremental) are never embedded if they haven't been already
+    tombstones = chunk_documents.load_tombstones(TOMBSTONES_PATH)
+    if tombstones:
+        print(f"Skipping {len(tombstones)} tombstoned chunks")
+
+    if fixed_batches:
+        print(f"Fixed batches of {BATCH_SIZE}")
+    else:
+        print(f"Length-sorted windows of {WINDOW_SIZE}, {TOKEN_BUDGET} padded tokens per batch")
 
-    batch_texts = []
-    batch_meta = []
-    current_position = 0
     total_added = 0
+    total_tokens = 0
+    total_padded = 0
+    pending_vectors = []
+    pending_metas = []
+
+    state = {}
+    chunks = open_chunks(chunks_store, chunks_table, start_position, cursor.get("byte_offset"), state)
+    started = time.time()
 
-    with open(CHUNKS_PATH, "r", encoding="utf-8") as chunk_file, \
-         open(META_PATH, "a", encoding="utf-8") as meta_file:
+    with tqdm(chunks, unit="chunk") as progress:
 
-        for line in tqdm(chunk_file):
-            if current_position < start_position:
-                current_position += 1
-                continue
+        if pipeline:
+            windows = pipelined_windows(progress, tombstones, start_position, fixed_batches, state, encoders, threads, backend, cache_key)
+        else:
+            windows = serial_windows(model, progress, tombstones, start_position, fixed_batches, state, cache_key)
 
-            record = json.loads(line)
+        for embeddings, metas, tokens, padded, resume in windows:
+            pending_vectors.append(embeddings)
+            pending_metas.extend(metas)
 
-            batch_texts.append(record["text"])
-            batch_meta.append({
-                "chunk_id": record["chunk_id"],
-                "doc_id": record["doc_id"],
-                "dataset": record["dataset"],
-                "folder": record["folder"],
-                "filename": record["filename"]
-            })
+            total_added += len(metas)
+            total_tokens += tokens
+            total_padded += padded
+            progress.set_postfix(padding_eff=f"{total_tokens / max(total_padded, 1):.0%}")
 
-            if len(batch_texts) >= BATCH_SIZE:
-                embeddings = model.encode(
-                    batch_texts,
-                    convert_to_numpy=True,
-                    normalize_embeddings=True
-                )
+            if len(pending_metas) >= SHARD_CHUNKS:
+                write_shard(cursor, np.concatenate(pending_vectors), pending_metas, resume)
+                pending_vectors = []
+                pending_metas = []
 
-                index.add(embeddings)
+        # Final shard; also moves the cursor past trailing tombstoned chunks
+        resume = state.get("resume")
+        if pending_metas:
+            write_shard(cursor, np.concatenate(pending_vectors), pending_metas, resume)
+        elif resume is not None and resume["position"] != cursor["position"]:
+            cursor.update(resume)
+            save_cursor(cursor)
 
-                for meta in batch_meta:
-                    meta_file.write(json.dumps(meta) + "\n")
+    elapsed = max(time.time() - started, 1e-9)
 
-                total_added += len(batch_texts)
-                current_position += len(batch_texts)
+    padding = f"{total_tokens / total_padded:.1%}" if total_padded else "n/a"
+    print(f"Embedded {total_added} chunks: {total_added / elapsed:.1f} chunks/s, padding efficiency {padding}")
+    if cache_key is not None:
+        report_cache(state, elapsed)
 
-                batch_texts = []
-                batch_meta = []
+    finish(cursor, index_kind, index_params, partitioning, chunks_store, chunks_table)
 
-                if total_added % SAVE_INTERVAL == 0:
-                    print("Saving intermediate index...")
-                    faiss.write_index(index, INDEX_PATH)
-                    save_checkpoint(current_position)
 
-        # Final flush
-        if batch_texts:
-            embeddings = model.encode(
-                batch_texts,
-                convert_to_numpy=True,
-                normalize_embeddings=True
-            )
-            index.add(embeddings)
+def report_cache(state, elapsed):
+    hits = state.get("cache_hits", 0)
+    misses = state.get("cache_misses", 0)
+    print(f"Embedding cache: {hits} hits, {misses} misses ({hits / max(hits + misses, 1):.1%} hit rate)")
 
-            for meta in batch_meta:
-                meta_file.write(json.dumps(meta) + "\n")
+    # Saved time is priced at this run's own seconds per encoded token
+    if misses and hits:
+        saved = state["hit_tokens"] * elapsed / max(state["miss_tokens"], 1)
+        print(f"Estimated encoding time saved: {saved / 60:.1f} min")
 
-            current_position += len(batch_texts)
 
-    print("Saving final index...")
-    faiss.write_index(index, INDEX_PATH)
-    save_checkpoint(current_position)
+def finish(cursor, kind="flat", params=None, partitioning=None, chunks_store=None, chunks_table=None):
+    if cursor["shards"] == 0:
+        print("Nothing to embed.")
+        return
 
+    if partitioning is not None:
+        finish_partitions(cursor, kind, params, **partitioning)
+    else:
+        print(f"Building {kind} FAISS index from shards...")
+        index = build_index(cursor, kind, params)
+        print(f"Wrote {index.ntotal} vectors to {INDEX_PATH}")
+
+    fill_store_text(chunks_store, chunks_table)
     print("Embedding complete.")
 
 
+def finish_partitions(cursor, kind, params, by, size, only):
+    # Per-partition indexes (index_partitions.py) instead of faiss.index
+    arrays = [np.load(shard_paths(number)[0], mmap_mode="r") for number in range(cursor["shards"])]
+    meta_paths, rows, ids = live_shard_rows(cursor)
+
+    print(f"Building {kind} partitions by {by} from shards...")
+    manifest = index_partitions.build_partitions(arrays, meta_paths, rows, ids, by, size, only, kind, params)
+    print(f"{len(manifest['partitions'])} partitions in {index_partitions.PARTITIONS_DIR}")
+
+    removed = chunk_store.sync(meta_paths, rows, ids)
+    print(f"Metadata store: {chunk_store.count()} chunks ({removed} removed)")
+
+
+# -------- DELETE / REPLACE --------
+# In-place edits of faiss.index, every index partition and the metadata
+# store, no rebuild. Both are also recorded in the shards (deleted.jsonl, or
+# a shard holding the new vectors), so the next full build keeps them. Every
+# index is checked before anything is written. An HNSW index can't remove
+# vectors; its edits reach it on the next --build-only. Don't run these
+# while an embedding run is writing shards.
+def edit_targets():
+    # -> ([(index path, metadata path, partition name or None)], partition
+    # manifest or None)
+    targets = []
+    if os.path.exists(INDEX_PATH):
+        targets.append((INDEX_PATH, META_PATH, None))
+
+    manifest = index_partitions.load_manifest()
+    if manifest is not None and not manifest["partitions"]:
+        manifest = None
+    for name in sorted(manifest["partitions"]) if manifest is not None else []:
+        root = os.path.join(index_partitions.PARTITIONS_DIR, name)
+        targets.append((os.path.join(root, "faiss.index"), os.path.join(root, "chunk_metadata.jsonl"), name))
+
+    if not targets:
+        raise SystemExit(f"No {INDEX_PATH} or index partitions to edit; build one first")
+    for index_path, _, _ in targets:
+        if not vector_index.has_ids(index_path):
+            raise SystemExit(f"{index_path} predates chunk ids; rebuild it with --build-only first")
+    return targets, manifest
+
+
+def replacement_partitions(manifest, metas, first_position):
+    # The partition each replacement is added to: its dataset's, or with
+    # --partition size the one its new shard row (first_position onwards)
+    # falls in, which edit_indexes creates if needed. A dataset without a
+    # partition yet has to be built with --only first.
+    if manifest is None:
+        return None
+    if manifest["by"] != "dataset":
+        size = manifest.get("size")
+        if size is None:
+            raise SystemExit("The index partitions predate position-based size partitions; "
+                             "rebuild them with --build-only --partition size first")
+        return [index_partitions.size_partition_name(first_position + i, size) for i in range(len(metas))]
+
+    names = []
+    for meta in metas:
+        name = index_partitions.partition_name(meta["dataset"])
+        if name not in manifest["partitions"]:
+            raise SystemExit(f"No index partition for dataset {meta['dataset']!r}; "
+                             f"build it with --build-only --partition dataset --only {meta['dataset']}")
+        names.append(name)
+    return names
+
+
+def save_index(index, path=INDEX_PATH):
+    faiss.write_index(index, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def rewrite_metadata(drop_ids, append_metas=(), path=META_PATH):
+    # Keeps chunk_metadata.jsonl in index order: remove_ids compacts, and
+    # add_with_ids appends
+    drop = set(int(key) for key in drop_ids)
+    with open(path, "rb") as meta_in, open(path + ".tmp", "wb") as meta_out:
+        for line in meta_in:
+            if chunk_store.chunk_key(json.loads(line)["chunk_id"]) not in drop:
+                meta_out.write(line)
+        for meta in append_metas:
+            meta_out.write((json.dumps(meta) + "\n").encode("utf-8"))
+    os.replace(path + ".tmp", path)
+
+
+def remove_from_index(index, ids, path=INDEX_PATH):
+    try:
+        return index.remove_ids(ids)
+    except RuntimeError:
+        print(f"This index type can't remove vectors; run --build-only to apply the change to {path}")
+        return None
+
+
+def new_partition(manifest, name, vectors):
+    # A size partition that replacements are the first rows of
+    root = os.path.join(index_partitions.PARTITIONS_DIR, name)
+    os.makedirs(root, exist_ok=True)
+    kind = manifest["index"] if manifest["index"] in vector_index.INDEX_TYPES else "flat"
+    kind = vector_index.fit_kind(kind, len(vectors))
+    manifest["partitions"][name] = {"dataset": None, "index": kind, "vectors": 0}
+    open(os.path.join(root, "chunk_metadata.jsonl"), "wb").close()
+
+    index = vector_index.with_ids(vector_index.new_index(kind, vectors.shape[1], len(vectors)))
+    if not index.is_trained:
+        index.train(vectors)
+    return index
+
+
+def edit_indexes(targets, manifest, ids, vectors=None, metas=(), destinations=None):
+    # Removes ids from every target and adds vectors[i] / metas[i] to
+    # faiss.index and to partition destinations[i]
+    known = {name for _, _, name in targets}
+    for name in sorted(set(destinations or ()) - known):
+        root = os.path.join(index_partitions.PARTITIONS_DIR, name)
+        targets.append((os.path.join(root, "faiss.index"), os.path.join(root, "chunk_metadata.jsonl"), name))
+
+    for index_path, meta_path, name in targets:
+        mine = [i for i in range(len(metas)) if name is None or destinations[i] == name]
+        if os.path.exists(index_path):
+            index = faiss.read_index(index_path)
+        else:
+            index = new_partition(manifest, name, vectors[mine])
+        removed = remove_from_index(index, ids, index_path)
+        if removed is None or (removed == 0 and not mine):
+            continue
+
+        if mine:
+            index.add_with_ids(vectors[mine], ids[mine])
+        save_index(index, index_path)
+        rewrite_metadata(ids, [metas[i] for i in mine], meta_path)
+        if name is not None:
+            manifest["partitions"][name]["vectors"] = int(index.ntotal)
+        print(f"{index_path}: removed {removed}, added {len(mine)}; {index.ntotal} vectors")
+
+    if manifest is not None:
+        index_partitions.save_manifest(manifest)
+
+
+def delete_chunks(chunk_ids):
+    cursor = load_cursor()
+    ids = chunk_store.chunk_keys(chunk_ids)
+    targets, manifest = edit_targets()
+
+    with open(DELETED_PATH, "a", encoding="utf-8") as f:
+        for chunk_id in chunk_ids:
+            f.write(json.dumps({"chunk_id": chunk_id, "before": cursor["vectors"]}) + "\n")
+    chunk_store.delete(ids)
+
+    edit_indexes(targets, manifest, ids)
+
+
+def replace_chunks(path):
+    # path: JSONL of chunk records (chunk_id, text and the metadata fields),
+    # embedded with the backend the shards were built with
+    cursor = load_cursor()
+    with open(path, "r", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if not records:
+        return
+
+    # A replacement keeps the chunk position of what it replaces, so a later
+    # tombstone of that position still applies to it
+    ids = chunk_store.chunk_keys([record["chunk_id"] for record in records])
+    previous = chunk_store.lookup(ids, with_text=False)
+    metas = []
+    for key, record in zip(ids, records):
+        meta = chunk_meta(record)
+        if "position" in previous.get(int(key), {}):
+            meta["position"] = previous[int(key)]["position"]
+        metas.append(meta)
+
+    targets, manifest = edit_targets()
+    destinations = replacement_partitions(manifest, metas, cursor["vectors"])
+
+    model = load_model(cursor.get("backend", "fp32"))
+    texts = [record["text"] for record in records]
+    vectors = model.encode(texts, batch_size=BATCH_SIZE, convert_to_numpy=True, normalize_embeddings=True).astype(np.float32)
+
+    write_shard(cursor, vectors, metas, {})
+    chunk_store.put(list(zip(ids, metas, texts)))
+
+    edit_indexes(targets, manifest, ids, vectors, metas, destinations)
+
+
+def benchmark(num_chunks, chunks_store=None, chunks_table=None, backend="fp32"):
+    # Embeds the first num_chunks chunks with fixed and with length-sorted
+    # batches and compares them; nothing is written
+    model = load_model(backend)
+    max_length = model.max_seq_length
+    dimension = model.get_sentence_embedding_dimension()
+
+    texts = []
+    lengths = []
+    for record in open_chunks(chunks_store, chunks_table):
+        texts.append(record["text"])
+        lengths.append(chunk_length(record, max_length))
+        if len(texts) >= num_chunks:
+            break
+
+    model.encode(texts[:BATCH_SIZE], batch_size=BATCH_SIZE)  # warm-up
+    real_tokens = sum(lengths)
+    results = {}
+
+    for name, fixed in [("fixed", True), ("bucketed", False)]:
+        started = time.time()
+        embedded = 0
+        padded = 0
+        for i in range(0, len(texts), WINDOW_SIZE):
+            _, window_padded = encode_window(model, texts[i:i + WINDOW_SIZE], lengths[i:i + WINDOW_SIZE], dimension, fixed)
+            padded += window_padded
+            embedded += len(texts[i:i + WINDOW_SIZE])
+        elapsed = max(time.time() - started, 1e-9)
+        results[name] = embedded / elapsed
+        print(f"{name:>9}: {results[name]:8.1f} chunks/s, padding efficiency {real_tokens / max(padded, 1):.1%}")
+
+    print(f"Speed-up: {results['bucketed'] / results['fixed']:.2f}x on {len(texts)} chunks")
+
+
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Embed chunks into the FAISS index")
+    parser.add_argument("--chunks-store", default=None, help="read chunks from a corpus store instead of chunks.jsonl")
+    parser.add_argument("--chunks-table", nargs="?", const=chunk_table.CHUNKS_TABLE_PATH, default=None,
+                        help="read chunks from the offset-based chunk table (resolved against processed/documents.store)")
+    parser.add_argument("--fixed-batches", action="store_true", help=f"embed fixed batches of {BATCH_SIZE} in file order instead of length-sorted ones")
+    parser.add_argument("--benchmark", type=int, default=None, metavar="N",
+                        help="time fixed vs length-sorted batches on the first N chunks and exit")
+    parser.add_argument("--pipeline", action="store_true", help="overlap reading/tokenizing, encoding in a process pool, and index writes")
+    parser.add_argument("--encoders", type=int, default=ENCODERS, help="encoder processes in --pipeline mode (one model copy each)")
+    parser.add_argument("--threads", type=int, default=ENCODER_THREADS, help="torch threads per encoder in --pipeline mode")
+    parser.add_argument("--no-cache", action="store_true", help="encode every chunk without reading or filling the embedding cache")
+    parser.add_argument("--backend", choices=embedding_backend.BACKENDS, default="fp32",
+                        help="int8: dynamic int8 quantization, onnx: ONNX Runtime graph (both CPU; see embedding_backend.py check)")
+    vector_index.add_index_arguments(parser)
+    parser.add_argument("--nprobe", type=int, default=None, help=f"IVF lists probed per search, saved with the index (default {vector_index.DEFAULT_PARAMS['nprobe']})")
+    parser.add_argument("--ef-search", dest="ef_search", type=int, default=None, help=f"HNSW search depth, saved with the index (default {vector_index.DEFAULT_PARAMS['ef_search']})")
+    parser.add_argument("--partition", choices=index_partitions.PARTITION_BY, default=None,
+                        help="write one index per dataset (or per --partition-vectors vectors) under processed/index_partitions instead of faiss.index")
+    parser.add_argument("--partition-vectors", type=int, default=index_partitions.PARTITION_VECTORS)
+    parser.add_argument("--only", action="append", default=None, metavar="DATASET",
+                        help="with --partition, rebuild only this dataset's partition, or part-NNNN with --partition size (repeatable)")
+    parser.add_argument("--delete-chunks", nargs="+", default=None, metavar="CHUNK_ID",
+                        help="remove these chunks from faiss.index, the index partitions and the metadata store and exit")
+    parser.add_argument("--replace-chunks", default=None, metavar="JSONL",
+                        help="re-embed the chunk records in this file in place of their old vectors and exit")
+    parser.add_argument("--build-only", action="store_true", help="rebuild faiss.index and chunk_metadata.jsonl from the committed shards and exit")
+    args = parser.parse_args()
+    index_params = vector_index.index_params(args)
+    partitioning = None
+    if args.partition:
+        partitioning = {"by": args.partition, "size": max(1, args.partition_vectors), "only": args.only}
+    elif args.only:
+        parser.error("--only needs --partition")
+
+    if args.delete_chunks:
+        delete_chunks(args.delete_chunks)
+    elif args.replace_chunks:
+        replace_chunks(args.replace_chunks)
+    elif args.benchmark:
+        benchmark(args.benchmark, args.chunks_store, args.chunks_table, args.backend)
+    elif args.build_only:
+        finish(load_cursor(), args.index, index_params, partitioning, args.chunks_store, args.chunks_table)
+    else:
+        main(args.chunks_store, args.chunks_table, args.fixed_batches,
+             args.pipeline, max(1, args.encoders), max(1, args.threads),
+             embedding_cache.CACHE_ENABLED and not args.no_cache, args.backend,
+             args.index, index_params, partitioning)
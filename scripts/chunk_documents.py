@@ -1,16 +1,50 @@
 import os
+import re
 import json
+import time
+import bisect
+import hashlib
+import argparse
+from functools import partial
+from contextlib import ExitStack
+from multiprocessing import Pool, cpu_count
 from tqdm import tqdm
 
+import batching
+import chunk_table
+import corpus_store
+import shard_store
+
 # Resolve project root dynamically
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
 
 DOCS_PATH = os.path.join(PROJECT_ROOT, "processed", "documents.jsonl")
 CHUNKS_PATH = os.path.join(PROJECT_ROOT, "processed", "chunks.jsonl")
+CHUNK_MANIFEST_PATH = os.path.join(PROJECT_ROOT, "processed", "chunk_manifest.jsonl")
+CHUNK_TOMBSTONES_PATH = os.path.join(PROJECT_ROOT, "processed", "chunk_tombstones.jsonl")
+CHUNK_STATE_PATH = os.path.join(PROJECT_ROOT, "processed", "chunk_state.json")
+PAGE_OFFSETS_PATH = os.path.join(PROJECT_ROOT, "processed", "page_offsets.jsonl")
+
+# Page-marked documents written by ingest_preserved_server
+PRESERVED_ROOT = os.path.join(PROJECT_ROOT, "processed_jsonl")
 
 MAX_CHUNK_WORDS = 1200
 TARGET_CHUNK_WORDS = 1000
+WORD_RE = re.compile(r"\S+")  # same words as str.split()
+PAGE_MARKER_RE = re.compile(r"---PAGE (\d+)---")
+
+# Token mode (--tokens): windows are cut on the embedding model's own
+# tokenizer, so no chunk runs past what the model actually reads. bge-large
+# truncates at 512 tokens, two of which are [CLS]/[SEP].
+EMBED_MODEL_NAME = "BAAI/bge-large-en-v1.5"  # keep in step with build_vector_index.MODEL_NAME
+TOKEN_BUDGET = 510
+TOKEN_OVERLAP = 64
+
+# Documents are chunked in batches across MAX_WORKERS processes; output
+# order always matches documents.jsonl
+BATCH_SIZE = 500
+MAX_WORKERS = max(1, int(cpu_count() * 0.7))
 
 
 def split_into_paragraphs(text):
@@ -28,82 +62,520 @@ def chunk_text(doc_record):
         return [{
             "chunk_index": 0,
             "text": text,
-            "word_count": len(words)
+            "word_count": len(words),
+            "char_start": 0,
+            "char_end": len(text)
+        }]
+
+    # For large docs, chunk based on word windows. Spans of the windows in the
+    # original text are kept for the offset-based chunk table.
+    spans = [match.span() for match in WORD_RE.finditer(text)]
+    chunks = []
+    for chunk_index, start in enumerate(range(0, len(words), TARGET_CHUNK_WORDS)):
+        window = words[start:start + TARGET_CHUNK_WORDS]
+        chunks.append({
+            "chunk_index": chunk_index,
+            "text": " ".join(window),
+            "word_count": len(window),
+            "char_start": spans[start][0],
+            "char_end": spans[start + len(window) - 1][1]
+        })
+
+    return chunks
+
+
+# -------- TOKEN CHUNKING --------
+# One tokenizer per process; pool workers load their own
+_tokenizer = None
+_tokenizer_pid = None
+
+
+def get_tokenizer():
+    global _tokenizer, _tokenizer_pid
+
+    if _tokenizer is None or _tokenizer_pid != os.getpid():
+        from transformers import AutoTokenizer
+
+        _tokenizer = AutoTokenizer.from_pretrained(EMBED_MODEL_NAME, use_fast=True)
+        # Whole documents are tokenized on purpose; silence the max-length warning
+        _tokenizer.model_max_length = 10 ** 12
+        _tokenizer_pid = os.getpid()
+
+    return _tokenizer
+
+
+def token_offsets(texts):
+    # One batched call into the Rust tokenizer for the whole batch. Offsets
+    # map each token back to its characters, so chunk text is sliced from
+    # the original rather than decoded.
+    encoded = get_tokenizer()(
+        texts,
+        add_special_tokens=False,
+        return_offsets_mapping=True,
+        return_attention_mask=False,
+        return_token_type_ids=False
+    )
+    return encoded["offset_mapping"]
+
+
+def continues_word(offsets, i):
+    # Token i is glued to token i-1 (a word piece or trailing punctuation)
+    return offsets[i][0] == offsets[i - 1][1]
+
+
+def token_windows(offsets, budget, overlap):
+    num_tokens = len(offsets)
+    if num_tokens <= budget:
+        return [(0, num_tokens)]
+
+    windows = []
+    start = 0
+    while True:
+        end = min(start + budget, num_tokens)
+
+        # Don't cut inside a word unless it is absurdly long
+        if end < num_tokens:
+            cut = end
+            while cut > start + budget // 2 and continues_word(offsets, cut):
+                cut -= 1
+            if cut > start + budget // 2:
+                end = cut
+
+        windows.append((start, end))
+        if end >= num_tokens:
+            return windows
+
+        next_start = max(end - overlap, start + 1)
+        while next_start < end and continues_word(offsets, next_start):
+            next_start += 1
+        start = next_start
+
+
+def chunk_tokens(text, offsets, budget, overlap):
+    windows = token_windows(offsets, budget, overlap)
+
+    if len(windows) == 1:
+        return [{
+            "chunk_index": 0,
+            "text": text,
+            "word_count": len(text.split()),
+            "token_count": len(offsets),
+            "char_start": 0,
+            "char_end": len(text)
         }]
 
-    # For large docs, chunk based on word windows
     chunks = []
-    current_chunk = []
-    current_word_count = 0
-    chunk_index = 0
-
-    for word in words:
-        current_chunk.append(word)
-        current_word_count += 1
-
-        if current_word_count >= TARGET_CHUNK_WORDS:
-            chunk_text = " ".join(current_chunk).strip()
-            chunks.append({
-                "chunk_index": chunk_index,
-                "text": chunk_text,
-                "word_count": current_word_count
-            })
-            chunk_index += 1
-            current_chunk = []
-            current_word_count = 0
-
-    # Handle remainder
-    if current_chunk:
-        chunk_text = " ".join(current_chunk).strip()
+    for chunk_index, (start, end) in enumerate(windows):
+        char_start, char_end = offsets[start][0], offsets[end - 1][1]
+        window_text = text[char_start:char_end]
         chunks.append({
             "chunk_index": chunk_index,
-            "text": chunk_text,
-            "word_count": current_word_count
+            "text": window_text,
+            "word_count": len(window_text.split()),
+            "token_count": end - start,
+            "char_start": char_start,
+            "char_end": char_end
         })
 
     return chunks
 
 
-def process():
+# -------- PAGES --------
+# Page mode (--pages): ingest_preserved_server separates pages with
+# ---PAGE NNN--- marker lines. The markers are taken out of the text before
+# chunking, and each page's start offset in the remaining text is kept, so
+# a chunk's char span maps to the pages it covers without opening the PDF.
+def split_pages(text):
+    # -> (text without markers, {"pages": [page numbers], "offsets": [start
+    # of each page in that text]}), or (text, None) if it has no markers
+    markers = list(PAGE_MARKER_RE.finditer(text))
+    if not markers:
+        return text, None
+
+    contents = []
+    for i, marker in enumerate(markers):
+        end = markers[i + 1].start() if i + 1 < len(markers) else len(text)
+        contents.append(text[marker.end():end].strip())
+
+    offsets = []
+    position = 0
+    for content in contents:
+        offsets.append(position)
+        position += len(content) + 2  # "\n\n" between pages
+
+    page_table = {"pages": [int(marker.group(1)) for marker in markers], "offsets": offsets}
+    return "\n\n".join(contents), page_table
+
+
+def page_range(page_table, char_start, char_end):
+    # First and last page numbers a char span touches
+    offsets = page_table["offsets"]
+    first = bisect.bisect_right(offsets, char_start) - 1
+    last = bisect.bisect_right(offsets, max(char_start, char_end - 1)) - 1
+    return page_table["pages"][max(first, 0)], page_table["pages"][max(last, 0)]
+
+
+def load_page_offsets(path=PAGE_OFFSETS_PATH):
+    # doc_id -> page table; later lines win, as in the chunk manifest
+    page_offsets = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            entry = json.loads(line)
+            page_offsets[entry["doc_id"]] = entry
+    return page_offsets
+
+
+# -------- OUTPUT --------
+DOC_FIELDS = ["doc_id", "dataset", "folder", "filename", "text"]
+
+
+def chunk_records(doc, chunks):
+    for chunk in chunks:
+        record = {
+            "chunk_id": f"{doc['doc_id']}_{chunk['chunk_index']}",
+            "doc_id": doc["doc_id"],
+            "dataset": doc["dataset"],
+            "folder": doc["folder"],
+            "filename": doc["filename"],
+            "chunk_index": chunk["chunk_index"],
+            "word_count": chunk["word_count"],
+            "text": chunk["text"]
+        }
+        if "token_count" in chunk:
+            # Content tokens, without [CLS]/[SEP]; the embedder plans
+            # batches from this instead of tokenizing again
+            record["token_count"] = chunk["token_count"]
+        if "page_start" in chunk:
+            record["page_start"] = chunk["page_start"]
+            record["page_end"] = chunk["page_end"]
+        yield record
+
+
+# -------- INCREMENTAL STATE --------
+# chunks.jsonl (or chunks.table) is append-only in --incremental mode, and
+# so are the logs next to it: the manifest (doc_id -> content hash and the
+# positions of that doc's chunks, last entry wins), the tombstones (chunks
+# superseded by a newer version of their document, or whose document is
+# gone) and, in --pages mode, the page-offset tables. A state file holds the
+# committed byte length of each log; anything past those lengths is a batch
+# that was cut off mid-write and is truncated on the next run.
+
+# Documents the previous run chunked: doc_id -> sha256 of the text. Set in
+# every worker through the pool initializer.
+_known = {}
+
+
+def set_known(known):
+    global _known
+    _known = known
+
+
+def content_hash(text):
+    # surrogatepass: a lone surrogate left by a bad decode upstream hashes
+    # like any other code point instead of aborting the run
+    return hashlib.sha256(text.encode("utf-8", "surrogatepass")).hexdigest()
+
+
+def chunking_label(token_budget, token_overlap, table, preserved=False):
+    # The document source is part of it: an incremental run over another
+    # source would tombstone the whole previous corpus or mix the two. A
+    # --docs-store holds documents.jsonl itself, so both count as one source.
+    source = "preserved" if preserved else "documents"
+    output = "table" if table else "jsonl"
+    if token_budget:
+        return f"{source}:{output}:tokens:{EMBED_MODEL_NAME}:{token_budget}:{token_overlap}"
+    return f"{source}:{output}:words:{TARGET_CHUNK_WORDS}:{MAX_CHUNK_WORDS}"
+
+
+def load_state():
+    if not os.path.exists(CHUNK_STATE_PATH):
+        return None
+    with open(CHUNK_STATE_PATH, "r") as f:
+        return json.load(f)
+
+
+def save_state(state):
+    tmp_path = CHUNK_STATE_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, CHUNK_STATE_PATH)
+
+
+def truncate_to(path, size):
+    if os.path.exists(path) and os.path.getsize(path) > size:
+        os.truncate(path, size)
+
+
+def load_manifest():
+    manifest = {}
+    with open(CHUNK_MANIFEST_PATH, "r", encoding="utf-8") as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry.get("removed"):
+                manifest.pop(entry["doc_id"], None)
+            else:
+                manifest[entry["doc_id"]] = entry
+    return manifest
+
+
+def load_tombstones(path=None):
+    # Positions (chunks.jsonl lines / chunks.table rows) of chunks that are no longer live
+    path = path or CHUNK_TOMBSTONES_PATH
+    if not os.path.exists(path):
+        return set()
+    with open(path, "r", encoding="utf-8") as f:
+        return {json.loads(line)["position"] for line in f}
+
+
+def tombstone_lines(entry):
+    lines = []
+    for i in range(entry["count"]):
+        tombstone = {"chunk_id": f"{entry['doc_id']}_{i}", "position": entry["first"] + i}
+        lines.append((json.dumps(tombstone) + "\n").encode("utf-8"))
+    return lines
+
+
+# -------- CHUNKING --------
+def chunk_batch(docs, token_budget=None, token_overlap=TOKEN_OVERLAP, table=False, pages=False, hashed=True):
+    # One batch of documents (raw JSONL lines or store records) ->
+    # (doc_id, hash, encoded chunks, chunk count, page table line) for every
+    # document that is new or changed since the last run, plus the ids of all
+    # documents seen, so the parent only writes. Chunks are encoded as
+    # chunks.jsonl lines or as chunk table rows. hashed=False (a run without
+    # --incremental) leaves the hash out; every document counts as new.
+    docs = [json.loads(doc) if isinstance(doc, str) else doc for doc in docs]
+    hashes = [content_hash(doc["text"]) if hashed else None for doc in docs]
+    changed = [
+        (doc, doc_hash) for doc, doc_hash in zip(docs, hashes)
+        if doc_hash is None or _known.get(doc["doc_id"]) != doc_hash
+    ]
+
+    page_tables = [None] * len(changed)
+    if pages:
+        for i, (doc, doc_hash) in enumerate(changed):
+            text, page_tables[i] = split_pages(doc["text"])
+            changed[i] = (dict(doc, text=text), doc_hash)
+
+    if token_budget:
+        offsets = token_offsets([doc["text"] for doc, _ in changed])
+        doc_chunks = [
+            chunk_tokens(doc["text"], doc_offsets, token_budget, token_overlap)
+            for (doc, _), doc_offsets in zip(changed, offsets)
+        ]
+    else:
+        doc_chunks = [chunk_text(doc) for doc, _ in changed]
+
+    results = []
+    large_docs = 0
+    for (doc, doc_hash), chunks, page_table in zip(changed, doc_chunks, page_tables):
+        page_line = b""
+        if page_table is not None:
+            for chunk in chunks:
+                chunk["page_start"], chunk["page_end"] = page_range(page_table, chunk["char_start"], chunk["char_end"])
+            page_line = (json.dumps(dict(page_table, doc_id=doc["doc_id"])) + "\n").encode("utf-8")
+
+        if table:
+            output = chunk_table.encode_chunks(doc["doc_id"], doc["text"], chunks)
+        else:
+            output = "".join(json.dumps(record) + "\n" for record in chunk_records(doc, chunks)).encode("utf-8")
+        results.append((doc["doc_id"], doc_hash, output, len(chunks), page_line))
+        if len(chunks) > 1:
+            large_docs += 1
+
+    return results, [doc["doc_id"] for doc in docs], large_docs
+
+
+def doc_batches(docs_store, preserved=False):
+    if preserved:
+        return batching.batched(shard_store.iter_records(PRESERVED_ROOT), BATCH_SIZE)
+    if docs_store is not None:
+        docs = corpus_store.iter_jsonl_or_store(DOCS_PATH, docs_store, DOC_FIELDS)
+        return batching.batched(docs, BATCH_SIZE)
+    return batching.iter_line_batches(DOCS_PATH, BATCH_SIZE)
+
+
+def process(docs_store=None, workers=MAX_WORKERS, token_budget=None, token_overlap=TOKEN_OVERLAP,
+            incremental=False, table=False, pages=False, preserved=False):
     total_docs = 0
     total_chunks = 0
     large_docs = 0
+    changed_docs = 0
+    tombstoned = 0
+
+    if token_budget and not 0 <= token_overlap < token_budget:
+        raise ValueError("token overlap must be smaller than the token budget")
+    if pages and table:
+        # Table rows point into the stored text, which still has the markers
+        raise ValueError("--pages writes full-text chunks; it can't be combined with --table")
+
+    label = chunking_label(token_budget, token_overlap, table, preserved)
+    if pages:
+        label += ":pages"
+    output_path = chunk_table.CHUNKS_TABLE_PATH if table else CHUNKS_PATH
+    state = load_state() if incremental else None
 
-    with open(DOCS_PATH, "r", encoding="utf-8") as docs_file, \
-         open(CHUNKS_PATH, "w", encoding="utf-8") as chunks_file:
+    # Content hashes are only worked out for --incremental runs, including
+    # the full build that seeds them; a build without them can't be resumed
+    # incrementally
+    hashed = incremental
+    if incremental and state is None:
+        print("No chunk state found; doing a full build.")
+        incremental = False
+    elif incremental and not state.get("hashed", True):
+        print("The last build was not --incremental and has no content hashes; doing a full build.")
+        incremental = False
+    elif incremental and state["chunking"] != label:
+        print(f"Chunking settings changed ({state['chunking']} -> {label}); doing a full build.")
+        incremental = False
 
-        for line in tqdm(docs_file):
-            doc = json.loads(line)
+    # Every log the run appends to, in the order a batch is written
+    logs = {"chunks": output_path, "manifest": CHUNK_MANIFEST_PATH, "tombstones": CHUNK_TOMBSTONES_PATH}
+    if pages:
+        logs["page_offsets"] = PAGE_OFFSETS_PATH
 
-            total_docs += 1
+    if incremental:
+        for name, path in logs.items():
+            truncate_to(path, state[f"{name}_bytes"])
+        manifest = load_manifest()
+        known = {doc_id: entry["sha256"] for doc_id, entry in manifest.items()}
+        mode = "ab"
+        print(f"Incremental: {len(manifest)} documents already chunked, {state['positions']} chunk positions")
+    else:
+        manifest = {}
+        known = {}
+        mode = "wb"
+        state = {"chunking": label, "positions": 0, "hashed": hashed}
 
-            doc_chunks = chunk_text(doc)
+    set_known(known)
+    seen = set()
 
-            if len(doc_chunks) > 1:
-                large_docs += 1
+    batches = doc_batches(docs_store, preserved)
+    func = partial(chunk_batch, token_budget=token_budget, token_overlap=token_overlap, table=table, pages=pages,
+                   hashed=hashed)
+    print(f"Using {workers} workers, {BATCH_SIZE} documents per batch")
+    if token_budget:
+        print(f"Token windows: {token_budget} tokens, {token_overlap} overlap ({EMBED_MODEL_NAME})")
 
-            for chunk in doc_chunks:
-                chunk_record = {
-                    "chunk_id": f"{doc['doc_id']}_{chunk['chunk_index']}",
-                    "doc_id": doc["doc_id"],
-                    "dataset": doc["dataset"],
-                    "folder": doc["folder"],
-                    "filename": doc["filename"],
-                    "chunk_index": chunk["chunk_index"],
-                    "word_count": chunk["word_count"],
-                    "text": chunk["text"]
-                }
+    started = time.time()
 
-                chunks_file.write(json.dumps(chunk_record) + "\n")
-                total_chunks += 1
+    with ExitStack() as stack:
+        files = {name: stack.enter_context(open(path, mode)) for name, path in logs.items()}
+        progress = stack.enter_context(tqdm(unit="doc"))
+
+        def commit(entries):
+            # Chunks first, then the logs that point at them, then the state
+            # that makes the batch count
+            for name, f in files.items():
+                f.write(b"".join(entries.get(name, [])))
+                f.flush()
+            for name, f in files.items():
+                state[f"{name}_bytes"] = f.tell()
+            save_state(state)
+
+        if workers > 1:
+            pool = Pool(workers, initializer=set_known, initargs=(known,))
+            # Batches come back in input order, so chunks.jsonl is identical
+            # to a single-process run
+            ordered = batching.bounded_imap(pool, func, batches, workers * 4)
+            results = (result for _, result in ordered)
+        else:
+            pool = None
+            results = map(func, batches)
+
+        try:
+            for doc_results, doc_ids, num_large in results:
+                chunk_output = []
+                manifest_lines = []
+                tombstones = []
+                page_lines = []
+
+                for doc_id, doc_hash, output, num_chunks, page_line in doc_results:
+                    if doc_id in manifest:
+                        tombstones.extend(tombstone_lines(manifest[doc_id]))
+
+                    entry = {
+                        "doc_id": doc_id,
+                        "sha256": doc_hash,
+                        "first": state["positions"],
+                        "count": num_chunks
+                    }
+                    manifest[doc_id] = entry
+                    manifest_lines.append((json.dumps(entry) + "\n").encode("utf-8"))
+                    chunk_output.append(output)
+                    page_lines.append(page_line)
+
+                    state["positions"] += num_chunks
+                    total_chunks += num_chunks
+
+                commit({
+                    "chunks": chunk_output,
+                    "manifest": manifest_lines,
+                    "tombstones": tombstones,
+                    "page_offsets": page_lines
+                })
+
+                seen.update(doc_ids)
+                total_docs += len(doc_ids)
+                changed_docs += len(doc_results)
+                tombstoned += len(tombstones)
+                large_docs += num_large
+                progress.update(len(doc_ids))
+        finally:
+            if pool is not None:
+                # Stops the feeder first, or join would wait on it forever
+                # after an error
+                ordered.close()
+                pool.close()
+                pool.join()
+
+        # Documents that have left documents.jsonl take their chunks with them
+        removed = [doc_id for doc_id in manifest if doc_id not in seen]
+        if removed:
+            tombstones = []
+            manifest_lines = []
+            for doc_id in removed:
+                tombstones.extend(tombstone_lines(manifest.pop(doc_id)))
+                manifest_lines.append((json.dumps({"doc_id": doc_id, "removed": True}) + "\n").encode("utf-8"))
+            commit({"manifest": manifest_lines, "tombstones": tombstones})
+            tombstoned += len(tombstones)
+
+    elapsed = max(time.time() - started, 1e-9)
 
     print("\n====================================")
     print(f"Total documents processed: {total_docs}")
+    if incremental:
+        print(f"New or changed documents: {changed_docs}")
+        print(f"Removed documents: {len(removed)}")
+        print(f"Chunks tombstoned: {tombstoned}")
     print(f"Total chunks created: {total_chunks}")
     print(f"Documents requiring splitting: {large_docs}")
+    print(f"Throughput: {total_docs / elapsed:.1f} docs/s, {total_chunks / elapsed:.1f} chunks/s")
+    if table:
+        print(f"Chunk table: {output_path} (text resolves from the documents store)")
     print("Chunking complete.")
     print("====================================")
 
 
 if __name__ == "__main__":
-    process()
+    parser = argparse.ArgumentParser(description="Split documents into chunks.jsonl")
+    parser.add_argument("--docs-store", default=None, help="read documents from a corpus store instead of documents.jsonl")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="chunking processes (1 = run in this process)")
+    parser.add_argument("--tokens", action="store_true", help="window on embedding-model tokens instead of words")
+    parser.add_argument("--token-budget", type=int, default=TOKEN_BUDGET, help="content tokens per chunk in --tokens mode")
+    parser.add_argument("--token-overlap", type=int, default=TOKEN_OVERLAP, help="tokens shared by consecutive chunks in --tokens mode")
+    parser.add_argument("--incremental", action="store_true", help="only chunk new or changed documents, appending to chunks.jsonl")
+    parser.add_argument("--table", action="store_true", help="write the offset-based chunk table instead of full-text chunks.jsonl")
+    parser.add_argument("--pages", action="store_true", help="strip ---PAGE NNN--- markers and record page ranges per chunk")
+    parser.add_argument("--preserved", action="store_true", help="read the page-marked documents from processed_jsonl/ shards")
+    args = parser.parse_args()
+
+    process(
+        args.docs_store,
+        max(1, args.workers),
+        args.token_budget if args.tokens else None,
+        args.token_overlap,
+        args.incremental,
+        args.table,
+        args.pages,
+        args.preserved
+    )
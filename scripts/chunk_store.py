@@ -0,0 +1,236 @@
+import os
+import json
+import sqlite3
+import argparse
+import threading
+import numpy as np
+
+import corpus_store
+
+# Stable chunk ids and the metadata store that resolves them.
+#
+# Every vector in faiss.index is added under chunk_key(chunk_id), a 63-bit
+# hash of its chunk_id, through an IndexIDMap2, so a search hit names its
+# chunk directly instead of a position that only means something next to one
+# particular chunk_metadata.jsonl. build_vector_index fills the store below
+# from the embedding shards whenever it builds the index; a batch of hit ids
+# is then resolved with one indexed query instead of a scan of the JSONL.
+#
+#   chunks(id INTEGER PRIMARY KEY, chunk_id, meta JSON, text)
+#
+# Which shard rows are live (live_rows): a chunk_id embedded more than once
+# keeps its latest row, rows whose chunk position chunk_documents has since
+# tombstoned are dropped, and so are ids deleted after they were embedded.
+# Deletes and replacements (build_vector_index --delete-chunks /
+# --replace-chunks) edit faiss.index, the index partitions and this store in
+# place, and land in the shards as well, so the next full build agrees with
+# them.
+#
+#   python chunk_store.py get <chunk_id or id> ...
+
+# -------- PATHS --------
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+
+STORE_PATH = os.path.join(PROJECT_ROOT, "processed", "chunk_metadata.sqlite")
+
+# -------- CONFIG --------
+ID_MASK = (1 << 63) - 1   # non-negative, so an id is never faiss's -1 "no hit"
+LOOKUP_CHUNK = 900        # ids per IN (...) query, under SQLite's variable limit
+WRITE_BATCH = 10000
+
+# One connection per thread, like embedding_cache: the search service
+# resolves hits from several threads
+_local = threading.local()
+
+
+# -------- IDS --------
+def chunk_key(chunk_id):
+    return corpus_store.key_hash(chunk_id) & ID_MASK
+
+
+def chunk_keys(chunk_ids):
+    return np.array([chunk_key(chunk_id) for chunk_id in chunk_ids], dtype=np.int64)
+
+
+def live_rows(meta_paths, tombstones=(), deleted=None):
+    # -> (rows, ids): the shard rows (global positions, sorted) that belong
+    # in the index and their chunk ids. deleted: {id: vector count when it
+    # was deleted}; a row embedded after the delete brings the chunk back.
+    ids = []
+    dead = []
+    for path in meta_paths:
+        with open(path, "rb") as f:
+            for line in f:
+                meta = json.loads(line)
+                ids.append(chunk_key(meta["chunk_id"]))
+                dead.append(meta.get("position") in tombstones)
+
+    ids = np.array(ids, dtype=np.int64)
+    if len(ids) == 0:
+        return np.zeros(0, dtype=np.int64), ids
+
+    # Latest row per id: first occurrence in the reversed order
+    _, reversed_first = np.unique(ids[::-1], return_index=True)
+    keep = np.zeros(len(ids), dtype=bool)
+    keep[len(ids) - 1 - reversed_first] = True
+    keep &= ~np.array(dead)
+
+    if deleted:
+        keys = np.array(sorted(deleted), dtype=np.int64)
+        befores = np.array([deleted[key] for key in keys], dtype=np.int64)
+        hit = np.flatnonzero(np.isin(ids, keys))
+        before = befores[np.searchsorted(keys, ids[hit])]
+        keep[hit[hit < before]] = False
+
+    rows = np.flatnonzero(keep)
+    return rows, ids[rows]
+
+
+# -------- STORE --------
+def get_connection(path=STORE_PATH):
+    conn = getattr(_local, "connection", None)
+    if conn is not None and _local.pid == os.getpid() and _local.path == path:
+        return conn
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=60000")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS chunks (
+            id INTEGER PRIMARY KEY,
+            chunk_id TEXT NOT NULL,
+            meta TEXT NOT NULL,
+            text TEXT
+        )
+    """)
+
+    _local.connection = conn
+    _local.pid = os.getpid()
+    _local.path = path
+    return conn
+
+
+def put(entries, path=STORE_PATH):
+    # entries: (id, meta dict, text or None). A row whose meta changed (a
+    # re-chunked chunk has a new position) loses its old text unless the
+    # entry brings one.
+    conn = get_connection(path)
+    conn.execute("BEGIN")
+    conn.executemany(
+        "INSERT INTO chunks (id, chunk_id, meta, text) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(id) DO UPDATE SET chunk_id = excluded.chunk_id, meta = excluded.meta, "
+        "text = COALESCE(excluded.text, CASE WHEN chunks.meta = excluded.meta THEN chunks.text END)",
+        [(int(key), meta["chunk_id"], json.dumps(meta), text) for key, meta, text in entries]
+    )
+    conn.execute("COMMIT")
+
+
+def delete(ids, path=STORE_PATH):
+    conn = get_connection(path)
+    conn.execute("BEGIN")
+    conn.executemany("DELETE FROM chunks WHERE id = ?", [(int(key),) for key in ids])
+    conn.execute("COMMIT")
+
+
+def sync(meta_paths, rows, ids, path=STORE_PATH):
+    # Store = exactly the live shard rows
+    conn = get_connection(path)
+    wanted = set(rows.tolist())
+    batch = []
+    position = 0
+
+    for meta_path in meta_paths:
+        with open(meta_path, "rb") as f:
+            for line in f:
+                if position in wanted:
+                    meta = json.loads(line)
+                    batch.append((chunk_key(meta["chunk_id"]), meta, None))
+                    if len(batch) >= WRITE_BATCH:
+                        put(batch, path)
+                        batch = []
+                position += 1
+    if batch:
+        put(batch, path)
+
+    conn.execute("BEGIN")
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS live (id INTEGER PRIMARY KEY)")
+    conn.execute("DELETE FROM live")
+    conn.executemany("INSERT INTO live VALUES (?)", [(int(key),) for key in ids])
+    removed = conn.execute("DELETE FROM chunks WHERE id NOT IN (SELECT id FROM live)").rowcount
+    conn.execute("COMMIT")
+    return removed
+
+
+def missing_text(path=STORE_PATH):
+    # -> ({chunk position: id}, {id} without a position) for rows whose
+    # text hasn't been filled in yet
+    by_position = {}
+    by_key = set()
+    for key, meta in get_connection(path).execute("SELECT id, meta FROM chunks WHERE text IS NULL"):
+        position = json.loads(meta).get("position")
+        if position is None:
+            by_key.add(key)
+        else:
+            by_position[position] = key
+    return by_position, by_key
+
+
+def set_text(updates, path=STORE_PATH):
+    # updates: (text, id)
+    conn = get_connection(path)
+    conn.execute("BEGIN")
+    conn.executemany("UPDATE chunks SET text = ? WHERE id = ?", updates)
+    conn.execute("COMMIT")
+
+
+def lookup(ids, with_text=True, path=STORE_PATH):
+    # -> {id: meta dict (+ "text")} for the ids the store has
+    conn = get_connection(path)
+    columns = "id, meta, text" if with_text else "id, meta, NULL"
+    found = {}
+    unique = list({int(key) for key in ids if key >= 0})
+
+    for i in range(0, len(unique), LOOKUP_CHUNK):
+        part = unique[i:i + LOOKUP_CHUNK]
+        rows = conn.execute(f"SELECT {columns} FROM chunks WHERE id IN ({','.join('?' * len(part))})", part)
+        for key, meta, text in rows:
+            record = json.loads(meta)
+            if with_text:
+                record["text"] = text
+            found[key] = record
+
+    return found
+
+
+def dataset_ids(datasets, path=STORE_PATH):
+    # -> sorted ids of every chunk in these datasets
+    datasets = list(datasets)
+    rows = get_connection(path).execute(
+        f"SELECT id FROM chunks WHERE json_extract(meta, '$.dataset') IN ({','.join('?' * len(datasets))})", datasets)
+    return np.sort(np.array([key for key, in rows], dtype=np.int64))
+
+
+def count(path=STORE_PATH):
+    return get_connection(path).execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Look up chunks in the metadata store")
+    parser.add_argument("--store", default=STORE_PATH)
+    sub = parser.add_subparsers(dest="command", required=True)
+    get = sub.add_parser("get", help="print chunks by chunk_id or numeric id")
+    get.add_argument("keys", nargs="+")
+    args = parser.parse_args()
+
+    ids = [int(key) if key.isdigit() else chunk_key(key) for key in args.keys]
+    found = lookup(ids, path=args.store)
+    for key, name in zip(ids, args.keys):
+        print(json.dumps({"id": key, **found[key]} if key in found else {"id": key, "missing": name}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+import os
+import json
+import argparse
+import numpy as np
+from tqdm import tqdm
+
+import corpus_store
+
+# Offset-based chunk table: the compact alternative to chunks.jsonl.
+#
+# Each chunk is one fixed-width row that points into its document instead of
+# carrying a copy of the text and the document's metadata:
+#   doc_key       corpus_store.key_hash(doc_id), resolved through the
+#                 documents store's key index
+#   chunk_index   position of the chunk within its document
+#   token_count   content tokens (--tokens mode), -1 for word windows
+#   char_start / char_end   span in the document text
+#   byte_start / byte_end   the same span in the text's UTF-8 bytes
+#
+# The byte span lets a reader slice the chunk straight out of the mapped
+# documents store (zero-copy until it is decoded), so the embedder never
+# parses the text as JSON a second time. The table is a plain array of rows,
+# so it can be appended to, and row i is chunk position i just like line i
+# of chunks.jsonl.
+#
+#   python chunk_documents.py --table                 -> processed/chunks.table
+#   python chunk_table.py export                      -> processed/chunks.jsonl
+#   python chunk_table.py get <position>
+
+# -------- PATHS --------
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+
+CHUNKS_TABLE_PATH = os.path.join(PROJECT_ROOT, "processed", "chunks.table")
+CHUNKS_PATH = os.path.join(PROJECT_ROOT, "processed", "chunks.jsonl")
+
+# -------- FORMAT --------
+CHUNK_DTYPE = np.dtype([
+    ("doc_key", "<i8"),
+    ("chunk_index", "<i4"),
+    ("token_count", "<i4"),
+    ("char_start", "<i8"),
+    ("char_end", "<i8"),
+    ("byte_start", "<i8"),
+    ("byte_end", "<i8"),
+])
+
+DOC_FIELDS = ["doc_id", "dataset", "folder", "filename"]
+
+
+# -------- WRITER --------
+def encode_chunks(doc_id, text, chunks):
+    # chunks: dicts from chunk_documents with char_start / char_end (and
+    # token_count in token mode) -> the table rows for one document, as bytes
+    rows = np.zeros(len(chunks), dtype=CHUNK_DTYPE)
+    doc_key = corpus_store.key_hash(doc_id)
+
+    ascii = text.isascii()
+    char_pos = 0
+    byte_pos = 0
+
+    for i, chunk in enumerate(chunks):
+        start, end = chunk["char_start"], chunk["char_end"]
+
+        if ascii:
+            byte_start, byte_end = start, end
+        else:
+            # Chunk starts only move forward, so walk the text once rather
+            # than encoding a prefix per chunk
+            # Encoded like the documents store encodes the text
+            byte_start = byte_pos + len(text[char_pos:start].encode("utf-8", corpus_store.TEXT_ERRORS))
+            byte_end = byte_start + len(text[start:end].encode("utf-8", corpus_store.TEXT_ERRORS))
+            char_pos, byte_pos = start, byte_start
+
+        rows[i] = (
+            doc_key, chunk["chunk_index"], chunk.get("token_count", -1),
+            start, end, byte_start, byte_end
+        )
+
+    return rows.tobytes()
+
+
+# -------- READER --------
+class ChunkTable:
+    def __init__(self, path=CHUNKS_TABLE_PATH, docs_store=corpus_store.DOCS_STORE_PATH):
+        self.path = path
+        self.docs = corpus_store.open_store(docs_store)
+        self.text = self.docs.columns["text"]
+
+        # np.memmap refuses empty files
+        if os.path.getsize(path) > 0:
+            self.rows = np.memmap(path, dtype=CHUNK_DTYPE, mode="r")
+        else:
+            self.rows = np.zeros(0, dtype=CHUNK_DTYPE)
+
+        # Chunks of one document are consecutive, so one key probe per
+        # document rather than per chunk
+        self.last_key = None
+        self.last_row = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def doc_row(self, position):
+        key = self.rows[position]["doc_key"]
+        if key != self.last_key:
+            row = self.docs.find_hash(key)
+            if row is None:
+                raise KeyError(f"chunk {position}: document not in {self.docs.path}")
+            self.last_key, self.last_row = key, row
+        return self.last_row
+
+    def get_bytes(self, position):
+        # Zero-copy view of the chunk's UTF-8 text inside the documents store
+        entry = self.rows[position]
+        doc_text = self.text.get_bytes(self.doc_row(position))
+        return doc_text[entry["byte_start"]:entry["byte_end"]]
+
+    def get_text(self, position):
+        return bytes(self.get_bytes(position)).decode("utf-8", corpus_store.TEXT_ERRORS)
+
+    def record(self, position, fields=None):
+        # The chunks.jsonl record for this position, built on demand
+        entry = self.rows[position]
+        doc = self.docs.row(self.doc_row(position), DOC_FIELDS)
+        chunk_index = int(entry["chunk_index"])
+
+        record = {
+            "chunk_id": f"{doc['doc_id']}_{chunk_index}",
+            "doc_id": doc["doc_id"],
+            "dataset": doc["dataset"],
+            "folder": doc["folder"],
+            "filename": doc["filename"],
+            "chunk_index": chunk_index,
+            "char_start": int(entry["char_start"]),
+            "char_end": int(entry["char_end"]),
+        }
+        if entry["token_count"] >= 0:
+            record["token_count"] = int(entry["token_count"])
+
+        if fields is None or "text" in fields or "word_count" in fields:
+            text = self.get_text(position)
+            record["word_count"] = len(text.split())
+            record["text"] = text
+
+        if fields is not None:
+            record = {field: record[field] for field in fields if field in record}
+        return record
+
+    def iter_records(self, fields=None, start=0):
+        for position in range(start, len(self)):
+            yield self.record(position, fields)
+
+
+def open_table(path=CHUNKS_TABLE_PATH, docs_store=corpus_store.DOCS_STORE_PATH):
+    return ChunkTable(path, docs_store)
+
+
+# -------- EXPORT --------
+EXPORT_FIELDS = [
+    "chunk_id", "doc_id", "dataset", "folder", "filename",
+    "chunk_index", "word_count", "text", "token_count"
+]
+
+
+def table_to_jsonl(table_path, docs_store, jsonl_path):
+    # Full-text chunks.jsonl for anything that still reads the old format
+    table = open_table(table_path, docs_store)
+    with open(jsonl_path, "w", encoding="utf-8") as f:
+        for record in tqdm(table.iter_records(EXPORT_FIELDS), total=len(table), desc="Exporting"):
+            f.write(json.dumps(record) + "\n")
+    print(f"Wrote {len(table)} chunks to {jsonl_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read or export the offset-based chunk table")
+    parser.add_argument("--table", default=CHUNKS_TABLE_PATH)
+    parser.add_argument("--docs-store", default=corpus_store.DOCS_STORE_PATH)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    export = sub.add_parser("export", help="table -> full-text chunks.jsonl")
+    export.add_argument("jsonl", nargs="?", default=CHUNKS_PATH)
+
+    lookup = sub.add_parser("get", help="print one chunk by position")
+    lookup.add_argument("position", type=int)
+
+    args = parser.parse_args()
+
+    if args.command == "export":
+        table_to_jsonl(args.table, args.docs_store, args.jsonl)
+    else:
+        print(json.dumps(open_table(args.table, args.docs_store).record(args.position), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,484 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+from array import array
+import numpy as np
+from tqdm import tqdm
+
+# Offset-indexed corpus store for documents.jsonl / chunks.jsonl.
+#
+# A store is a directory with one file per field instead of one JSON object
+# per line:
+#   <field>.data + <field>.offsets   strings (text included): one contiguous
+#                                    UTF-8 blob plus int64 row offsets
+#   <field>.data                     ints / floats / bools: fixed-width column
+#   <field>.present                  only for fields some rows don't have
+#                                    or hold null: one byte per row, 0 no
+#                                    field, 1 a value, 2 null
+#   key.hashes + key.rows            open-addressing hash table on the key
+#                                    field (doc_id / chunk_id)
+#   schema.json
+#
+# Strings are stored as UTF-8 with surrogatepass, so text carrying a lone
+# surrogate (a bad decode upstream) round-trips instead of failing the
+# import; chunk_table's byte offsets count the same way. An int column that
+# meets a float is widened to float.
+#
+# Everything is opened with mmap, so opening a store costs nothing, a single
+# field can be read for every row without touching the others, and a key
+# lookup is a couple of probes into key.hashes.
+#
+# Convert with:
+#   python corpus_store.py import processed/documents.jsonl processed/documents.store --key doc_id
+#   python corpus_store.py export processed/documents.store processed/documents.jsonl
+
+# -------- PATHS --------
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+
+DOCS_STORE_PATH = os.path.join(PROJECT_ROOT, "processed", "documents.store")
+CHUNKS_STORE_PATH = os.path.join(PROJECT_ROOT, "processed", "chunks.store")
+
+# -------- CONFIG --------
+FORMAT_VERSION = 2
+READABLE_VERSIONS = [1, 2]  # 1: no null rows
+FLUSH_ROWS = 65536
+
+FIXED_KINDS = {
+    "int": ("q", np.int64),
+    "float": ("d", np.float64),
+    "bool": ("b", np.int8),
+}
+EMPTY_SLOT = -1
+TEXT_ERRORS = "surrogatepass"
+
+# .present values
+ABSENT = 0
+PRESENT = 1
+NULL = 2
+
+
+def value_kind(value):
+    # bool before int: True is an int in Python
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, int):
+        return "int"
+    if isinstance(value, float):
+        return "float"
+    if isinstance(value, str):
+        return "str"
+    return "json"
+
+
+def key_hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8", TEXT_ERRORS), digest_size=8).digest(), "little", signed=True)
+
+
+# -------- WRITER --------
+class ColumnWriter:
+    def __init__(self, store_dir, name, kind, start_row, null_rows=()):
+        self.store_dir = store_dir
+        self.name = name
+        self.kind = kind
+        self.rows = 0
+        self.missing = 0
+
+        self.data_file = open(os.path.join(store_dir, f"{name}.data"), "wb")
+        self.present_file = open(os.path.join(store_dir, f"{name}.present"), "wb")
+
+        if kind in FIXED_KINDS:
+            self.buffer = array(FIXED_KINDS[kind][0])
+            self.offsets_file = None
+        else:
+            self.buffer = []
+            self.offsets_file = open(os.path.join(store_dir, f"{name}.offsets"), "wb")
+            self.offsets = array("q", [0])
+            self.data_size = 0
+
+        self.present = bytearray()
+
+        # A field first seen at row N is absent from every row before it,
+        # or null where a row had it as null
+        null_rows = set(null_rows)
+        for row in range(start_row):
+            self.append(None, row not in null_rows)
+
+    def append(self, value, missing=False):
+        # value None: the row has the field as null, or (missing) not at all
+        self.rows += 1
+        state = ABSENT if missing else NULL if value is None else PRESENT
+        self.present.append(state)
+
+        if state != PRESENT:
+            self.missing += 1
+
+        if self.kind in FIXED_KINDS:
+            self.buffer.append(value if state == PRESENT else 0)
+        else:
+            if state != PRESENT:
+                data = b""
+            elif self.kind == "json":
+                data = json.dumps(value).encode("utf-8")
+            else:
+                data = value.encode("utf-8", TEXT_ERRORS)
+            self.buffer.append(data)
+            self.data_size += len(data)
+            self.offsets.append(self.data_size)
+
+        if len(self.present) >= FLUSH_ROWS:
+            self.flush()
+
+    def widen(self):
+        # int column -> float: the rows written so far are converted once
+        self.flush()
+        self.data_file.close()
+        path = os.path.join(self.store_dir, f"{self.name}.data")
+        np.fromfile(path, dtype=np.int64).astype(np.float64).tofile(path)
+        self.data_file = open(path, "ab")
+        self.kind = "float"
+        self.buffer = array(FIXED_KINDS["float"][0])
+
+    def flush(self):
+        if self.kind in FIXED_KINDS:
+            self.buffer.tofile(self.data_file)
+            self.buffer = array(FIXED_KINDS[self.kind][0])
+        else:
+            self.data_file.write(b"".join(self.buffer))
+            self.buffer = []
+            self.offsets.tofile(self.offsets_file)
+            self.offsets = array("q")
+
+        self.present_file.write(self.present)
+        self.present = bytearray()
+
+    def close(self, store_dir):
+        self.flush()
+        self.data_file.close()
+        self.present_file.close()
+        if self.offsets_file is not None:
+            self.offsets_file.close()
+
+        if self.missing == 0:
+            os.remove(os.path.join(store_dir, f"{self.name}.present"))
+
+        return {"kind": self.kind, "has_presence": self.missing > 0}
+
+
+class StoreWriter:
+    # Writes into <path>.tmp and swaps it in on close, so readers never see a
+    # half-written store
+
+    def __init__(self, path, key_field):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.key_field = key_field
+        self.columns = {}
+        self.field_order = []
+        self.null_rows = {}  # fields only seen as null so far -> those rows
+        self.rows = 0
+
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+
+    def add(self, record):
+        if self.key_field not in record:
+            raise ValueError(f"record {self.rows} has no {self.key_field!r} field")
+
+        for name, value in record.items():
+            if name in self.columns:
+                continue
+            if value is None:
+                self.null_rows.setdefault(name, []).append(self.rows)
+                continue
+            self.columns[name] = ColumnWriter(self.tmp_path, name, value_kind(value), self.rows,
+                                              self.null_rows.pop(name, ()))
+            self.field_order.append(name)
+
+        for name, column in self.columns.items():
+            if name not in record:
+                column.append(None, missing=True)
+                continue
+
+            value = record[name]
+            if value is not None and column.kind != "json" and value_kind(value) != column.kind:
+                if column.kind == "int" and value_kind(value) == "float":
+                    column.widen()
+                elif column.kind == "float" and value_kind(value) == "int":
+                    value = float(value)
+                else:
+                    raise ValueError(
+                        f"row {self.rows}: field {name!r} is {value_kind(value)}, column is {column.kind}"
+                    )
+            column.append(value)
+
+        self.rows += 1
+
+    def close(self):
+        # Fields that were never anything but null get a column of their own
+        for name, rows in self.null_rows.items():
+            column = ColumnWriter(self.tmp_path, name, "null", 0)
+            null_rows = set(rows)
+            for row in range(self.rows):
+                column.append(None, row not in null_rows)
+            self.columns[name] = column
+            self.field_order.append(name)
+        self.null_rows = {}
+
+        schema = {
+            "version": FORMAT_VERSION,
+            "rows": self.rows,
+            "key_field": self.key_field,
+            "field_order": self.field_order,
+            "columns": {name: column.close(self.tmp_path) for name, column in self.columns.items()},
+        }
+        schema["hash_slots"] = build_key_index(self.tmp_path, schema)
+
+        with open(os.path.join(self.tmp_path, "schema.json"), "w") as f:
+            json.dump(schema, f, indent=2)
+
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self.tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+
+def build_key_index(store_dir, schema):
+    rows = schema["rows"]
+    slots = 8
+    while slots < rows * 2:
+        slots *= 2
+    mask = slots - 1
+
+    hashes = np.zeros(slots, dtype=np.int64)
+    slot_rows = np.full(slots, EMPTY_SLOT, dtype=np.int64)
+
+    keys = StringColumn(store_dir, schema["key_field"])
+    for row in range(rows):
+        h = key_hash(keys.get(row))
+        slot = h & mask
+        while slot_rows[slot] != EMPTY_SLOT:
+            slot = (slot + 1) & mask
+        hashes[slot] = h
+        slot_rows[slot] = row
+    keys.close()
+
+    hashes.tofile(os.path.join(store_dir, "key.hashes"))
+    slot_rows.tofile(os.path.join(store_dir, "key.rows"))
+    return slots
+
+
+# -------- READER --------
+class StringColumn:
+    def __init__(self, store_dir, name, kind="str"):
+        self.kind = kind
+        self.offsets = np.memmap(os.path.join(store_dir, f"{name}.offsets"), dtype=np.int64, mode="r")
+        data_path = os.path.join(store_dir, f"{name}.data")
+        # np.memmap refuses empty files
+        if os.path.getsize(data_path) > 0:
+            self.data = np.memmap(data_path, dtype=np.uint8, mode="r")
+        else:
+            self.data = np.zeros(0, dtype=np.uint8)
+
+    def get_bytes(self, row):
+        # Zero-copy view into the mapped blob
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return memoryview(self.data[start:end])
+
+    def get(self, row):
+        raw = bytes(self.get_bytes(row)).decode("utf-8", TEXT_ERRORS)
+        return json.loads(raw) if self.kind == "json" else raw
+
+    def close(self):
+        self.offsets = None
+        self.data = None
+
+
+class CorpusStore:
+    def __init__(self, path):
+        self.path = path
+
+        with open(os.path.join(path, "schema.json"), "r") as f:
+            self.schema = json.load(f)
+
+        if self.schema["version"] not in READABLE_VERSIONS:
+            raise ValueError(f"{path}: store format {self.schema['version']}, expected {FORMAT_VERSION}")
+
+        self.rows = self.schema["rows"]
+        self.key_field = self.schema["key_field"]
+        self.field_order = self.schema["field_order"]
+        self.columns = {}
+        self.present = {}
+
+        for name, info in self.schema["columns"].items():
+            kind = info["kind"]
+            if kind in FIXED_KINDS:
+                dtype = FIXED_KINDS[kind][1]
+                self.columns[name] = np.memmap(os.path.join(path, f"{name}.data"), dtype=dtype, mode="r", shape=(self.rows,)) if self.rows else np.zeros(0, dtype=dtype)
+            else:
+                self.columns[name] = StringColumn(path, name, kind)
+
+            if info["has_presence"]:
+                self.present[name] = np.memmap(os.path.join(path, f"{name}.present"), dtype=np.int8, mode="r")
+
+        self.hash_mask = self.schema["hash_slots"] - 1
+        self.key_hashes = np.memmap(os.path.join(path, "key.hashes"), dtype=np.int64, mode="r")
+        self.key_rows = np.memmap(os.path.join(path, "key.rows"), dtype=np.int64, mode="r")
+
+    def __len__(self):
+        return self.rows
+
+    def kind(self, field):
+        return self.schema["columns"][field]["kind"]
+
+    def column(self, field):
+        # Whole numeric column as a mapped numpy array
+        return self.columns[field]
+
+    def state(self, row, field):
+        # ABSENT / PRESENT / NULL
+        if field in self.present:
+            return int(self.present[field][row])
+        return PRESENT
+
+    def get(self, row, field):
+        if self.state(row, field) != PRESENT:
+            return None
+
+        column = self.columns[field]
+        kind = self.kind(field)
+        if kind == "str" or kind == "json":
+            return column.get(row)
+        if kind == "bool":
+            return bool(column[row])
+        if kind == "int":
+            return int(column[row])
+        return float(column[row])
+
+    def get_bytes(self, row, field):
+        return self.columns[field].get_bytes(row)
+
+    def row(self, row, fields=None):
+        record = {}
+        for field in fields or self.field_order:
+            if field not in self.columns:
+                continue  # no row has it, same as a JSONL line without the key
+            state = self.state(row, field)
+            if state != ABSENT:
+                record[field] = self.get(row, field) if state == PRESENT else None
+        return record
+
+    def find(self, key):
+        h = key_hash(key)
+        slot = h & self.hash_mask
+        keys = self.columns[self.key_field]
+
+        while True:
+            row = self.key_rows[slot]
+            if row == EMPTY_SLOT:
+                return None
+            if self.key_hashes[slot] == h and keys.get(row) == key:
+                return int(row)
+            slot = (slot + 1) & self.hash_mask
+
+    def find_hash(self, h):
+        # Row for a precomputed key_hash(), for fixed-width tables that
+        # reference records by hash instead of holding the key string. A
+        # 64-bit collision between two keys of one store isn't guarded
+        # against.
+        h = int(h)
+        slot = h & self.hash_mask
+
+        while True:
+            row = self.key_rows[slot]
+            if row == EMPTY_SLOT:
+                return None
+            if self.key_hashes[slot] == h:
+                return int(row)
+            slot = (slot + 1) & self.hash_mask
+
+    def get_record(self, key, fields=None):
+        row = self.find(key)
+        return None if row is None else self.row(row, fields)
+
+    def iter_records(self, fields=None, start=0):
+        for row in range(start, self.rows):
+            yield self.row(row, fields)
+
+
+def open_store(path):
+    return CorpusStore(path)
+
+
+def iter_jsonl_or_store(jsonl_path, store_path=None, fields=None, start=0):
+    # Shared entry point for the pipeline scripts: records from the store when
+    # one is given, otherwise the original JSONL
+    if store_path is not None:
+        yield from open_store(store_path).iter_records(fields, start)
+        return
+
+    with open(jsonl_path, "r", encoding="utf-8") as f:
+        for i, line in enumerate(f):
+            if i < start:
+                continue
+            yield json.loads(line)
+
+
+# -------- CONVERTERS --------
+def jsonl_to_store(jsonl_path, store_path, key_field):
+    with open(jsonl_path, "r", encoding="utf-8") as f, StoreWriter(store_path, key_field) as writer:
+        for line in tqdm(f, desc="Importing"):
+            writer.add(json.loads(line))
+    print(f"Wrote {writer.rows} rows to {store_path}")
+
+
+def store_to_jsonl(store_path, jsonl_path):
+    store = open_store(store_path)
+    with open(jsonl_path, "w", encoding="utf-8") as f:
+        for record in tqdm(store.iter_records(), total=len(store), desc="Exporting"):
+            f.write(json.dumps(record) + "\n")
+    print(f"Wrote {len(store)} rows to {jsonl_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert between JSONL and the mmap corpus store")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    to_store = sub.add_parser("import", help="JSONL -> store")
+    to_store.add_argument("jsonl")
+    to_store.add_argument("store")
+    to_store.add_argument("--key", default="doc_id", help="unique key field (doc_id or chunk_id)")
+
+    to_jsonl = sub.add_parser("export", help="store -> JSONL")
+    to_jsonl.add_argument("store")
+    to_jsonl.add_argument("jsonl")
+
+    lookup = sub.add_parser("get", help="print one record by key")
+    lookup.add_argument("store")
+    lookup.add_argument("key")
+
+    args = parser.parse_args()
+
+    if args.command == "import":
+        jsonl_to_store(args.jsonl, args.store, args.key)
+    elif args.command == "export":
+        store_to_jsonl(args.store, args.jsonl)
+    else:
+        record = open_store(args.store).get_record(args.key)
+        if record is None:
+            sys.exit(f"{args.key} not found")
+        print(json.dumps(record, indent=2))
+
+
+if __name__ == "__main__":
+    main()
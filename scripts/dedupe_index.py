@@ -0,0 +1,127 @@
+import os
+import hashlib
+from tqdm import tqdm
+
+# Global dedupe index for Dataset 9. Every PDF that has ever been committed is
+# recorded by EFTA ID and by SHA-256 of its bytes, across every folder and
+# every run, so a re-crawled or re-numbered copy never reaches disk again.
+#
+# On disk it is an append-only text file, one "id <EFTA>" or "sha <hex>" per
+# line. In memory the IDs are a set of str and the hashes a set of 32-byte
+# digests, so membership is O(1) at a few hundred bytes per document.
+#
+# A line without its newline is a write cut short by a crash. Readers stop
+# there, and open_for_append cuts it off before anything else is appended.
+#
+# Run this file directly to rebuild the index from the PDFs already on disk.
+
+# -------- PATHS --------
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+
+DATASET_ROOT = os.path.join(PROJECT_ROOT, "raw_pdfs", "Dataset 9")
+INDEX_PATH = os.path.join(PROJECT_ROOT, "processed", "dataset9_dedupe_index.txt")
+
+
+# -------- HASHING --------
+def hash_bytes(pdf_bytes):
+    return hashlib.sha256(pdf_bytes).digest()
+
+
+def hash_file(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.digest()
+
+
+# -------- INDEX --------
+def load_index():
+    if not os.path.exists(INDEX_PATH):
+        return rebuild_index()
+
+    index = {"ids": set(), "hashes": set()}
+
+    with open(INDEX_PATH, "r", encoding="ascii") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break
+            kind, _, value = line.rstrip("\n").partition(" ")
+            if kind == "id":
+                index["ids"].add(value)
+            elif kind == "sha":
+                index["hashes"].add(bytes.fromhex(value))
+
+    return index
+
+
+def is_duplicate(index, doc_id=None, content_hash=None):
+    if doc_id is not None and doc_id in index["ids"]:
+        return True
+    if content_hash is not None and content_hash in index["hashes"]:
+        return True
+    return False
+
+
+def add(index, index_file, doc_id, content_hash):
+    index["ids"].add(doc_id)
+    index["hashes"].add(content_hash)
+    index_file.write(f"id {doc_id}\nsha {content_hash.hex()}\n")
+
+
+def repair_index():
+    if not os.path.exists(INDEX_PATH):
+        return
+    # Lines are short, so the last newline is always in the final block
+    with open(INDEX_PATH, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        start = max(0, size - 4096)
+        f.seek(start)
+        tail = f.read()
+        end = start + tail.rfind(b"\n") + 1
+        if end < size and (end > start or start == 0):
+            f.truncate(end)
+
+
+def open_for_append():
+    os.makedirs(os.path.dirname(INDEX_PATH), exist_ok=True)
+    repair_index()
+    return open(INDEX_PATH, "a", encoding="ascii")
+
+
+def rebuild_index():
+    index = {"ids": set(), "hashes": set()}
+    duplicates = 0
+
+    tmp_path = INDEX_PATH + ".tmp"
+    os.makedirs(os.path.dirname(INDEX_PATH), exist_ok=True)
+
+    with open(tmp_path, "w", encoding="ascii") as index_file:
+        if os.path.isdir(DATASET_ROOT):
+            for folder in tqdm(sorted(os.listdir(DATASET_ROOT)), desc="Indexing Dataset 9"):
+                folder_path = os.path.join(DATASET_ROOT, folder)
+                if not os.path.isdir(folder_path):
+                    continue
+
+                for filename in sorted(os.listdir(folder_path)):
+                    if not filename.lower().endswith(".pdf"):
+                        continue
+
+                    doc_id = filename[:-4]
+                    content_hash = hash_file(os.path.join(folder_path, filename))
+
+                    if is_duplicate(index, doc_id, content_hash):
+                        duplicates += 1
+                        continue
+
+                    add(index, index_file, doc_id, content_hash)
+
+    os.replace(tmp_path, INDEX_PATH)
+
+    print(f"Dedupe index built: {len(index['ids'])} documents, {duplicates} duplicates already on disk")
+    return index
+
+
+if __name__ == "__main__":
+    rebuild_index()
@@ -0,0 +1,134 @@
+import os
+import time
+import random
+import argparse
+import numpy as np
+import torch
+from sentence_transformers import SentenceTransformer
+
+import corpus_store
+
+# Embedding model backends for build_vector_index (and query-time encoding):
+#   fp32   the model as published; on the GPU when there is one
+#   int8   torch dynamic quantization: every nn.Linear gets int8 weights and
+#          quantizes its activations on the fly. CPU only, no extra packages.
+#   onnx   sentence-transformers' ONNX Runtime backend, an exported graph
+#          with fused kernels. CPU only, needs optimum[onnxruntime].
+#
+# Vectors from different backends are close but not interchangeable, so the
+# backend is part of the embedding-cache key and is recorded in the shard
+# cursor. `check` measures how close on a sample of real chunks:
+#
+#   python embedding_backend.py check --backend int8 --sample 2000 --k 10
+
+# -------- PATHS --------
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+
+CHUNKS_PATH = os.path.join(PROJECT_ROOT, "processed", "chunks.jsonl")
+
+# -------- CONFIG --------
+MODEL_NAME = "BAAI/bge-large-en-v1.5"
+BACKENDS = ["fp32", "int8", "onnx"]
+CHECK_BATCH_SIZE = 32
+SAMPLE_POOL = 20  # sample from the first SAMPLE_POOL x N chunks
+
+
+# -------- LOADING --------
+def load_model(backend="fp32", threads=None, device=None):
+    if threads is not None:
+        torch.set_num_threads(threads)
+
+    if backend == "fp32":
+        device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        return SentenceTransformer(MODEL_NAME, device=device)
+
+    if backend == "int8":
+        model = SentenceTransformer(MODEL_NAME, device="cpu")
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    if backend == "onnx":
+        try:
+            import onnxruntime
+        except ImportError:
+            raise SystemExit("The onnx backend needs optimum[onnxruntime] (pip install optimum[onnxruntime])")
+
+        model_kwargs = {}
+        if threads is not None:
+            # ORT ignores torch's thread setting; without this every encoder
+            # process would claim all cores
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = threads
+            model_kwargs["session_options"] = options
+        return SentenceTransformer(MODEL_NAME, device="cpu", backend="onnx", model_kwargs=model_kwargs)
+
+    raise ValueError(f"unknown backend {backend!r}, expected one of {BACKENDS}")
+
+
+def model_key(backend):
+    # Embedding-cache key; fp32 keeps the bare model name it always had
+    return MODEL_NAME if backend == "fp32" else f"{MODEL_NAME}:{backend}"
+
+
+# -------- QUALITY CHECK --------
+def sample_texts(num_chunks, chunks_store=None, seed=0):
+    pool = []
+    for record in corpus_store.iter_jsonl_or_store(CHUNKS_PATH, chunks_store, ["text"]):
+        pool.append(record["text"])
+        if len(pool) >= num_chunks * SAMPLE_POOL:
+            break
+    return random.Random(seed).sample(pool, min(num_chunks, len(pool)))
+
+
+def timed_encode(model, texts):
+    model.encode(texts[:CHECK_BATCH_SIZE], batch_size=CHECK_BATCH_SIZE)  # warm-up
+    started = time.time()
+    vectors = model.encode(texts, batch_size=CHECK_BATCH_SIZE, convert_to_numpy=True, normalize_embeddings=True)
+    return vectors.astype(np.float32), max(time.time() - started, 1e-9)
+
+
+def top_k(vectors, k):
+    # Every sample chunk as a query against all the others
+    scores = vectors @ vectors.T
+    np.fill_diagonal(scores, -np.inf)
+    return np.argpartition(-scores, k, axis=1)[:, :k]
+
+
+def check(backend, num_chunks, k, chunks_store=None):
+    texts = sample_texts(num_chunks, chunks_store)
+    if len(texts) <= k:
+        raise SystemExit(f"Only {len(texts)} chunks to sample; need more than k={k}")
+    print(f"Comparing {backend} against fp32 on {len(texts)} chunks")
+
+    baseline, baseline_seconds = timed_encode(load_model("fp32", device="cpu"), texts)
+    candidate, candidate_seconds = timed_encode(load_model(backend), texts)
+
+    # Both sides are unit vectors
+    cosine = np.sum(baseline * candidate, axis=1)
+
+    expected = top_k(baseline, k)
+    found = top_k(candidate, k)
+    recall = np.mean([len(set(e) & set(f)) / k for e, f in zip(expected, found)])
+
+    print(f"fp32:      {len(texts) / baseline_seconds:8.1f} chunks/s")
+    print(f"{backend + ':':<10} {len(texts) / candidate_seconds:8.1f} chunks/s ({baseline_seconds / candidate_seconds:.2f}x)")
+    print(f"Cosine to fp32: mean {cosine.mean():.4f}, p1 {np.percentile(cosine, 1):.4f}, min {cosine.min():.4f}")
+    print(f"Recall@{k} vs fp32 neighbours: {recall:.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embedding backends and their quality check")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    check_parser = sub.add_parser("check", help="speed, cosine and recall@k of a backend against fp32")
+    check_parser.add_argument("--backend", choices=BACKENDS[1:], default="int8")
+    check_parser.add_argument("--sample", type=int, default=2000, help="chunks to compare on")
+    check_parser.add_argument("--k", type=int, default=10)
+    check_parser.add_argument("--chunks-store", default=None, help="sample from a corpus store instead of chunks.jsonl")
+
+    args = parser.parse_args()
+    check(args.backend, args.sample, args.k, args.chunks_store)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import os
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+
+# Persistent embedding cache. build_vector_index looks every chunk up here
+# before encoding, so re-chunking or re-scrubbing only pays for the chunk
+# texts that actually changed. Keyed by (model, normalize flag, text hash);
+# vectors are stored as float16, half the size of the index's float32.
+
+# -------- PATHS --------
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+
+CACHE_PATH = os.path.join(PROJECT_ROOT, "processed", "embedding_cache.sqlite")
+
+# -------- CONFIG --------
+CACHE_ENABLED = True
+LOOKUP_CHUNK = 900  # hashes per IN (...) query, under SQLite's variable limit
+
+# One connection per thread: the pipelined indexer looks up from its reader
+# thread while the main thread stores
+_local = threading.local()
+
+
+# -------- CONNECTION --------
+def get_connection():
+    conn = getattr(_local, "connection", None)
+    if conn is not None and _local.pid == os.getpid():
+        return conn
+
+    os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+
+    # Same settings as text_cache: WAL readers never block the writer
+    conn = sqlite3.connect(CACHE_PATH, timeout=60, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=60000")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS embeddings (
+            model TEXT NOT NULL,
+            normalized INTEGER NOT NULL,
+            text_hash BLOB NOT NULL,
+            vector BLOB NOT NULL,
+            PRIMARY KEY (model, normalized, text_hash)
+        ) WITHOUT ROWID
+    """)
+
+    _local.connection = conn
+    _local.pid = os.getpid()
+    return conn
+
+
+# -------- CACHE --------
+def text_hash(text):
+    # surrogatepass: a lone surrogate in a chunk hashes instead of failing
+    return hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+
+def lookup(model, normalized, hashes):
+    # -> {hash: float16 vector} for the hashes that are cached
+    conn = get_connection()
+    found = {}
+    unique = list(set(hashes))
+
+    for i in range(0, len(unique), LOOKUP_CHUNK):
+        part = unique[i:i + LOOKUP_CHUNK]
+        rows = conn.execute(
+            f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND normalized = ? "
+            f"AND text_hash IN ({','.join('?' * len(part))})",
+            [model, int(normalized), *part]
+        )
+        for h, blob in rows:
+            found[h] = np.frombuffer(blob, dtype=np.float16)
+
+    return found
+
+
+def store(model, normalized, hashes, vectors):
+    vectors = np.asarray(vectors, dtype=np.float16)
+    conn = get_connection()
+    conn.execute("BEGIN")
+    conn.executemany(
+        "INSERT OR IGNORE INTO embeddings VALUES (?, ?, ?, ?)",
+        [(model, int(normalized), h, vector.tobytes()) for h, vector in zip(hashes, vectors)]
+    )
+    conn.execute("COMMIT")
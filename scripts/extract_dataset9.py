@@ -2,10 +2,18 @@ import os
 import gzip
 import json
 import re
-import fitz
+import shutil
+import argparse
+from multiprocessing import cpu_count
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from warcio.archiveiterator import ArchiveIterator
 from tqdm import tqdm
 
+import dedupe_index
+import ingest_pdf
+import pdf_extract
+
 # Dataset 9 was bruteforced by a 3rd party. It was supplied as .warc in .gz folders and required additional scripting to clean and extract
 
 # -------- PATH RESOLUTION --------
@@ -15,13 +23,24 @@ PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
 WARC_ROOT = os.path.join(PROJECT_ROOT, "raw_warc")
 DATASET_ROOT = os.path.join(PROJECT_ROOT, "raw_pdfs", "Dataset 9")
 CHECKPOINT_PATH = os.path.join(PROJECT_ROOT, "processed", "dataset9_checkpoint.json")
+STAGING_ROOT = os.path.join(PROJECT_ROOT, "processed", "dataset9_staging")
+FOLDER_STATE_PATH = os.path.join(PROJECT_ROOT, "processed", "dataset9_folder_state.json")
 
 os.makedirs(DATASET_ROOT, exist_ok=True)
 
 # -------- CONFIG --------
+DATASET_NAME = "Dataset 9"
+DATASET_ID = "9"
 PDFS_PER_FOLDER = 1000
 EFTA_PATTERN = re.compile(r"EFTA\d+")
 
+# Parallel mode: WARC_WORKERS archives are staged at once, each with its own
+# pool of PDF_WORKERS_PER_WARC parsers. MAX_IN_FLIGHT bounds how many PDFs a
+# reader holds in memory while waiting on its parsers.
+WARC_WORKERS = 4
+PDF_WORKERS_PER_WARC = max(1, int(cpu_count() * 0.7) // WARC_WORKERS)
+MAX_IN_FLIGHT = 64
+
 # -------- CHECKPOINT --------
 def load_checkpoint():
     if not os.path.exists(CHECKPOINT_PATH):
@@ -47,7 +66,7 @@ def get_current_folder_and_count():
     return folder, count
 
 # -------- CORE EXTRACTION --------
-def process_warc(warc_path):
+def process_warc(warc_path, index):
     print(f"\n=== Processing WARC: {os.path.basename(warc_path)} ===")
 
     folder, count = get_current_folder_and_count()
@@ -57,8 +76,11 @@ def process_warc(warc_path):
     else:
         stream = open(warc_path, 'rb')
 
-    with stream:
-        for record in tqdm(ArchiveIterator(stream)):
+    with stream, \
+         dedupe_index.open_for_append() as index_file, \
+         pdf_extract.open_error_log() as error_file:
+
+        for seq, record in enumerate(tqdm(ArchiveIterator(stream))):
             if record.rec_type != 'response':
                 continue
 
@@ -70,12 +92,11 @@ def process_warc(warc_path):
             try:
                 pdf_bytes = record.content_stream().read()
 
-                # Open PDF in memory
-                doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-                text = ""
-                for page in doc:
-                    text += page.get_text("text") + "\n"
-                doc.close()
+                content_hash = dedupe_index.hash_bytes(pdf_bytes)
+                if dedupe_index.is_duplicate(index, content_hash=content_hash):
+                    continue
+
+                text = pdf_extract.extract_text(pdf_bytes=pdf_bytes)
 
                 matches = EFTA_PATTERN.findall(text)
                 if not matches:
@@ -89,13 +110,15 @@ def process_warc(warc_path):
 
                 output_path = os.path.join(folder_path, filename)
 
-                # Deduplicate
-                if os.path.exists(output_path):
+                # Deduplicate against every folder and every earlier run
+                if dedupe_index.is_duplicate(index, doc_id) or os.path.exists(output_path):
                     continue
 
                 with open(output_path, "wb") as f:
                     f.write(pdf_bytes)
 
+                dedupe_index.add(index, index_file, doc_id, content_hash)
+
                 count += 1
 
                 # Folder rollover
@@ -103,15 +126,282 @@ def process_warc(warc_path):
                     folder = f"{int(folder) + 1:04d}"
                     count = 0
 
+            except Exception as e:
+                pdf_extract.log_error(error_file, pdf_extract.error_record(
+                    type(e).__name__, str(e), warc=os.path.basename(warc_path), record=seq
+                ))
+                continue
+
+# -------- STAGED EXTRACTION --------
+# Staging runs out of order across processes, but nothing lands in DATASET_ROOT
+# or documents.jsonl until commit_staged_warc() replays each WARC in sorted
+# order, so folder rollover and the checkpoint match a serial run exactly.
+def iter_pdf_records(warc_path, index=None):
+    if warc_path.endswith(".gz"):
+        stream = gzip.open(warc_path, 'rb')
+    else:
+        stream = open(warc_path, 'rb')
+
+    with stream:
+        for record in ArchiveIterator(stream):
+            if record.rec_type != 'response':
+                continue
+
+            content_type = record.http_headers.get_header('Content-Type')
+
+            if not content_type or 'application/pdf' not in content_type:
+                continue
+
+            try:
+                pdf_bytes = record.content_stream().read()
             except Exception:
                 continue
 
+            content_hash = dedupe_index.hash_bytes(pdf_bytes)
+
+            # Content committed by an earlier run is never worth parsing again
+            if index is not None and dedupe_index.is_duplicate(index, content_hash=content_hash):
+                continue
+
+            yield pdf_bytes, content_hash
+
+def find_efta_id(pdf_record, keep_text=False):
+    pdf_bytes, _ = pdf_record
+
+    text = pdf_extract.extract_text(pdf_bytes=pdf_bytes)
+
+    matches = EFTA_PATTERN.findall(text)
+    if not matches:
+        return None, None
+
+    # last occurrence = footer ID. The text only crosses back from the worker
+    # when the fused path is going to turn it into a documents.jsonl record.
+    return matches[-1], (text if keep_text else None)
+
+_stage_index = None
+
+def get_stage_index():
+    global _stage_index
+    if _stage_index is None:
+        _stage_index = dedupe_index.load_index()
+    return _stage_index
+
+def get_staging_dir(warc_file):
+    return os.path.join(STAGING_ROOT, warc_file)
+
+def stage_warc(warc_path, fused=False, write_pdfs=True):
+    warc_file = os.path.basename(warc_path)
+    staging_dir = get_staging_dir(warc_file)
+    records_path = os.path.join(staging_dir, "records.jsonl")
+    done_path = os.path.join(staging_dir, "DONE")
+
+    # A finished stage survives a crash during commit, so don't redo it
+    if os.path.exists(done_path):
+        return warc_file
+
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(staging_dir, exist_ok=True)
+
+    parse = partial(find_efta_id, keep_text=fused)
+    # A snapshot is enough here: it only saves parsing content an earlier run
+    # already committed. commit_staged_warc() holds the authoritative index.
+    records = iter_pdf_records(warc_path, get_stage_index())
+
+    with pdf_extract.ExtractionPool(parse, PDF_WORKERS_PER_WARC) as pool, \
+         pdf_extract.open_error_log() as error_file, \
+         open(records_path, "w", encoding="utf-8") as records_file:
+
+        # Ordered, and never more than MAX_IN_FLIGHT PDFs ahead of this loop,
+        # so a multi-GB WARC is never buffered in RAM
+        results = pool.imap(records, MAX_IN_FLIGHT)
+
+        for seq, ((pdf_bytes, content_hash), ok, value) in enumerate(results):
+            if not ok:
+                pdf_extract.log_error(error_file, dict(value, warc=warc_file, record=seq))
+                continue
+
+            doc_id, text = value
+            if doc_id is None:
+                continue
+
+            # --skip-pdfs still keeps the PDF of a document that will be
+            # discarded for too little text: its discarded.jsonl record points
+            # at it, and recover_discarded_documents / analyze_discarded
+            # reopen it from there
+            staged_name = None
+            if write_pdfs or len(ingest_pdf.normalize_text(text or "")) < ingest_pdf.MIN_TEXT_LENGTH:
+                staged_name = f"{seq:08d}.pdf"
+                with open(os.path.join(staging_dir, staged_name), "wb") as f:
+                    f.write(pdf_bytes)
+
+            records_file.write(json.dumps({
+                "staged_name": staged_name,
+                "doc_id": doc_id,
+                "sha256": content_hash.hex(),
+                "text": text
+            }) + "\n")
+
+    with open(done_path, "w") as f:
+        f.write(warc_file)
+
+    return warc_file
+
+# Without PDFs on disk there is nothing for get_current_folder_and_count() to
+# look at, so --skip-pdfs runs keep the rollover position in a state file.
+# Those runs only write the PDFs of discarded documents, so only
+# discarded.jsonl records have a source_path that exists; documents.jsonl
+# records name where the PDF would have gone.
+# Don't mix --skip-pdfs runs with PDF-writing runs over the same DATASET_ROOT.
+def load_folder_state(write_pdfs):
+    if not write_pdfs and os.path.exists(FOLDER_STATE_PATH):
+        with open(FOLDER_STATE_PATH, "r") as f:
+            state = json.load(f)
+        return state["folder"], state["count"], set(state["filenames"])
+
+    folder, count = get_current_folder_and_count()
+    folder_path = os.path.join(DATASET_ROOT, folder)
+    filenames = set(os.listdir(folder_path)) if os.path.isdir(folder_path) else set()
+    return folder, count, filenames
+
+def save_folder_state(folder, count, filenames):
+    with open(FOLDER_STATE_PATH, "w") as f:
+        json.dump({"folder": folder, "count": count, "filenames": sorted(filenames)}, f)
+
+def mark_ingested(folders):
+    # Folders whose records were emitted here must not be re-read by ingest_pdf
+    ingest_pdf.ensure_directories()
+    checkpoints = ingest_pdf.load_checkpoints()
+    done = checkpoints.setdefault(DATASET_NAME, [])
+    for folder in folders:
+        if folder not in done:
+            done.append(folder)
+    ingest_pdf.save_checkpoints(checkpoints)
+
+def commit_staged_warc(warc_file, index, fused=False, write_pdfs=True):
+    staging_dir = get_staging_dir(warc_file)
+
+    folder, count, filenames = load_folder_state(write_pdfs)
+    touched_folders = []
+    written = 0
+    totals = {"valid": 0, "discard": 0}
+
+    with open(os.path.join(staging_dir, "records.jsonl"), "r", encoding="utf-8") as records_file, \
+         open(ingest_pdf.DOCS_PATH if fused else os.devnull, "a", encoding="utf-8") as docs_file, \
+         open(ingest_pdf.DISCARDED_PATH if fused else os.devnull, "a", encoding="utf-8") as discard_file, \
+         dedupe_index.open_for_append() as index_file:
+
+        for line in records_file:
+            staged = json.loads(line)
+            filename = f"{staged['doc_id']}.pdf"
+            content_hash = bytes.fromhex(staged["sha256"])
+
+            # Deduplicate against every folder and every earlier run
+            if dedupe_index.is_duplicate(index, staged["doc_id"], content_hash):
+                continue
+
+            folder_path = os.path.join(DATASET_ROOT, folder)
+            output_path = os.path.join(folder_path, filename)
+
+            staged_path = os.path.join(staging_dir, staged["staged_name"]) if staged["staged_name"] else None
+
+            staged_exists = staged_path is not None and os.path.exists(staged_path)
+            # Whether this document takes a slot in the folder count
+            counted = True
+
+            if write_pdfs:
+                if os.path.exists(output_path):
+                    if staged_exists:
+                        continue
+                    # Moved by a commit that crashed before recording it;
+                    # the move is already in the folder count
+                    counted = False
+                elif staged_exists:
+                    os.makedirs(folder_path, exist_ok=True)
+                    shutil.move(staged_path, output_path)
+                elif staged_path is not None:
+                    continue
+                else:
+                    # Staged by a --skip-pdfs run, which kept no PDF for a
+                    # valid document; it is still recorded below
+                    counted = False
+            elif filename in filenames:
+                continue
+            elif staged_exists:
+                # A discarded document's PDF (see stage_warc)
+                os.makedirs(folder_path, exist_ok=True)
+                shutil.move(staged_path, output_path)
+
+            filenames.add(filename)
+            dedupe_index.add(index, index_file, staged["doc_id"], content_hash)
+            written += 1
+
+            if fused:
+                result_type, record = ingest_pdf.build_record(
+                    DATASET_NAME, DATASET_ID, folder, filename, staged["text"]
+                )
+                if result_type == "valid":
+                    docs_file.write(json.dumps(record) + "\n")
+                else:
+                    discard_file.write(json.dumps(record) + "\n")
+                totals[result_type] += 1
+
+                if folder not in touched_folders:
+                    touched_folders.append(folder)
+
+            if not counted:
+                continue
+            count += 1
+
+            # Folder rollover
+            if count >= PDFS_PER_FOLDER:
+                folder = f"{int(folder) + 1:04d}"
+                count = 0
+                filenames = set()
+
+    if not write_pdfs:
+        save_folder_state(folder, count, filenames)
+
+    if fused:
+        mark_ingested(touched_folders)
+
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    print(f"[COMMIT] {warc_file}: {written} PDFs committed")
+    if fused:
+        print(f"         {totals['valid']} documents, {totals['discard']} discarded")
+
+def run_staged(pending_files, processed_files, index, workers, fused=False, write_pdfs=True):
+    print(f"Staging {len(pending_files)} WARCs with {workers} readers x {PDF_WORKERS_PER_WARC} parsers")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            file: executor.submit(stage_warc, os.path.join(WARC_ROOT, file), fused, write_pdfs)
+            for file in pending_files
+        }
+
+        # Commit strictly in sorted order, whatever order staging finishes in
+        for file in tqdm(pending_files, desc="WARCs"):
+            futures[file].result()
+            commit_staged_warc(file, index, fused, write_pdfs)
+
+            processed_files.append(file)
+            save_checkpoint(processed_files)
+
 def main():
+    parser = argparse.ArgumentParser(description="Extract Dataset 9 PDFs from WARC archives")
+    parser.add_argument("--parallel", action="store_true", help="stage several WARCs at once with a process pool")
+    parser.add_argument("--fused", action="store_true", help="also emit documents.jsonl / discarded.jsonl records from the WARC text")
+    parser.add_argument("--skip-pdfs", action="store_true", help="with --fused, only write raw PDFs of discarded documents to DATASET_ROOT")
+    args = parser.parse_args()
+
+    if args.skip_pdfs and not args.fused:
+        parser.error("--skip-pdfs requires --fused")
+
     processed_files = load_checkpoint()
 
     print("WARC ROOT:", WARC_ROOT)
     print("Files detected:", os.listdir(WARC_ROOT))
 
+    pending_files = []
     for file in sorted(os.listdir(WARC_ROOT)):
         if not (file.endswith(".warc") or file.endswith(".warc.gz")):
             continue
@@ -120,8 +410,20 @@ def main():
             print(f"[SKIP] {file} already processed.")
             continue
 
+        pending_files.append(file)
+
+    # Loaded (or bootstrapped from disk) once, before any worker needs it
+    index = dedupe_index.load_index()
+
+    if args.parallel or args.fused:
+        workers = WARC_WORKERS if args.parallel else 1
+        run_staged(pending_files, processed_files, index, workers, args.fused, not args.skip_pdfs)
+        print("\nDataset 9 extraction complete.")
+        return
+
+    for file in pending_files:
         warc_path = os.path.join(WARC_ROOT, file)
-        process_warc(warc_path)
+        process_warc(warc_path, index)
 
         processed_files.append(file)
         save_checkpoint(processed_files)
@@ -0,0 +1,311 @@
+import os
+import re
+import json
+import shutil
+import argparse
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+import numpy as np
+import faiss
+from tqdm import tqdm
+
+import chunk_store
+import vector_index
+
+# Partitioned vector index: one faiss.index + chunk_metadata.jsonl per
+# dataset (or per fixed-size run of vectors) instead of a single monolithic
+# processed/faiss.index. Partitions are built from the same embedding shards
+# and each is written on its own, so re-ingesting one dataset rebuilds that
+# dataset's partition and leaves the others untouched:
+#
+#   python build_vector_index.py --build-only --partition dataset
+#   python build_vector_index.py --build-only --partition dataset --only 9
+#   python index_partitions.py list
+#
+# PartitionedIndex opens every partition (mapped, see vector_index.open_index)
+# and searches them in parallel threads, merging each query's top k; a
+# search can be limited to some datasets and never touches the others.
+#
+# --partition size cuts on shard row positions (part-NNNN holds rows
+# NNNN x size up to the next part), not on the count of live rows, so a
+# delete or replace never moves a chunk into another partition and a single
+# part can be rebuilt with --only part-NNNN. Size partitions mix datasets;
+# a dataset filter searches all of them restricted to those chunk ids.
+#
+# Layout:
+#   processed/index_partitions/partitions.json       {"by", "size", "index", "partitions": {name: {dataset, index, vectors}}}
+#   processed/index_partitions/<name>/faiss.index
+#   processed/index_partitions/<name>/chunk_metadata.jsonl
+
+# -------- PATHS --------
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+
+PARTITIONS_DIR = os.path.join(PROJECT_ROOT, "processed", "index_partitions")
+MANIFEST_NAME = "partitions.json"
+
+# -------- CONFIG --------
+PARTITION_BY = ["dataset", "size"]
+PARTITION_VECTORS = 1000000  # vectors per partition with --partition size
+SEARCH_THREADS = max(1, cpu_count())
+
+
+# -------- PLANNING --------
+def partition_name(dataset):
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", dataset).strip("_") or "unnamed"
+
+
+def size_partition_name(position, size=PARTITION_VECTORS):
+    # position: the row's global shard position
+    return f"part-{position // size:04d}"
+
+
+def plan_partitions(meta_paths, rows, ids, by, size=PARTITION_VECTORS):
+    # rows / ids: the live shard rows and their chunk ids
+    # (chunk_store.live_rows) -> {name: {"dataset", "rows", "ids"}}
+    partitions = {}
+    live = np.zeros(rows[-1] + 1 if len(rows) else 0, dtype=np.int64) - 1
+    live[rows] = np.arange(len(rows))
+    position = 0
+
+    for path in meta_paths:
+        with open(path, "rb") as f:
+            for line in f:
+                row = position
+                n = live[row] if row < len(live) else -1
+                position += 1
+                if n < 0:
+                    continue
+
+                if by == "dataset":
+                    dataset = json.loads(line)["dataset"]
+                    name = partition_name(dataset)
+                else:
+                    dataset = None
+                    name = size_partition_name(row, size)
+
+                entry = partitions.setdefault(name, {"dataset": dataset, "members": []})
+                if entry["dataset"] != dataset:
+                    raise SystemExit(f"Datasets {entry['dataset']!r} and {dataset!r} both map to partition {name!r}")
+                entry["members"].append(n)
+
+    for entry in partitions.values():
+        members = np.array(entry.pop("members"), dtype=np.int64)
+        entry["rows"] = rows[members]
+        entry["ids"] = ids[members]
+    return partitions
+
+
+# -------- BUILD --------
+def load_manifest(root=PARTITIONS_DIR):
+    path = os.path.join(root, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, root=PARTITIONS_DIR):
+    path = os.path.join(root, MANIFEST_NAME)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def write_metadata(meta_paths, partitions, root):
+    # One pass over the shard metadata, each line to its partition's
+    # chunk_metadata.jsonl.tmp; build_partitions moves them into place
+    names = list(partitions)
+    total = max((int(entry["rows"][-1]) + 1 for entry in partitions.values()), default=0)
+    owner = np.full(total, -1, dtype=np.int32)
+    for n, name in enumerate(names):
+        owner[partitions[name]["rows"]] = n
+
+    with ExitStack() as stack:
+        outputs = [
+            stack.enter_context(open(os.path.join(root, name, "chunk_metadata.jsonl.tmp"), "wb"))
+            for name in names
+        ]
+        position = 0
+        for path in meta_paths:
+            with open(path, "rb") as f:
+                for line in f:
+                    if position >= total:
+                        break
+                    if owner[position] >= 0:
+                        outputs[owner[position]].write(line)
+                    position += 1
+
+
+def build_partitions(arrays, meta_paths, rows, ids, by, size=PARTITION_VECTORS, only=None,
+                     kind="flat", params=None, root=PARTITIONS_DIR):
+    # arrays / meta_paths: the committed embedding shards, in order; rows /
+    # ids: which of their rows are live. only: datasets (or partition names)
+    # to rebuild; the rest keep their files. Partitions too small for kind
+    # are built flat (vector_index.fit_kind).
+    os.makedirs(root, exist_ok=True)
+    planned = plan_partitions(meta_paths, rows, ids, by, size)
+
+    manifest = load_manifest(root)
+    if manifest is None or only is None:
+        manifest = {"by": by, "size": size, "index": kind, "partitions": {}}
+    elif manifest["by"] != by:
+        raise SystemExit(f"{root} is partitioned by {manifest['by']}; rebuild everything to change to {by}")
+    elif by == "size" and manifest.get("size") != size:
+        raise SystemExit(f"{root} has {manifest.get('size')} vectors per partition; rebuild everything to change to {size}")
+
+    if only is None:
+        selected = planned
+        emptied = set()
+    else:
+        wanted = {partition_name(value) if by == "dataset" else value for value in only}
+        missing = wanted - set(planned) - set(manifest["partitions"])
+        if missing:
+            raise SystemExit(f"No vectors for partition(s): {', '.join(sorted(missing))}")
+        selected = {name: entry for name, entry in planned.items() if name in wanted}
+        emptied = wanted - set(planned)
+
+    # Everything is written next to its target as .tmp first; only once
+    # every partition has built are they moved into place, so a failed
+    # build leaves the previous set (and partitions.json) as it was
+    created = [name for name in selected if not os.path.isdir(os.path.join(root, name))]
+    built = {}
+    try:
+        dimension = arrays[0].shape[1]
+        for name, entry in tqdm(selected.items(), desc="Building partitions", unit="partition"):
+            os.makedirs(os.path.join(root, name), exist_ok=True)
+            partition_kind = vector_index.fit_kind(kind, len(entry["rows"]))
+            index = vector_index.with_ids(vector_index.new_index(partition_kind, dimension, len(entry["rows"]), params))
+            vector_index.train(index, arrays, entry["rows"])
+            vector_index.add(index, arrays, entry["rows"], entry["ids"])
+
+            faiss.write_index(index, os.path.join(root, name, "faiss.index.tmp"))
+            built[name] = {"dataset": entry["dataset"], "index": partition_kind, "vectors": int(index.ntotal)}
+            del index
+
+        write_metadata(meta_paths, selected, root)
+    except BaseException:
+        for name in selected:
+            for filename in ["faiss.index.tmp", "chunk_metadata.jsonl.tmp"]:
+                if os.path.exists(os.path.join(root, name, filename)):
+                    os.remove(os.path.join(root, name, filename))
+        for name in created:
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+        raise
+
+    for name in selected:
+        for filename in ["faiss.index", "chunk_metadata.jsonl"]:
+            path = os.path.join(root, name, filename)
+            os.replace(path + ".tmp", path)
+    manifest["partitions"].update(built)
+
+    # A dataset whose chunks are all gone loses its partition, and a full
+    # rebuild drops every partition that has no vectors any more
+    for name in emptied:
+        del manifest["partitions"][name]
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+    if only is None:
+        for name in os.listdir(root):
+            if name not in planned and os.path.isdir(os.path.join(root, name)):
+                shutil.rmtree(os.path.join(root, name))
+
+    kinds = {entry.get("index", manifest["index"]) for entry in manifest["partitions"].values()}
+    manifest["index"] = kinds.pop() if len(kinds) == 1 else "mixed" if kinds else kind
+    save_manifest(manifest, root)
+    return manifest
+
+
+# -------- SEARCH --------
+class PartitionedIndex:
+    def __init__(self, root=PARTITIONS_DIR, mmap=True):
+        manifest = load_manifest(root)
+        if manifest is None:
+            raise FileNotFoundError(f"No {MANIFEST_NAME} in {root}; build with build_vector_index.py --partition")
+
+        self.root = root
+        self.by = manifest["by"]
+        self.filters = {}  # dataset filter -> search params per partition (size partitions)
+        self.names = sorted(manifest["partitions"])
+        self.datasets = {name: manifest["partitions"][name]["dataset"] for name in self.names}
+        self.indexes = {
+            name: vector_index.open_index(os.path.join(root, name, "faiss.index"), mmap)
+            for name in self.names
+        }
+        self.ntotal = sum(index.ntotal for index in self.indexes.values())
+
+        # faiss and numpy release the GIL while they search
+        self.executor = ThreadPoolExecutor(max_workers=max(1, min(len(self.names), SEARCH_THREADS)))
+
+    def select(self, datasets=None):
+        # -> (partitions to search, datasets their hits must come from or
+        # None). Datasets may also name partitions directly.
+        if datasets is None:
+            return self.names, None
+        wanted = set(datasets)
+        if self.by == "size" and not wanted <= set(self.names):
+            return self.names, tuple(sorted(wanted))
+        return [name for name in self.names if name in wanted or self.datasets[name] in wanted], None
+
+    def filter_params(self, datasets):
+        # Search params restricting each partition to the datasets' chunk
+        # ids, resolved once per filter
+        if datasets not in self.filters:
+            ids = chunk_store.dataset_ids(datasets)
+            if not len(ids):
+                raise KeyError(f"No chunks for datasets {list(datasets)}")
+            self.filters[datasets] = {name: vector_index.search_params(self.indexes[name], ids) for name in self.names}
+        return self.filters[datasets]
+
+    def set_search_params(self, nprobe=None, ef_search=None):
+        self.filters = {}  # they carry the old nprobe / efSearch
+        for index in self.indexes.values():
+            if not isinstance(index, vector_index.MappedFlatIndex):
+                vector_index.set_search_params(index, nprobe, ef_search)
+
+    def search(self, queries, k, datasets=None):
+        # -> (scores, partition names, chunk ids), each queries x k; -1 pads
+        # queries with fewer than k hits. Resolve ids with chunk_store.lookup.
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        names, filtered = self.select(datasets)
+        if not names:
+            raise KeyError(f"No partitions for datasets {datasets}")
+
+        if filtered is None:
+            results = list(self.executor.map(lambda name: self.indexes[name].search(queries, k), names))
+        else:
+            params = self.filter_params(filtered)
+            results = list(self.executor.map(lambda name: self.indexes[name].search(queries, k, params=params[name]), names))
+
+        scores = np.concatenate([s for s, _ in results], axis=1)
+        ids = np.concatenate([i for _, i in results], axis=1)
+        owners = np.concatenate([np.full(i.shape, n) for n, (_, i) in enumerate(results)], axis=1)
+        scores = np.where(ids < 0, -np.inf, scores)
+
+        order = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+        ids = np.take_along_axis(ids, order, axis=1)
+        partitions = np.array(names, dtype=object)[np.take_along_axis(owners, order, axis=1)]
+        return np.take_along_axis(scores, order, axis=1), partitions, ids
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect the partitioned vector index")
+    parser.add_argument("--root", default=PARTITIONS_DIR)
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("list", help="partitions and their vector counts")
+    args = parser.parse_args()
+
+    manifest = load_manifest(args.root)
+    if manifest is None:
+        raise SystemExit(f"No {MANIFEST_NAME} in {args.root}")
+    print(f"Partitioned by {manifest['by']}, {manifest['index']} indexes")
+    for name, entry in sorted(manifest["partitions"].items()):
+        label = f" ({entry['dataset']})" if entry["dataset"] is not None else ""
+        print(f"{name:>32}{label}: {entry['vectors']} vectors, {entry.get('index', manifest['index'])}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,11 @@
 import os
 import json
-import fitz
+import argparse
 from tqdm import tqdm
 from datetime import datetime
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import cpu_count
+
+import pdf_extract
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
@@ -14,8 +16,11 @@ PROCESSED_ROOT = os.path.join(PROJECT_ROOT, "processed")
 DOCS_PATH = os.path.join(PROCESSED_ROOT, "documents.jsonl")
 DISCARDED_PATH = os.path.join(PROCESSED_ROOT, "discarded.jsonl")
 CHECKPOINT_PATH = os.path.join(PROCESSED_ROOT, "checkpoints.json")
+FILE_PROGRESS_PATH = os.path.join(PROCESSED_ROOT, "ingest_file_progress.txt")
 MIN_TEXT_LENGTH = 300
-MAX_WORKERS = 16
+MAX_WORKERS = max(1, int(cpu_count() * 0.7))
+IN_FLIGHT_PER_WORKER = 4
+FLUSH_EVERY = 500  # results between flushes of output + file-level progress
 
 
 def ensure_directories():
@@ -41,56 +46,75 @@ def normalize_text(text):
     return text.strip()
 
 
+def build_record(dataset_name, dataset_id, folder_name, pdf_file, text):
+    text = normalize_text(text)
+
+    doc_id = f"dataset{dataset_id}_{folder_name}_{pdf_file.replace('.pdf','')}"
+
+    record = {
+        "doc_id": doc_id,
+        "dataset": dataset_id,
+        "folder": folder_name,
+        "filename": pdf_file,
+        "source_path": os.path.join(dataset_name, folder_name, pdf_file),
+        "char_count": len(text),
+        "word_count": len(text.split()),
+        "has_text": len(text) >= MIN_TEXT_LENGTH,
+        "ingested_at": datetime.utcnow().isoformat()
+    }
+
+    if len(text) < MIN_TEXT_LENGTH:
+        record["reason"] = "no_extractable_text"
+        return ("discard", record)
+
+    record["text"] = text
+    return ("valid", record)
+
+
 def process_pdf(args):
     dataset_name, dataset_id, folder_name, pdf_file, folder_path = args
     pdf_path = os.path.join(folder_path, pdf_file)
 
     try:
-        doc = fitz.open(pdf_path)
-        text = ""
-        for page in doc:
-            text += page.get_text("text") + "\n"
-        doc.close()
-
-        text = normalize_text(text)
-
-        doc_id = f"dataset{dataset_id}_{folder_name}_{pdf_file.replace('.pdf','')}"
-
-        record = {
-            "doc_id": doc_id,
-            "dataset": dataset_id,
-            "folder": folder_name,
-            "filename": pdf_file,
-            "source_path": os.path.join(dataset_name, folder_name, pdf_file),
-            "char_count": len(text),
-            "word_count": len(text.split()),
-            "has_text": len(text) >= MIN_TEXT_LENGTH,
-            "ingested_at": datetime.utcnow().isoformat()
-        }
-
-        if len(text) < MIN_TEXT_LENGTH:
-            record["reason"] = "no_extractable_text"
-            return ("discard", record)
-
-        record["text"] = text
-        return ("valid", record)
-
-    except Exception as e:
-        return ("error", {
-            "dataset": dataset_id,
-            "folder": folder_name,
-            "filename": pdf_file,
-            "error": str(e)
-        })
-
-
-def process():
-    ensure_directories()
-    checkpoints = load_checkpoints()
+        text = pdf_extract.extract_text(pdf_path)
 
-    total_processed = 0
-    total_discarded = 0
+        return build_record(dataset_name, dataset_id, folder_name, pdf_file, text)
 
+    except Exception as e:
+        return ("error", pdf_extract.error_record(
+            type(e).__name__, str(e),
+            dataset=dataset_id, folder=folder_name, filename=pdf_file
+        ))
+
+
+def load_done_files():
+    # Files finished inside folders that are not yet checkpointed as a whole
+    done = set()
+    if os.path.exists(FILE_PROGRESS_PATH):
+        with open(FILE_PROGRESS_PATH, "r", encoding="utf-8") as f:
+            for line in f:
+                done.add(line.rstrip("\n"))
+    return done
+
+
+def compact_file_progress(checkpoints):
+    # Entries for checkpointed folders are redundant; keep the file small
+    done = load_done_files()
+    keep = []
+    for path in sorted(done):
+        dataset_name, folder_name, _ = path.split(os.sep, 2)
+        if folder_name not in checkpoints.get(dataset_name, []):
+            keep.append(path)
+
+    tmp_path = FILE_PROGRESS_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write("".join(path + "\n" for path in keep))
+    os.replace(tmp_path, FILE_PROGRESS_PATH)
+
+
+def scan_tasks(checkpoints, done_files, folder_remaining, pending_folders):
+    # Streams tasks folder by folder so the pool starts work immediately and
+    # the scanner never holds more than one folder listing at a time
     for dataset_name in sorted(os.listdir(RAW_ROOT)):
         dataset_path = os.path.join(RAW_ROOT, dataset_name)
 
@@ -99,7 +123,7 @@ def process():
 
         dataset_id = dataset_name.replace("Dataset ", "").strip()
 
-        print(f"\n=== Processing {dataset_name} ===")
+        print(f"\n=== Scanning {dataset_name} ===")
 
         if dataset_name not in checkpoints:
             checkpoints[dataset_name] = []
@@ -114,47 +138,124 @@ def process():
                 print(f"[SKIP] {dataset_name}/{folder_name} already processed.")
                 continue
 
-            print(f"\n--- Folder {folder_name} ---")
-
             pdf_files = [
-                f for f in os.listdir(folder_path)
+                f for f in sorted(os.listdir(folder_path))
                 if f.lower().endswith(".pdf")
+                and os.path.join(dataset_name, folder_name, f) not in done_files
             ]
 
-            tasks = [
-                (dataset_name, dataset_id, folder_name, pdf_file, folder_path)
-                for pdf_file in pdf_files
-            ]
+            # Registered before any task is yielded; an empty or fully
+            # resumed folder goes straight to the checkpoint
+            folder_remaining[(dataset_name, folder_name)] = len(pdf_files)
+            if not pdf_files:
+                pending_folders.append((dataset_name, folder_name))
 
-            with open(DOCS_PATH, "a", encoding="utf-8") as docs_file, \
-                 open(DISCARDED_PATH, "a", encoding="utf-8") as discard_file, \
-                 ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            for pdf_file in pdf_files:
+                yield (dataset_name, dataset_id, folder_name, pdf_file, folder_path)
 
-                futures = [executor.submit(process_pdf, task) for task in tasks]
 
-                for future in tqdm(as_completed(futures), total=len(futures)):
-                    result_type, record = future.result()
+def process(workers=MAX_WORKERS, max_in_flight=None):
+    ensure_directories()
+    checkpoints = load_checkpoints()
+    done_files = load_done_files()
 
-                    if result_type == "valid":
-                        docs_file.write(json.dumps(record) + "\n")
-                        total_processed += 1
-                    elif result_type == "discard":
-                        discard_file.write(json.dumps(record) + "\n")
-                        total_discarded += 1
-                    else:
-                        print(f"[ERROR] {record}")
+    if max_in_flight is None:
+        max_in_flight = workers * IN_FLIGHT_PER_WORKER
 
-            checkpoints[dataset_name].append(folder_name)
+    total_processed = 0
+    total_discarded = 0
+    total_errors = 0
+
+    folder_remaining = {}
+    pending_progress = []
+    pending_folders = []
+
+    print(f"Using {workers} workers, at most {max_in_flight} PDFs in flight")
+
+    def flush():
+        # Records hit disk before the progress lines that vouch for them, and
+        # those before the folder checkpoint, so a crash can only ever redo
+        # work, never lose it
+        docs_file.flush()
+        discard_file.flush()
+
+        if pending_progress:
+            progress_file.write("".join(line + "\n" for line in pending_progress))
+            progress_file.flush()
+            pending_progress.clear()
+
+        if pending_folders:
+            for dataset_name, folder_name in pending_folders:
+                checkpoints[dataset_name].append(folder_name)
+                print(f"[DONE] {dataset_name}/{folder_name} processed.")
             save_checkpoints(checkpoints)
-
-            print(f"[DONE] Folder {folder_name} processed.")
+            pending_folders.clear()
+
+    def finish_task(task):
+        dataset_name, _, folder_name, pdf_file, _ = task
+        pending_progress.append(os.path.join(dataset_name, folder_name, pdf_file))
+
+        key = (dataset_name, folder_name)
+        folder_remaining[key] -= 1
+        if folder_remaining[key] == 0:
+            pending_folders.append(key)
+
+    tasks = scan_tasks(checkpoints, done_files, folder_remaining, pending_folders)
+
+    with open(DOCS_PATH, "a", encoding="utf-8") as docs_file, \
+         open(DISCARDED_PATH, "a", encoding="utf-8") as discard_file, \
+         open(FILE_PROGRESS_PATH, "a", encoding="utf-8") as progress_file, \
+         pdf_extract.open_error_log() as error_file, \
+         pdf_extract.ExtractionPool(process_pdf, workers) as pool, \
+         tqdm(unit="pdf") as progress:
+
+        # The pool pulls at most max_in_flight tasks ahead of this loop, so
+        # the scanner is throttled to whatever the writer keeps up with
+        for task, ok, result in pool.imap_unordered(tasks, max_in_flight):
+            if ok:
+                result_type, record = result
+            else:
+                # Timed out, or the worker died under it
+                dataset_name, dataset_id, folder_name, pdf_file, _ = task
+                result_type, record = "error", dict(
+                    result, dataset=dataset_id, folder=folder_name, filename=pdf_file
+                )
+
+            if result_type == "valid":
+                docs_file.write(json.dumps(record) + "\n")
+                total_processed += 1
+            elif result_type == "discard":
+                discard_file.write(json.dumps(record) + "\n")
+                total_discarded += 1
+            else:
+                print(f"[ERROR] {record['filename']}: {record['error_type']}: {record['error']}")
+                pdf_extract.log_error(error_file, record)
+                total_errors += 1
+
+            finish_task(task)
+            progress.update(1)
+
+            if len(pending_progress) >= FLUSH_EVERY or pending_folders:
+                flush()
+
+        flush()
+
+        print(f"Workers recycled: {pool.recycled}, timed out: {pool.timeouts}")
+
+    compact_file_progress(checkpoints)
 
     print("\n====================================")
     print(f"Total processed documents: {total_processed}")
     print(f"Total discarded documents: {total_discarded}")
+    print(f"Total errors: {total_errors} (see {pdf_extract.ERRORS_PATH})")
     print("Ingestion complete.")
     print("====================================")
 
 
 if __name__ == "__main__":
-    process()
+    parser = argparse.ArgumentParser(description="Extract text from raw_pdfs into documents.jsonl")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="number of PDF worker processes")
+    parser.add_argument("--max-in-flight", type=int, default=None, help="PDFs queued ahead of the writer (default: workers x %d)" % IN_FLIGHT_PER_WORKER)
+    args = parser.parse_args()
+
+    process(args.workers, args.max_in_flight)
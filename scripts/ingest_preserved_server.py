@@ -1,9 +1,13 @@
 import os
 import json
-import fitz
-from multiprocessing import Pool, cpu_count
+import argparse
+from functools import partial
+from multiprocessing import cpu_count
 from tqdm import tqdm
 
+import pdf_extract
+import shard_store
+
 # -------- PATHS --------
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
@@ -13,7 +17,7 @@ OUTPUT_ROOT = os.path.join(PROJECT_ROOT, "processed_jsonl")
 
 os.makedirs(OUTPUT_ROOT, exist_ok=True)
 
-MAX_WORKERS = int(cpu_count() * 0.7)
+MAX_WORKERS = max(1, int(cpu_count() * 0.7))
 
 # -------- NORMALIZATION --------
 def mild_normalize(text):
@@ -21,29 +25,24 @@ def mild_normalize(text):
     return text.strip()
 
 # -------- SINGLE PDF PROCESS --------
-def process_pdf(args):
+def process_pdf(args, compress=False):
     dataset_name, folder_name, pdf_filename = args
 
     pdf_path = os.path.join(RAW_ROOT, dataset_name, folder_name, pdf_filename)
 
     try:
-        doc = fitz.open(pdf_path)
-
         pages = []
-        for i, page in enumerate(doc):
-            page_text = page.get_text("text")
+        for i, page_text in enumerate(pdf_extract.extract_pages(pdf_path)):
             page_text = mild_normalize(page_text)
             pages.append(f"---PAGE {i+1:03d}---\n{page_text}")
 
-        doc.close()
-
         full_text = "\n\n".join(pages)
 
         if len(full_text.strip()) < 5:
-            return None
+            return ("empty", None)
 
         record = {
-            "doc_id": pdf_filename.replace(".pdf", ""),
+            "doc_id": os.path.splitext(pdf_filename)[0],
             "dataset": dataset_name.replace("Dataset ", "").strip(),
             "folder": folder_name,
             "filename": pdf_filename,
@@ -53,22 +52,32 @@ def process_pdf(args):
             "text": full_text
         }
 
-        output_dir = os.path.join(OUTPUT_ROOT, dataset_name, folder_name)
-        os.makedirs(output_dir, exist_ok=True)
-
-        output_path = os.path.join(output_dir, pdf_filename.replace(".pdf", ".jsonl"))
+        # Appended to this worker's shard instead of a file per PDF; the
+        # parent turns the location into a manifest entry
+        shard, offset, length = shard_store.append_record(OUTPUT_ROOT, record, compress)
 
-        with open(output_path, "w", encoding="utf-8") as f:
-            f.write(json.dumps(record))
+        return ("ok", shard_store.manifest_entry(record, shard, offset, length))
 
-        return True
-
-    except Exception:
-        return None
+    except Exception as e:
+        return ("error", pdf_extract.error_record(type(e).__name__, str(e), source_path=pdf_path))
 
 # -------- MAIN --------
 def main():
+    parser = argparse.ArgumentParser(description="Re-ingest raw_pdfs with page markers into sharded JSONL")
+    parser.add_argument("--zstd", action="store_true", help="zstd-compress shards (one frame per record)")
+    parser.add_argument("--reingest", action="store_true", help="extract PDFs already in the manifest again; the new records replace the old")
+    args = parser.parse_args()
+
+    if args.zstd and not shard_store.compression_available():
+        parser.error("--zstd needs the zstandard package (pip install zstandard)")
+
+    # Reruns pick up where the last one stopped instead of writing every
+    # document again
+    shard_store.repair_manifest(OUTPUT_ROOT)
+    done = set() if args.reingest else set(shard_store.load_manifest(OUTPUT_ROOT))
+
     tasks = []
+    skipped = 0
 
     for dataset_name in sorted(os.listdir(RAW_ROOT)):
         dataset_path = os.path.join(RAW_ROOT, dataset_name)
@@ -81,15 +90,44 @@ def main():
                 continue
 
             for pdf_filename in os.listdir(folder_path):
-                if pdf_filename.lower().endswith(".pdf"):
-                    tasks.append((dataset_name, folder_name, pdf_filename))
-
-    print(f"Total PDFs detected: {len(tasks)}")
+                if not pdf_filename.lower().endswith(".pdf"):
+                    continue
+                if os.path.join(dataset_name, folder_name, pdf_filename) in done:
+                    skipped += 1
+                    continue
+                tasks.append((dataset_name, folder_name, pdf_filename))
+
+    print(f"Total PDFs detected: {len(tasks) + skipped} ({skipped} already in the manifest)")
     print(f"Using {MAX_WORKERS} workers")
 
-    with Pool(MAX_WORKERS) as pool:
-        list(tqdm(pool.imap_unordered(process_pdf, tasks), total=len(tasks)))
+    counts = {"ok": 0, "empty": 0, "error": 0}
+    worker = partial(process_pdf, compress=args.zstd)
+
+    with pdf_extract.ExtractionPool(worker, MAX_WORKERS) as pool, \
+         pdf_extract.open_error_log() as error_file, \
+         open(shard_store.manifest_path(OUTPUT_ROOT), "a", encoding="utf-8") as manifest_file:
+
+        for task, ok, result in tqdm(pool.imap_unordered(tasks), total=len(tasks)):
+            if ok:
+                status, detail = result
+            else:
+                # Timed out, or the worker died under it
+                dataset_name, folder_name, pdf_filename = task
+                status, detail = "error", dict(
+                    result, source_path=os.path.join(RAW_ROOT, dataset_name, folder_name, pdf_filename)
+                )
+
+            if status == "ok":
+                manifest_file.write(json.dumps(detail) + "\n")
+            elif status == "error":
+                pdf_extract.log_error(error_file, detail)
+
+            counts[status] += 1
+
+        print(f"Workers recycled: {pool.recycled}, timed out: {pool.timeouts}")
 
+    print(f"Written: {counts['ok']}, empty: {counts['empty']}, errors: {counts['error']}")
+    print(f"Shards and {shard_store.MANIFEST_NAME} written to {OUTPUT_ROOT}")
     print("Ingestion complete.")
 
 if __name__ == "__main__":
@@ -0,0 +1,287 @@
+import os
+import json
+import time
+import multiprocessing
+from collections import deque
+from datetime import datetime
+from multiprocessing.connection import wait
+import fitz
+
+import text_cache
+
+# Shared PDF text extraction. Every script that reads PDFs goes through
+# extract_pages() / extract_text() here, and anything that reads PDFs in bulk
+# runs them on an ExtractionPool, which adds what Pool/ProcessPoolExecutor
+# can't: a wall-clock timeout per PDF (the worker is killed, not waited on),
+# recycling of workers after N tasks or above an RSS limit to shed PyMuPDF
+# leaks, and structured error records instead of silently dropped files.
+
+# -------- PATHS --------
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+
+ERRORS_PATH = os.path.join(PROJECT_ROOT, "processed", "extraction_errors.jsonl")
+
+# -------- CONFIG --------
+PDF_TIMEOUT = 120           # seconds of wall clock per PDF
+MAX_TASKS_PER_WORKER = 500  # recycle a worker after this many PDFs
+MAX_WORKER_RSS_MB = 2048    # ...or as soon as it grows past this
+POLL_INTERVAL = 0.5         # how often running tasks are checked for timeouts
+
+
+# -------- EXTRACTION --------
+def read_pages(pdf_bytes):
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        return [page.get_text("text") for page in doc]
+    finally:
+        doc.close()
+
+
+def extract_pages(pdf_path=None, pdf_bytes=None):
+    if pdf_bytes is None:
+        with open(pdf_path, "rb") as f:
+            pdf_bytes = f.read()
+
+    if not text_cache.CACHE_ENABLED:
+        return read_pages(pdf_bytes)
+
+    content_hash = text_cache.hash_bytes(pdf_bytes)
+
+    pages = text_cache.lookup(content_hash)
+    if pages is not None:
+        return pages
+
+    pages = read_pages(pdf_bytes)
+    text_cache.store(content_hash, pages)
+    return pages
+
+
+def extract_text(pdf_path=None, pdf_bytes=None):
+    # Same layout the old `text += page.get_text("text") + "\n"` loops built,
+    # joined once instead of re-copied per page
+    pages = extract_pages(pdf_path, pdf_bytes)
+    return "".join(page + "\n" for page in pages)
+
+
+# -------- ERRORS --------
+def error_record(error_type, error, **context):
+    record = dict(context)
+    record["error_type"] = error_type
+    record["error"] = error
+    record["logged_at"] = datetime.utcnow().isoformat()
+    return record
+
+
+def open_error_log():
+    os.makedirs(os.path.dirname(ERRORS_PATH), exist_ok=True)
+    return open(ERRORS_PATH, "a", encoding="utf-8")
+
+
+def log_error(error_file, record):
+    error_file.write(json.dumps(record) + "\n")
+
+
+# -------- WORKER --------
+def current_rss_mb():
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / (1024 * 1024)
+    except ImportError:
+        pass
+
+    try:
+        with open("/proc/self/statm", "r") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        return None  # no way to measure here; rely on MAX_TASKS_PER_WORKER
+
+
+def worker_main(func, conn, max_tasks, max_rss_mb):
+    completed = 0
+
+    while True:
+        try:
+            item = conn.recv()
+        except EOFError:
+            return
+
+        if item is None:
+            return
+
+        try:
+            result = (True, func(item))
+        except Exception as e:
+            result = (False, error_record(type(e).__name__, str(e)))
+
+        completed += 1
+        rss = current_rss_mb()
+        recycle = completed >= max_tasks or (rss is not None and rss > max_rss_mb)
+
+        conn.send((result, recycle))
+
+        if recycle:
+            return
+
+
+# -------- POOL --------
+class ExtractionPool:
+    # Each worker has its own pipe and runs one task at a time, so the parent
+    # always knows which PDF a worker is stuck on and how long it has been.
+
+    def __init__(self, func, workers, timeout=PDF_TIMEOUT,
+                 max_tasks=MAX_TASKS_PER_WORKER, max_rss_mb=MAX_WORKER_RSS_MB):
+        self.func = func
+        self.num_workers = workers
+        self.timeout = timeout
+        self.max_tasks = max_tasks
+        self.max_rss_mb = max_rss_mb
+
+        self.ctx = multiprocessing.get_context()
+        self.workers = {}  # conn -> process
+        self.running = {}  # conn -> (seq, task, started_at)
+        self.idle = deque()
+
+        self.recycled = 0
+        self.timeouts = 0
+
+    def __enter__(self):
+        for _ in range(self.num_workers):
+            self._spawn()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _spawn(self):
+        parent_conn, child_conn = self.ctx.Pipe()
+        process = self.ctx.Process(
+            target=worker_main,
+            args=(self.func, child_conn, self.max_tasks, self.max_rss_mb),
+            daemon=True
+        )
+        process.start()
+        child_conn.close()
+
+        self.workers[parent_conn] = process
+        self.idle.append(parent_conn)
+
+    def _retire(self, conn, kill=False):
+        process = self.workers.pop(conn)
+        if not kill:
+            process.join(5)
+        if process.is_alive():
+            process.kill()
+        process.join()
+        conn.close()
+
+    def close(self):
+        for conn in list(self.workers):
+            try:
+                conn.send(None)
+            except (OSError, BrokenPipeError):
+                pass
+        for conn in list(self.workers):
+            self._retire(conn)
+        self.idle.clear()
+        self.running.clear()
+
+    def _dispatch(self, seq, task):
+        conn = self.idle.popleft()
+        try:
+            conn.send(task)
+        except (OSError, BrokenPipeError):
+            # Worker died while idle; replace it and retry on a fresh one
+            self._retire(conn, kill=True)
+            self._spawn()
+            return self._dispatch(seq, task)
+        self.running[conn] = (seq, task, time.monotonic())
+
+    def _collect(self):
+        finished = []
+
+        for conn in wait(list(self.running), timeout=POLL_INTERVAL):
+            seq, task, _ = self.running.pop(conn)
+            try:
+                result, recycle = conn.recv()
+            except (EOFError, OSError):
+                # Segfaults and OOM kills inside MuPDF land here
+                process = self.workers[conn]
+                process.join(5)
+                exitcode = process.exitcode
+                result = (False, error_record("worker_died", f"worker exited with code {exitcode}"))
+                recycle = True
+
+            finished.append((seq, task, result))
+
+            if recycle:
+                self._retire(conn)
+                self._spawn()
+                self.recycled += 1
+            else:
+                self.idle.append(conn)
+
+        now = time.monotonic()
+        for conn, (seq, task, started_at) in list(self.running.items()):
+            if now - started_at < self.timeout:
+                continue
+
+            del self.running[conn]
+            self._retire(conn, kill=True)
+            self._spawn()
+            self.timeouts += 1
+
+            finished.append((seq, task, (False, error_record("timeout", f"exceeded {self.timeout}s"))))
+
+        return finished
+
+    def _run(self, tasks, ordered, max_in_flight):
+        # Yields (task, ok, value): value is func's return when ok, otherwise
+        # an error_record(). At most max_in_flight tasks are pulled from the
+        # iterator ahead of what has been yielded.
+        if max_in_flight is None:
+            max_in_flight = self.num_workers * 4
+
+        tasks = iter(tasks)
+        exhausted = False
+        backlog = deque()
+        buffered = {}
+        next_seq = 0
+        next_yield = 0
+
+        while True:
+            while not exhausted and next_seq - next_yield < max_in_flight:
+                try:
+                    backlog.append((next_seq, next(tasks)))
+                except StopIteration:
+                    exhausted = True
+                    break
+                next_seq += 1
+
+            while backlog and self.idle:
+                self._dispatch(*backlog.popleft())
+
+            if not self.running:
+                if exhausted and not backlog:
+                    return
+                continue
+
+            for seq, task, (ok, value) in self._collect():
+                if not ordered:
+                    next_yield += 1
+                    yield task, ok, value
+                    continue
+
+                buffered[seq] = (task, ok, value)
+
+            while ordered and next_yield in buffered:
+                task, ok, value = buffered.pop(next_yield)
+                next_yield += 1
+                yield task, ok, value
+
+    def imap(self, tasks, max_in_flight=None):
+        return self._run(tasks, True, max_in_flight)
+
+    def imap_unordered(self, tasks, max_in_flight=None):
+        return self._run(tasks, False, max_in_flight)
@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import random
+import argparse
+import threading
+from urllib.request import Request, urlopen
+import numpy as np
+
+import corpus_store
+
+# Load generator for search_service.py serve: N client threads send queries
+# back to back for a fixed time, then client-side latency percentiles and
+# throughput are printed next to the server's own /stats.
+#
+#   python search_loadgen.py --concurrency 16 --duration 30
+#   python search_loadgen.py --queries my_queries.txt --k 20
+#
+# Without --queries, queries are the opening words of sampled chunks.
+
+# -------- PATHS --------
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+
+CHUNKS_PATH = os.path.join(PROJECT_ROOT, "processed", "chunks.jsonl")
+
+# -------- CONFIG --------
+URL = "http://127.0.0.1:8765"
+CONCURRENCY = 8
+DURATION = 30
+QUERY_WORDS = 8
+SAMPLE_CHUNKS = 2000
+
+
+def load_queries(path=None, chunks_store=None):
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            return [line.strip() for line in f if line.strip()]
+
+    queries = []
+    for record in corpus_store.iter_jsonl_or_store(CHUNKS_PATH, chunks_store, ["text"]):
+        words = record["text"].split()
+        if len(words) >= QUERY_WORDS:
+            queries.append(" ".join(words[:QUERY_WORDS]))
+        if len(queries) >= SAMPLE_CHUNKS:
+            break
+    return queries
+
+
+def post_search(url, query, k):
+    body = json.dumps({"query": query, "k": k}).encode("utf-8")
+    request = Request(f"{url}/search", data=body, headers={"Content-Type": "application/json"})
+    with urlopen(request, timeout=60) as response:
+        return json.loads(response.read())
+
+
+def client(url, queries, k, deadline, seed, results):
+    rng = random.Random(seed)
+    latencies = []
+    errors = 0
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            post_search(url, rng.choice(queries), k)
+            latencies.append(time.perf_counter() - started)
+        except Exception:
+            errors += 1
+    results.append((latencies, errors))
+
+
+def run(url, queries, concurrency, duration, k):
+    print(f"{concurrency} clients for {duration}s against {url} ({len(queries)} distinct queries)")
+    post_search(url, queries[0], k)  # fail fast if the server isn't up
+
+    results = []
+    deadline = time.perf_counter() + duration
+    threads = [
+        threading.Thread(target=client, args=(url, queries, k, deadline, seed, results))
+        for seed in range(concurrency)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies = np.array([value for client_latencies, _ in results for value in client_latencies]) * 1000
+    errors = sum(client_errors for _, client_errors in results)
+    if not len(latencies):
+        raise SystemExit(f"No successful requests ({errors} errors)")
+
+    print(f"Requests: {len(latencies)} ok, {errors} errors, {len(latencies) / elapsed:.1f} QPS")
+    print(f"Client latency: p50 {np.percentile(latencies, 50):.1f} ms, "
+          f"p99 {np.percentile(latencies, 99):.1f} ms, max {latencies.max():.1f} ms")
+
+    with urlopen(f"{url}/stats", timeout=10) as response:
+        print(f"Server: {json.dumps(json.loads(response.read()))}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the local search server")
+    parser.add_argument("--url", default=URL)
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--duration", type=float, default=DURATION, help="seconds")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", default=None, help="file with one query per line")
+    parser.add_argument("--chunks-store", default=None, help="sample queries from a corpus store instead of chunks.jsonl")
+    args = parser.parse_args()
+
+    queries = load_queries(args.queries, args.chunks_store)
+    if not queries:
+        raise SystemExit("No queries")
+    run(args.url.rstrip("/"), queries, max(1, args.concurrency), args.duration, args.k)
+
+
+if __name__ == "__main__":
+    main()
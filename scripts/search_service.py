@@ -0,0 +1,342 @@
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+
+import chunk_store
+import embedding_backend
+import index_partitions
+import vector_index
+
+# Query path over faiss.index (or the partitioned index). The model, the
+# mapped index and the metadata store are opened once per process; queries
+# from any number of callers are gathered into micro-batches so one
+# model.encode and one index.search serve them all, and hits come back with
+# their chunk metadata and text from chunk_store.
+#
+#   python search_service.py query "flight logs 2002" --k 5
+#   python search_service.py serve --port 8765
+#       GET  /search?q=...&k=10&dataset=1
+#       POST /search  {"query": "...", "k": 10, "datasets": ["1"]}
+#       GET  /stats   p50 / p99 latency, QPS, mean batch size
+#
+# search_loadgen.py drives the server with concurrent clients.
+
+# -------- PATHS --------
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+
+CURSOR_PATH = os.path.join(vector_index.SHARDS_DIR, "cursor.json")
+
+# -------- CONFIG --------
+# bge v1.5 retrieval: queries (not passages) get this instruction
+QUERY_INSTRUCTION = "Represent this sentence for searching relevant passages: "
+
+DEFAULT_K = 10
+MAX_K = 100
+MAX_BATCH = 32          # queries per encode/search
+MAX_WAIT_MS = 5         # how long the first query of a batch waits for company
+STATS_WINDOW = 10000    # latencies kept for the percentiles
+HOST = "127.0.0.1"
+PORT = 8765
+
+
+# -------- BATCHER --------
+class QueryBatcher:
+    def __init__(self, model, index, max_batch=MAX_BATCH, max_wait_ms=MAX_WAIT_MS):
+        self.model = model
+        self.index = index
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.filters = {}  # dataset filter -> search params, for a single index
+
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=STATS_WINDOW)
+        self.finished = deque(maxlen=STATS_WINDOW)
+        self.total = 0
+        self.batches = 0
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, query, k=DEFAULT_K, datasets=None):
+        future = Future()
+        if isinstance(datasets, str):
+            datasets = [datasets]
+        self.requests.put({
+            "query": query,
+            "k": max(1, min(int(k), MAX_K)),
+            "datasets": tuple(sorted(datasets)) if datasets else None,
+            "submitted": time.perf_counter(),
+            "future": future,
+        })
+        return future
+
+    def search(self, query, k=DEFAULT_K, datasets=None):
+        return self.submit(query, k, datasets).result()
+
+    def run(self):
+        # Single consumer: the model and the index are only ever used here
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                self.process(batch)
+            except Exception as e:
+                for request in batch:
+                    if not request["future"].done():
+                        request["future"].set_exception(e)
+
+    def process(self, batch):
+        texts = [QUERY_INSTRUCTION + request["query"] for request in batch]
+        vectors = self.model.encode(texts, batch_size=len(texts), convert_to_numpy=True,
+                                    normalize_embeddings=True).astype(np.float32)
+
+        # One index.search per distinct dataset filter in the batch
+        groups = {}
+        for n, request in enumerate(batch):
+            groups.setdefault(request["datasets"], []).append(n)
+
+        for datasets, members in groups.items():
+            k = max(batch[n]["k"] for n in members)
+            try:
+                scores, ids = self.search_vectors(vectors[members], k, datasets)
+            except (KeyError, ValueError) as e:
+                for n in members:
+                    batch[n]["future"].set_exception(e)
+                continue
+
+            found = chunk_store.lookup(ids.ravel())
+            for row, n in enumerate(members):
+                batch[n]["future"].set_result(self.hits(scores[row], ids[row], found, batch[n]))
+
+        done = time.perf_counter()
+        with self.lock:
+            for request in batch:
+                self.latencies.append(done - request["submitted"])
+                self.finished.append(done)
+            self.total += len(batch)
+            self.batches += 1
+
+    def search_vectors(self, vectors, k, datasets):
+        if isinstance(self.index, index_partitions.PartitionedIndex):
+            scores, _, ids = self.index.search(vectors, k, datasets)
+            return scores, ids
+        if not datasets:
+            return self.index.search(vectors, k)
+        return self.index.search(vectors, k, params=self.filter_params(datasets))
+
+    def filter_params(self, datasets):
+        # A dataset filter on a single index searches only that dataset's
+        # chunk ids, so it finds its k hits however far down the unfiltered
+        # ranking they are. The index and store don't change under a running
+        # service, so each filter is resolved once.
+        if datasets not in self.filters:
+            ids = chunk_store.dataset_ids(datasets)
+            if not len(ids):
+                raise KeyError(f"No chunks for datasets {list(datasets)}")
+            self.filters[datasets] = vector_index.search_params(self.index, ids)
+        return self.filters[datasets]
+
+    def hits(self, scores, ids, found, request):
+        # Ids the store no longer has were deleted after the index was built
+        results = []
+        for score, key in zip(scores, ids):
+            record = found.get(int(key))
+            if record is None:
+                continue
+            if request["datasets"] and record.get("dataset") not in request["datasets"]:
+                continue
+            results.append(dict(record, id=int(key), score=float(score)))
+            if len(results) >= request["k"]:
+                break
+        return results
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            finished = list(self.finished)
+            total, batches = self.total, self.batches
+
+        stats = {"requests": total, "batches": batches, "mean_batch": total / batches if batches else 0.0}
+        if len(latencies):
+            stats["p50_ms"] = float(np.percentile(latencies, 50))
+            stats["p99_ms"] = float(np.percentile(latencies, 99))
+        if len(finished) > 1:
+            stats["qps"] = (len(finished) - 1) / max(finished[-1] - finished[0], 1e-9)
+        return stats
+
+
+# -------- LOADING --------
+def index_backend():
+    # Queries must be encoded like the chunks were
+    if os.path.exists(CURSOR_PATH):
+        with open(CURSOR_PATH, "r") as f:
+            return json.load(f).get("backend", "fp32")
+    return "fp32"
+
+
+def load_service(partitioned=False, backend=None, mmap=True, nprobe=None, ef_search=None):
+    backend = backend or index_backend()
+    started = time.time()
+    print(f"Loading embedding model ({backend})...")
+    model = embedding_backend.load_model(backend)
+
+    if partitioned:
+        index = index_partitions.PartitionedIndex(mmap=mmap)
+        index.set_search_params(nprobe, ef_search)
+    else:
+        index = vector_index.open_index(vector_index.INDEX_PATH, mmap)
+        if not isinstance(index, vector_index.MappedFlatIndex):
+            vector_index.set_search_params(index, nprobe, ef_search)
+
+    print(f"Ready in {time.time() - started:.1f}s: {index.ntotal} vectors, {chunk_store.count()} chunks in the store")
+    return QueryBatcher(model, index)
+
+
+# -------- HTTP --------
+class SearchHandler(BaseHTTPRequestHandler):
+    batcher = None  # set by serve()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/stats":
+            self.respond(200, self.batcher.stats())
+        elif url.path == "/search":
+            params = parse_qs(url.query)
+            self.search(params.get("q", [""])[0], params.get("k", [DEFAULT_K])[0], params.get("dataset"))
+        else:
+            self.respond(404, {"error": "not found"})
+
+    def do_POST(self):
+        if urlparse(self.path).path != "/search":
+            self.respond(404, {"error": "not found"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError:
+            self.respond(400, {"error": "body is not JSON"})
+            return
+        if not isinstance(body, dict):
+            self.respond(400, {"error": "body must be a JSON object"})
+            return
+        self.search(body.get("query", ""), body.get("k", DEFAULT_K), body.get("datasets"))
+
+    def search(self, query, k, datasets):
+        # query / k / datasets as the client sent them: query strings give
+        # k as a string, JSON bodies can hold anything
+        if not isinstance(query, str) or not query.strip():
+            self.respond(400, {"error": "query must be a non-empty string"})
+            return
+        if isinstance(k, bool) or not isinstance(k, (int, str)):
+            self.respond(400, {"error": "k must be an integer"})
+            return
+        try:
+            k = int(k)
+        except ValueError:
+            self.respond(400, {"error": "k must be an integer"})
+            return
+        if isinstance(datasets, str):
+            datasets = [datasets]
+        if datasets is not None and not (isinstance(datasets, list) and all(isinstance(d, str) for d in datasets)):
+            self.respond(400, {"error": "datasets must be a list of dataset ids"})
+            return
+
+        started = time.perf_counter()
+        try:
+            results = self.batcher.search(query, k, datasets)
+        except (KeyError, ValueError) as e:
+            self.respond(400, {"error": str(e)})
+            return
+        self.respond(200, {
+            "query": query,
+            "took_ms": (time.perf_counter() - started) * 1000,
+            "results": results,
+        })
+
+    def respond(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # one line per request drowns the stats
+
+
+def serve(batcher, host=HOST, port=PORT):
+    SearchHandler.batcher = batcher
+    server = ThreadingHTTPServer((host, port), SearchHandler)
+    server.daemon_threads = True
+    print(f"Listening on http://{host}:{port}/search")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(batcher.stats(), indent=2))
+
+
+def print_results(query, results):
+    print(f"\n{query}")
+    for n, hit in enumerate(results, 1):
+        pages = f" p{hit['page_start']}-{hit['page_end']}" if "page_start" in hit else ""
+        print(f"{n:>3}. {hit['score']:.3f}  {hit['dataset']} / {hit['filename']}{pages}  [{hit['chunk_id']}]")
+        text = " ".join((hit.get("text") or "").split())
+        print(f"     {text[:300]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search the vector index")
+    parser.add_argument("--partitions", action="store_true", help="search processed/index_partitions instead of faiss.index")
+    parser.add_argument("--backend", choices=embedding_backend.BACKENDS, default=None,
+                        help="query encoder backend (default: the one the index was embedded with)")
+    parser.add_argument("--no-mmap", action="store_true", help="load the index into memory instead of mapping it")
+    parser.add_argument("--nprobe", type=int, default=None)
+    parser.add_argument("--ef-search", dest="ef_search", type=int, default=None)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    query = sub.add_parser("query", help="run queries and print the hits")
+    query.add_argument("queries", nargs="+")
+    query.add_argument("--k", type=int, default=DEFAULT_K)
+    query.add_argument("--dataset", action="append", default=None)
+
+    server = sub.add_parser("serve", help="local HTTP search server")
+    server.add_argument("--host", default=HOST)
+    server.add_argument("--port", type=int, default=PORT)
+
+    args = parser.parse_args()
+    batcher = load_service(args.partitions, args.backend, not args.no_mmap, args.nprobe, args.ef_search)
+
+    if args.command == "serve":
+        serve(batcher, args.host, args.port)
+        return
+
+    # Submitted together, so they share a batch
+    futures = [batcher.submit(text, args.k, args.dataset) for text in args.queries]
+    for text, future in zip(args.queries, futures):
+        print_results(text, future.result())
+
+
+if __name__ == "__main__":
+    main()
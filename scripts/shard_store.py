@@ -0,0 +1,197 @@
+import os
+import io
+import json
+import uuid
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Size-rotated shard files for per-document JSON records. Each process
+# appends to its own shard, so writers never contend; a manifest maps every
+# source path (dataset/folder/filename) to (shard, offset, length) for random
+# access, and readers can also stream whole shards sequentially. Filenames
+# repeat across datasets and folders, so the doc_id alone is not a key.
+#
+# Compressed shards are a concatenation of one zstd frame per record, so a
+# record can be decompressed on its own from its offset, and a writer killed
+# mid-record only ever loses that record.
+#
+# The manifest is the source of truth: a record is only in the store once
+# its manifest line is, and the last line for a source path wins. iter_records
+# reads what the manifest points to, so a document ingested twice, or bytes
+# a killed worker left behind in its shard, are never yielded.
+
+# -------- CONFIG --------
+SHARD_MAX_BYTES = 512 * 1024 * 1024  # rotate once a shard passes this size
+COMPRESSION_LEVEL = 3
+MANIFEST_NAME = "manifest.jsonl"
+
+# One open shard per process; pool workers open their own after fork/spawn
+_writer = None
+
+
+def compression_available():
+    return zstandard is not None
+
+
+# -------- WRITER --------
+def shard_dir(root):
+    return os.path.join(root, "shards")
+
+
+def open_shard(root, compress):
+    global _writer
+
+    if _writer is not None:
+        _writer["file"].close()
+
+    os.makedirs(shard_dir(root), exist_ok=True)
+
+    # uuid rather than pid alone so shards from earlier runs are never reused
+    token = _writer["token"] if _writer is not None else uuid.uuid4().hex[:12]
+    number = _writer["number"] + 1 if _writer is not None else 0
+    extension = ".jsonl.zst" if compress else ".jsonl"
+    name = f"shard-{token}-{number:04d}{extension}"
+
+    _writer = {
+        "pid": os.getpid(),
+        "root": root,
+        "compress": compress,
+        "token": token,
+        "number": number,
+        "name": name,
+        "file": open(os.path.join(shard_dir(root), name), "ab"),
+        "size": 0,
+        "compressor": zstandard.ZstdCompressor(level=COMPRESSION_LEVEL) if compress else None
+    }
+    return _writer
+
+
+def get_writer(root, compress):
+    global _writer
+
+    if _writer is not None and _writer["pid"] != os.getpid():
+        _writer = None  # inherited across fork; not ours to write to
+
+    if _writer is None or _writer["root"] != root or _writer["compress"] != compress:
+        return open_shard(root, compress)
+
+    if _writer["size"] >= SHARD_MAX_BYTES:
+        return open_shard(root, compress)
+
+    return _writer
+
+
+def append_record(root, record, compress=False):
+    writer = get_writer(root, compress)
+
+    data = (json.dumps(record) + "\n").encode("utf-8")
+    if compress:
+        data = writer["compressor"].compress(data)
+
+    offset = writer["size"]
+    writer["file"].write(data)
+    # Flushed per record: a record is only reported once its bytes are out
+    # of this process, so a killed worker can't orphan a manifest entry
+    writer["file"].flush()
+    writer["size"] += len(data)
+
+    return writer["name"], offset, len(data)
+
+
+# -------- MANIFEST --------
+def manifest_path(root):
+    return os.path.join(root, MANIFEST_NAME)
+
+
+def manifest_entry(record, shard, offset, length):
+    return {
+        "doc_id": record["doc_id"],
+        "source_path": record["source_path"],
+        "dataset": record["dataset"],
+        "folder": record["folder"],
+        "shard": shard,
+        "offset": offset,
+        "length": length
+    }
+
+
+def load_manifest(root):
+    # A line without its newline is a manifest write cut short; everything
+    # after the last complete line is ignored
+    manifest = {}
+    if not os.path.exists(manifest_path(root)):
+        return manifest
+    with open(manifest_path(root), "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break
+            entry = json.loads(line)
+            manifest[entry["source_path"]] = entry
+    return manifest
+
+
+def repair_manifest(root):
+    # Cuts a partial last line off before more entries are appended
+    path = manifest_path(root)
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            f.truncate(end)
+
+
+# -------- READER --------
+def decode(data, shard):
+    if shard.endswith(".zst"):
+        data = zstandard.ZstdDecompressor().decompress(data)
+    return json.loads(data)
+
+
+def read_record(root, entry):
+    with open(os.path.join(shard_dir(root), entry["shard"]), "rb") as f:
+        f.seek(entry["offset"])
+        return decode(f.read(entry["length"]), entry["shard"])
+
+
+def iter_shard(root, shard):
+    # Every record in one shard file, in write order, up to a record a
+    # killed writer left incomplete
+    path = os.path.join(shard_dir(root), shard)
+
+    with open(path, "rb") as raw:
+        if shard.endswith(".zst"):
+            reader = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True)
+        else:
+            reader = raw
+
+        try:
+            for line in io.TextIOWrapper(reader, encoding="utf-8"):
+                if not line.endswith("\n"):
+                    break
+                if line.strip():
+                    yield json.loads(line)
+        except (zstandard.ZstdError if zstandard is not None else ()) as e:
+            print(f"Stopped at a truncated record in {shard}: {e}")
+
+
+def iter_records(root):
+    # The manifest's records, shard by shard in file order
+    entries = sorted(load_manifest(root).values(), key=lambda entry: (entry["shard"], entry["offset"]))
+    current, f = None, None
+    try:
+        for entry in entries:
+            if entry["shard"] != current:
+                if f is not None:
+                    f.close()
+                current = entry["shard"]
+                f = open(os.path.join(shard_dir(root), current), "rb")
+            f.seek(entry["offset"])
+            yield decode(f.read(entry["length"]), current)
+    finally:
+        if f is not None:
+            f.close()
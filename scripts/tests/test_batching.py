@@ -0,0 +1,61 @@
+import os
+import sys
+import threading
+from contextlib import closing
+from multiprocessing import Pool
+
+# Shared modules live one level up in scripts/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import batching
+
+
+def square(batch):
+    return [x * x for x in batch]
+
+
+def run_with_timeout(target, timeout=30):
+    # Pool teardown that hangs would otherwise hang the whole test run
+    errors = []
+
+    def run():
+        try:
+            target()
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "pool teardown hung"
+    return errors
+
+
+def test_bounded_imap_in_order():
+    batches = list(batching.batched(range(100), 7))
+    with Pool(2) as pool:
+        results = list(batching.bounded_imap(pool, square, batches, 3))
+    assert [batch for batch, _ in results] == batches
+    assert [result for _, result in results] == [square(batch) for batch in batches]
+
+
+def test_bounded_imap_consumer_stops_early():
+    def consume():
+        with Pool(2) as pool, \
+             closing(batching.bounded_imap(pool, square, batching.batched(range(10000), 10), 2)) as results:
+            for batch, _ in results:
+                if batch[0] >= 50:
+                    break
+
+    assert run_with_timeout(consume) == []
+
+
+def test_bounded_imap_consumer_raises():
+    def consume():
+        with Pool(2) as pool, \
+             closing(batching.bounded_imap(pool, square, batching.batched(range(10000), 10), 2)) as results:
+            for batch, _ in results:
+                if batch[0] >= 50:
+                    raise ValueError("consumer failed")
+
+    errors = run_with_timeout(consume)
+    assert [str(e) for e in errors] == ["consumer failed"]
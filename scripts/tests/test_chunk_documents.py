@@ -0,0 +1,24 @@
+import os
+import sys
+import json
+
+# Shared modules live one level up in scripts/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import chunk_documents
+
+SURROGATE_DOC = {"doc_id": "doc-1", "dataset": "9", "folder": "0001", "filename": "doc-1.pdf", "text": "flight ab\ud800cd logs " * 50}
+
+
+def test_content_hash_accepts_lone_surrogate():
+    assert chunk_documents.content_hash("ab\ud800cd") != chunk_documents.content_hash("abcd")
+
+
+def test_chunk_batch_with_lone_surrogate():
+    for hashed in [True, False]:
+        results, doc_ids, _ = chunk_documents.chunk_batch([json.dumps(SURROGATE_DOC)], hashed=hashed)
+        assert doc_ids == ["doc-1"]
+        (doc_id, doc_hash, output, count, _), = results
+        assert (doc_hash is not None) == hashed
+        chunks = [json.loads(line) for line in output.decode("utf-8").splitlines()]
+        assert len(chunks) == count >= 1
+        assert "\ud800" in chunks[0]["text"]
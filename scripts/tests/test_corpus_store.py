@@ -0,0 +1,24 @@
+import os
+import sys
+
+# Shared modules live one level up in scripts/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import corpus_store
+
+RECORDS = [
+    {"doc_id": "a", "text": "ab\ud800cd héllo", "pages": 1, "note": None},
+    {"doc_id": "b\ud800", "text": "plain", "pages": 2.5, "extra": None},
+    {"doc_id": "c", "pages": None, "note": "kept"},
+]
+
+
+def test_round_trip_keeps_surrogates_nulls_and_widens_ints(tmp_path):
+    path = str(tmp_path / "docs.store")
+    with corpus_store.StoreWriter(path, "doc_id") as writer:
+        for record in RECORDS:
+            writer.add(record)
+
+    store = corpus_store.open_store(path)
+    assert list(store.iter_records()) == RECORDS
+    assert store.kind("pages") == "float"
+    assert store.get_record("b\ud800")["text"] == "plain"
@@ -0,0 +1,79 @@
+import os
+import json
+import zlib
+import hashlib
+import sqlite3
+import fitz
+
+# Shared page-text cache. pdf_extract.extract_pages() checks here first, so a
+# PDF is only ever parsed once per PyMuPDF version, however many times
+# ingest / analyze / recover are re-run.
+
+# -------- PATHS --------
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+
+CACHE_PATH = os.path.join(PROJECT_ROOT, "processed", "text_cache.sqlite")
+
+# -------- CONFIG --------
+CACHE_ENABLED = True
+ENGINE_VERSION = f"pymupdf-{fitz.version[0]}-mupdf-{fitz.version[1]}"
+
+# One connection per process; pool workers open their own after fork/spawn
+_connection = None
+_connection_pid = None
+
+
+# -------- CONNECTION --------
+def get_connection():
+    global _connection, _connection_pid
+
+    if _connection is not None and _connection_pid == os.getpid():
+        return _connection
+
+    os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+
+    # WAL lets any number of readers run alongside a writer; busy_timeout
+    # makes concurrent writers queue instead of failing
+    conn = sqlite3.connect(CACHE_PATH, timeout=60, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=60000")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS page_text (
+            content_hash TEXT NOT NULL,
+            engine_version TEXT NOT NULL,
+            page_count INTEGER NOT NULL,
+            pages BLOB NOT NULL,
+            PRIMARY KEY (content_hash, engine_version)
+        )
+    """)
+
+    _connection = conn
+    _connection_pid = os.getpid()
+    return conn
+
+
+# -------- CACHE --------
+def hash_bytes(pdf_bytes):
+    return hashlib.sha256(pdf_bytes).hexdigest()
+
+
+def lookup(content_hash):
+    row = get_connection().execute(
+        "SELECT pages FROM page_text WHERE content_hash = ? AND engine_version = ?",
+        (content_hash, ENGINE_VERSION)
+    ).fetchone()
+
+    if row is None:
+        return None
+
+    return json.loads(zlib.decompress(row[0]))
+
+
+def store(content_hash, pages):
+    blob = zlib.compress(json.dumps(pages).encode("utf-8"))
+    get_connection().execute(
+        "INSERT OR IGNORE INTO page_text VALUES (?, ?, ?, ?)",
+        (content_hash, ENGINE_VERSION, len(pages), blob)
+    )
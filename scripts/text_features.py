@@ -0,0 +1,196 @@
+import os
+import argparse
+from multiprocessing import cpu_count
+import numpy as np
+from tqdm import tqdm
+
+import batching
+import corpus_store
+import pdf_extract
+
+# Text-quality features shared by scrub_documents_server, recover_discarded
+# and analyze_discarded. compute_features() scores a whole batch of texts in
+# one vectorized pass: the batch is joined into a single code-point array and
+# every metric is a mask over it, summed per document with reduceat, instead
+# of a Python generator per character and a regex pass per metric.
+#
+# build_*_features() write the results once to a corpus store (one row per
+# input line, keyed by doc_id), so trying a new threshold is a numpy filter
+# over a mapped column rather than another pass over the corpus.
+#
+#   python text_features.py documents             -> processed/documents.features
+#   python text_features.py discarded             -> processed/discarded.features
+
+# -------- PATHS --------
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+
+DOCS_PATH = os.path.join(PROJECT_ROOT, "processed", "documents.jsonl")
+DISCARDED_PATH = os.path.join(PROJECT_ROOT, "processed", "discarded.jsonl")
+RAW_ROOT = os.path.join(PROJECT_ROOT, "raw_pdfs")
+
+DOCS_FEATURES_PATH = os.path.join(PROJECT_ROOT, "processed", "documents.features")
+DISCARDED_FEATURES_PATH = os.path.join(PROJECT_ROOT, "processed", "discarded.features")
+
+# -------- CONFIG --------
+BATCH_SIZE = 1000
+MAX_WORKERS = max(1, int(cpu_count() * 0.7))
+
+# Upper bounds (exclusive) of the word-count buckets analyze_discarded reports
+LENGTH_BUCKET_EDGES = [10, 30, 100, 300]
+LENGTH_BUCKETS = ["<10 words", "10-30 words", "30-100 words", "100-300 words", "300+ words"]
+
+FEATURE_FIELDS = [
+    "char_count", "alpha_chars", "alpha_ratio", "word_count",
+    "real_word_count", "digit_tokens", "length_bucket"
+]
+
+# Code points below 128 are classified by table; anything above is looked up
+# once per distinct character in the batch
+ASCII_ALPHA = np.array([chr(c).isalpha() for c in range(128)])
+ASCII_SPACE = np.array([chr(c).isspace() for c in range(128)])
+ASCII_LETTER = np.array([chr(c).isascii() and chr(c).isalpha() for c in range(128)])  # [A-Za-z]
+ASCII_DIGIT = np.array([chr(c).isdecimal() for c in range(128)])
+
+SEPARATOR = "\n"  # whitespace, not alpha/letter/digit: ends every run
+
+
+# -------- ENGINE --------
+def classify(codes, table, predicate):
+    mask = np.zeros(len(codes), dtype=bool)
+    ascii = codes < 128
+    mask[ascii] = table[codes[ascii]]
+
+    if not ascii.all():
+        wide = codes[~ascii]
+        distinct = np.unique(wide)
+        hits = distinct[[predicate(chr(c)) for c in distinct]]
+        mask[~ascii] = np.isin(wide, hits)
+
+    return mask
+
+
+def count_runs(mask, doc_of, num_docs, min_length=1):
+    # Runs of True in mask; a run never spans documents because every
+    # document is followed by SEPARATOR
+    edges = np.diff(mask.astype(np.int8), prepend=0, append=0)
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    starts = starts[(ends - starts) >= min_length]
+    return np.bincount(doc_of[starts], minlength=num_docs)
+
+
+def compute_features(texts):
+    texts = [text.strip() for text in texts]
+    num_docs = len(texts)
+
+    char_count = np.array([len(text) for text in texts], dtype=np.int64)
+    if num_docs == 0:
+        return {field: np.zeros(0) for field in FEATURE_FIELDS}
+
+    joined = SEPARATOR.join(texts) + SEPARATOR
+    # surrogatepass: a lone surrogate (from a bad decode upstream) is still
+    # one code point, as it is to len() and str methods
+    codes = np.frombuffer(joined.encode("utf-32-le", "surrogatepass"), dtype=np.uint32)
+
+    starts = np.zeros(num_docs, dtype=np.int64)
+    starts[1:] = np.cumsum(char_count + 1)[:-1]
+    doc_of = np.repeat(np.arange(num_docs), char_count + 1)
+
+    alpha = classify(codes, ASCII_ALPHA, str.isalpha)
+    space = classify(codes, ASCII_SPACE, str.isspace)
+    letter = classify(codes, ASCII_LETTER, lambda c: False)
+    digit = classify(codes, ASCII_DIGIT, str.isdecimal)
+
+    alpha_chars = np.add.reduceat(alpha.astype(np.int64), starts)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        alpha_ratio = np.where(char_count > 0, alpha_chars / char_count, 0.0)
+
+    # len(text.split()), len(re.findall(r"[A-Za-z]{3,}")), len(re.findall(r"\d+"))
+    word_count = count_runs(~space, doc_of, num_docs)
+    real_word_count = count_runs(letter, doc_of, num_docs, min_length=3)
+    digit_tokens = count_runs(digit, doc_of, num_docs)
+
+    return {
+        "char_count": char_count,
+        "alpha_chars": alpha_chars,
+        "alpha_ratio": alpha_ratio,
+        "word_count": word_count,
+        "real_word_count": real_word_count,
+        "digit_tokens": digit_tokens,
+        "length_bucket": np.searchsorted(LENGTH_BUCKET_EDGES, word_count, side="right"),
+    }
+
+
+def feature_rows(doc_ids, features):
+    for i, doc_id in enumerate(doc_ids):
+        row = {"doc_id": doc_id}
+        for field in FEATURE_FIELDS:
+            value = features[field][i]
+            row[field] = float(value) if field == "alpha_ratio" else int(value)
+        yield row
+
+
+# -------- FEATURE FILES --------
+def build_document_features(docs_path=DOCS_PATH, out_path=DOCS_FEATURES_PATH, store=None):
+    docs = corpus_store.iter_jsonl_or_store(docs_path, store, ["doc_id", "text"])
+
+    with corpus_store.StoreWriter(out_path, "doc_id") as writer:
+        for batch in tqdm(batching.batched(docs, BATCH_SIZE), unit="batch"):
+            features = compute_features([doc.get("text", "") for doc in batch])
+            for row in feature_rows([doc["doc_id"] for doc in batch], features):
+                writer.add(row)
+
+    print(f"Wrote features for {writer.rows} documents to {out_path}")
+
+
+def discarded_text(task):
+    _, record = task
+    return pdf_extract.extract_text(os.path.join(RAW_ROOT, record["source_path"]))
+
+
+def build_discarded_features(discarded_path=DISCARDED_PATH, out_path=DISCARDED_FEATURES_PATH, store=None):
+    # Discarded records carry no text, so it comes from the PDFs (through the
+    # page-text cache). A PDF that fails to extract scores as empty text and
+    # is logged like any other extraction error.
+    records = enumerate(corpus_store.iter_jsonl_or_store(discarded_path, store))
+
+    def texts():
+        with pdf_extract.ExtractionPool(discarded_text, MAX_WORKERS) as pool, \
+             pdf_extract.open_error_log() as error_file:
+
+            for (_, record), ok, value in pool.imap(records):
+                if not ok:
+                    pdf_extract.log_error(error_file, dict(value, source_path=record["source_path"]))
+                    value = ""
+                yield record["doc_id"], value
+
+    with corpus_store.StoreWriter(out_path, "doc_id") as writer:
+        for batch in tqdm(batching.batched(texts(), BATCH_SIZE), unit="batch"):
+            features = compute_features([text for _, text in batch])
+            for row in feature_rows([doc_id for doc_id, _ in batch], features):
+                writer.add(row)
+
+    print(f"Wrote features for {writer.rows} discarded documents to {out_path}")
+
+
+def load_features(path):
+    # Mapped numpy columns, row i = line i of the source file
+    store = corpus_store.open_store(path)
+    return store, {field: store.column(field) for field in FEATURE_FIELDS}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute reusable text-quality features")
+    parser.add_argument("source", choices=["documents", "discarded"])
+    parser.add_argument("--store", default=None, help="read the source from a corpus store instead of JSONL")
+    args = parser.parse_args()
+
+    if args.source == "documents":
+        build_document_features(store=args.store)
+    else:
+        build_discarded_features(store=args.store)
+
+
+if __name__ == "__main__":
+    main()
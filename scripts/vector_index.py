@@ -0,0 +1,437 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+import faiss
+
+# FAISS index types for the chunk vectors. build_vector_index builds
+# faiss.index from its embedding shards with new_index() + train() and can be
+# re-run with --build-only --index <type> to try another one; bench compares
+# them against the exact flat scan on the same vectors.
+#
+#   flat       IndexFlatIP, exact; every query reads every vector
+#   ivf-flat   vectors bucketed under nlist k-means centroids, a query scans
+#              the nprobe nearest buckets. Full fp32 vectors, ~same memory
+#   ivf-pq     the same buckets holding product-quantized codes: pq_m bytes
+#              per vector instead of 4 x dim. Approximate distances
+#   hnsw       graph search over full vectors; no training, fastest queries,
+#              extra memory for the graph links (hnsw_m per node per layer)
+#
+# nprobe and ef_search are saved with the index as its default operating
+# point and can be changed per search with set_search_params().
+#
+#   python vector_index.py bench --index ivf-flat --nprobe 4,16,64
+#   python vector_index.py bench --index hnsw --ef-search 32,64,128,256
+#   python vector_index.py open                    time open_index() + first queries
+
+# -------- PATHS --------
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+
+# Written by build_vector_index: vectors-NNNNNN.npy for every shard below
+# cursor.json's "shards"
+SHARDS_DIR = os.path.join(PROJECT_ROOT, "processed", "embedding_shards")
+INDEX_PATH = os.path.join(PROJECT_ROOT, "processed", "faiss.index")
+
+# -------- CONFIG --------
+INDEX_TYPES = ["flat", "ivf-flat", "ivf-pq", "hnsw"]
+
+DEFAULT_PARAMS = {
+    "nlist": None,          # None: ivf_lists(number of vectors)
+    "pq_m": 64,             # 1024 dims -> 64 sub-vectors of 16 dims, 64 bytes per vector
+    "hnsw_m": 32,
+    "ef_construction": 200,
+    "nprobe": 16,
+    "ef_search": 128,
+}
+BUILD_PARAMS = ["nlist", "pq_m", "hnsw_m", "ef_construction"]
+
+TRAIN_PER_LIST = 64         # k-means wants 39-256 points per centroid
+MIN_IVF_VECTORS = 10000     # fewer than this: build flat (fit_kind)
+MIN_TRAIN = 16384           # PQ trains 256 centroids per sub-vector
+MAX_TRAIN = 262144
+ADD_BATCH = 65536
+SCAN_BLOCK = 65536          # vectors per matrix product in MappedFlatIndex.search
+
+
+# -------- INDEX TYPES --------
+def ivf_lists(num_vectors):
+    # ~4 sqrt(n) lists, a power of two, never more than the training data
+    # can support
+    nlist = 2 ** int(round(np.log2(max(4 * np.sqrt(num_vectors), 1))))
+    return max(1, min(nlist, num_vectors // 39))
+
+
+def fit_kind(kind, num_vectors):
+    # IVF needs enough vectors to train its centroids (PQ at least 256 per
+    # codebook) and is no faster than a scan over a few thousand vectors,
+    # so a small set, e.g. one small partition, gets a flat index
+    if kind.startswith("ivf") and num_vectors < MIN_IVF_VECTORS:
+        return "flat"
+    return kind
+
+
+def factory_string(kind, dimension, num_vectors, params):
+    nlist = params["nlist"] or ivf_lists(num_vectors)
+
+    if kind == "flat":
+        return "Flat"
+    if kind == "ivf-flat":
+        return f"IVF{nlist},Flat"
+    if kind == "ivf-pq":
+        if dimension % params["pq_m"]:
+            raise ValueError(f"pq_m={params['pq_m']} does not divide dimension {dimension}")
+        return f"IVF{nlist},PQ{params['pq_m']}x8"
+    if kind == "hnsw":
+        return f"HNSW{params['hnsw_m']}"
+    raise ValueError(f"unknown index type {kind!r}, expected one of {INDEX_TYPES}")
+
+
+def new_index(kind, dimension, num_vectors, params=None):
+    params = dict(DEFAULT_PARAMS, **(params or {}))
+    index = faiss.index_factory(dimension, factory_string(kind, dimension, num_vectors, params),
+                                faiss.METRIC_INNER_PRODUCT)
+    if kind == "hnsw":
+        index.hnsw.efConstruction = params["ef_construction"]
+    set_search_params(index, params["nprobe"], params["ef_search"])
+    return index
+
+
+def with_ids(index):
+    # Vectors added under chunk_store ids instead of their positions
+    return faiss.IndexIDMap2(index)
+
+
+def base_index(index):
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return faiss.downcast_index(index.index)
+    return index
+
+
+def set_search_params(index, nprobe=None, ef_search=None):
+    index = base_index(index)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and nprobe is not None:
+        ivf.nprobe = min(nprobe, ivf.nlist)
+    if isinstance(index, faiss.IndexHNSW) and ef_search is not None:
+        index.hnsw.efSearch = ef_search
+
+
+def index_bytes(index):
+    # Serialized size; for these index types that is what the index holds
+    # in memory once loaded
+    return faiss.serialize_index(index).nbytes
+
+
+# -------- SHARD VECTORS --------
+# Vectors stay in the mapped shard files; only the training sample and one
+# add batch at a time are copied out
+def shard_arrays(shards_dir=SHARDS_DIR):
+    with open(os.path.join(shards_dir, "cursor.json"), "r") as f:
+        shards = json.load(f)["shards"]
+    return [np.load(os.path.join(shards_dir, f"vectors-{n:06d}.npy"), mmap_mode="r") for n in range(shards)]
+
+
+def gather(arrays, rows):
+    # rows: sorted global positions across the concatenated shards
+    starts = np.cumsum([0] + [len(a) for a in arrays])
+    shard_of = np.searchsorted(starts, rows, side="right") - 1
+    return np.concatenate([
+        arrays[s][rows[shard_of == s] - starts[s]] for s in np.unique(shard_of)
+    ]).astype(np.float32)
+
+
+def sample_rows(num_vectors, size, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.sort(rng.choice(num_vectors, size=min(size, num_vectors), replace=False))
+
+
+def train(index, arrays, rows=None):
+    # rows: train on (and sample from) only these sorted positions, e.g.
+    # one partition's vectors (index_partitions)
+    if index.is_trained:
+        return
+    total = sum(len(a) for a in arrays) if rows is None else len(rows)
+    ivf = faiss.try_extract_index_ivf(base_index(index))
+    size = min(MAX_TRAIN, max(MIN_TRAIN, TRAIN_PER_LIST * (ivf.nlist if ivf is not None else 1)))
+
+    sample = sample_rows(total, size)
+    sample = gather(arrays, sample if rows is None else rows[sample])
+    print(f"Training on {len(sample)} of {total} vectors...")
+    index.train(sample)
+
+
+def add(index, arrays, rows=None, ids=None):
+    # ids (with rows): add row rows[i] under ids[i], for with_ids() indexes
+    if rows is not None:
+        for i in range(0, len(rows), ADD_BATCH):
+            vectors = gather(arrays, rows[i:i + ADD_BATCH])
+            if ids is None:
+                index.add(vectors)
+            else:
+                index.add_with_ids(vectors, np.ascontiguousarray(ids[i:i + ADD_BATCH], dtype=np.int64))
+        return
+    for vectors in arrays:
+        for i in range(0, len(vectors), ADD_BATCH):
+            index.add(np.ascontiguousarray(vectors[i:i + ADD_BATCH], dtype=np.float32))
+
+
+# -------- MAPPED LOADING --------
+# faiss.read_index copies the whole file into private memory: minutes for a
+# multi-GB index, and one copy per search process. open_index maps it
+# instead, so opening takes seconds and every process on the box shares the
+# same page-cache pages:
+#   flat      the vectors are the last ntotal x d floats of the file; they
+#             are mapped with numpy and scanned block by block
+#   ivf-*     faiss.IO_FLAG_MMAP loads the inverted lists as read-only
+#             mapped lists; only the centroids are read up front and a list
+#             is paged in when a query probes it
+#   hnsw      graph and vectors must be in memory; read normally
+# An IndexIDMap2 (with_ids) around either is mapped the same way; HNSW must
+# be in memory either way. build_index swaps faiss.index in with os.replace,
+# so processes that still map the old file keep a consistent view until they
+# reopen.
+FLAT_FOURCC = b"IxFI"
+ID_MAP_FOURCC = b"IxM2"
+HNSW_FOURCC_PREFIX = b"IHN"
+HEADER_BYTES = 37  # fourcc + d, ntotal, 2 dummies, is_trained, metric
+
+
+def has_ids(path):
+    # A with_ids() index file starts with the IndexIDMap2 header
+    with open(path, "rb") as f:
+        return f.read(4) == ID_MAP_FOURCC
+
+
+def read_header(path):
+    # Every faiss index file starts with fourcc, d (int32), ntotal (int64);
+    # an IndexIDMap2's wrapped index follows its header
+    with open(path, "rb") as f:
+        header = f.read(HEADER_BYTES + 4)
+    fourcc = header[:4]
+    if fourcc == ID_MAP_FOURCC:
+        fourcc = header[HEADER_BYTES:HEADER_BYTES + 4]
+    dimension = int(np.frombuffer(header, dtype="<i4", count=1, offset=4)[0])
+    ntotal = int(np.frombuffer(header, dtype="<i8", count=1, offset=8)[0])
+    return fourcc, dimension, ntotal
+
+
+class MappedFlatIndex:
+    # Exact inner-product search over a mapped IndexFlatIP file, bare or in
+    # an IndexIDMap2; same search() results as the faiss index it was
+    # written from
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            id_mapped = f.read(4) == ID_MAP_FOURCC
+        _, self.d, self.ntotal = read_header(path)
+
+        # Flat vectors are the end of the file, or sit just before the id
+        # map's (count, ids) when there is one
+        end = os.path.getsize(path)
+        self.ids = None
+        if id_mapped:
+            end -= 8 * self.ntotal
+            self.ids = np.memmap(path, dtype="<i8", mode="r", offset=end, shape=(self.ntotal,)) if self.ntotal else None
+            end -= 8
+
+        offset = end - self.ntotal * self.d * 4
+        if offset < 16:
+            raise ValueError(f"{path} is not a flat index file")
+        if self.ntotal:
+            self.vectors = np.memmap(path, dtype="<f4", mode="r", offset=offset, shape=(self.ntotal, self.d))
+        else:
+            self.vectors = np.zeros((0, self.d), dtype=np.float32)
+
+    def reconstruct_n(self, start, n):
+        return np.array(self.vectors[start:start + n])
+
+    def search(self, queries, k, params=None):
+        # params: positions to restrict the scan to (search_params)
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        best_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        total = self.ntotal if params is None else len(params)
+
+        for start in range(0, total, SCAN_BLOCK):
+            if params is None:
+                positions = np.arange(start, min(start + SCAN_BLOCK, total))
+                block = self.vectors[start:start + SCAN_BLOCK]
+            else:
+                positions = params[start:start + SCAN_BLOCK]
+                block = self.vectors[positions]
+            scores = queries @ block.T
+            top = min(k, scores.shape[1])
+            part = np.argpartition(-scores, top - 1, axis=1)[:, :top]
+
+            candidate_scores = np.concatenate([best_scores, np.take_along_axis(scores, part, axis=1)], axis=1)
+            candidate_ids = np.concatenate([best_ids, positions[part]], axis=1)
+            order = np.argsort(-candidate_scores, axis=1, kind="stable")[:, :k]
+            best_scores = np.take_along_axis(candidate_scores, order, axis=1)
+            best_ids = np.take_along_axis(candidate_ids, order, axis=1)
+
+        if self.ids is not None:
+            best_ids = np.where(best_ids >= 0, self.ids[np.maximum(best_ids, 0)], -1)
+        return best_scores, best_ids
+
+
+def search_params(index, ids):
+    # -> params for index.search(queries, k, params=...) that only consider
+    # vectors added under ids (a with_ids() index). faiss applies the
+    # IDSelector during the search itself; search parameters replace the
+    # index's own, so its nprobe / efSearch are carried over. With IVF only
+    # the nprobe probed lists are searched, so a small subset can still come
+    # back with fewer than k hits.
+    ids = np.ascontiguousarray(ids, dtype=np.int64)
+    if isinstance(index, MappedFlatIndex):
+        if index.ids is None:
+            raise ValueError("index predates chunk ids; rebuild it with build_vector_index.py --build-only")
+        return np.flatnonzero(np.isin(index.ids, ids))
+
+    if not isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        raise ValueError("index predates chunk ids; rebuild it with build_vector_index.py --build-only")
+    selector = faiss.IDSelectorBatch(ids)
+    base = base_index(index)
+    ivf = faiss.try_extract_index_ivf(base)
+    if ivf is not None:
+        params = faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+    elif isinstance(base, faiss.IndexHNSW):
+        params = faiss.SearchParametersHNSW(sel=selector, efSearch=base.hnsw.efSearch)
+    else:
+        params = faiss.SearchParameters(sel=selector)
+    params.referenced_objects = [selector]  # keeps the SWIG selector alive with params
+    return params
+
+
+def open_index(path=INDEX_PATH, mmap=True):
+    fourcc, _, _ = read_header(path)
+    if not mmap:
+        return faiss.read_index(path)
+    if fourcc == FLAT_FOURCC:
+        return MappedFlatIndex(path)
+    if fourcc.startswith(HNSW_FOURCC_PREFIX):
+        print("HNSW indexes cannot be mapped; loading into memory")
+        return faiss.read_index(path)
+    return faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+
+
+def time_open(path, num_queries, k, mmap):
+    started = time.time()
+    index = open_index(path, mmap)
+    opened = time.time() - started
+    print(f"Opened {type(index).__name__} with {index.ntotal} vectors in {opened:.2f}s")
+
+    # Random unit queries: the first search pages in what it touches, the
+    # second shows the warm cost
+    rng = np.random.default_rng(0)
+    queries = rng.standard_normal((num_queries, index.d)).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    for label in ["cold", "warm"]:
+        started = time.time()
+        index.search(queries, k)
+        print(f"{label}: {num_queries / max(time.time() - started, 1e-9):.1f} QPS")
+
+
+# -------- BENCHMARK --------
+def recall_at_k(found, expected):
+    k = expected.shape[1]
+    return np.mean([len(set(f) & set(e)) / k for f, e in zip(found, expected)])
+
+
+def timed_search(index, queries, k):
+    started = time.time()
+    _, ids = index.search(queries, k)
+    return ids, len(queries) / max(time.time() - started, 1e-9)
+
+
+def bench(kind, params, sweep, num_queries, k, limit=None):
+    # Only the first limit rows are copied out of the mapped shards
+    parts = []
+    remaining = limit
+    for array in shard_arrays():
+        if remaining is not None and remaining <= 0:
+            break
+        parts.append(array[:remaining])
+        remaining = None if remaining is None else remaining - len(parts[-1])
+    vectors = np.concatenate(parts) if parts else np.zeros((0, 0), np.float32)
+    if len(vectors) <= num_queries:
+        raise SystemExit(f"Only {len(vectors)} vectors in {SHARDS_DIR}; need more than --queries {num_queries}")
+
+    # Held-out queries, so no query finds itself
+    query_rows = sample_rows(len(vectors), num_queries, seed=1)
+    held_out = np.zeros(len(vectors), dtype=bool)
+    held_out[query_rows] = True
+    queries = np.ascontiguousarray(vectors[held_out], dtype=np.float32)
+    database = [vectors[~held_out]]
+    dimension = vectors.shape[1]
+    print(f"{len(database[0])} vectors x {dimension} dims, {len(queries)} queries, k={k}")
+
+    flat = new_index("flat", dimension, len(database[0]))
+    add(flat, database)
+    expected, flat_qps = timed_search(flat, queries, k)
+    print(f"{'flat':>24}: recall@{k} 1.000, {flat_qps:9.1f} QPS, {index_bytes(flat) / 2 ** 20:9.1f} MB")
+
+    started = time.time()
+    index = new_index(kind, dimension, len(database[0]), params)
+    train(index, database)
+    add(index, database)
+    print(f"Built {kind} ({factory_string(kind, dimension, len(database[0]), dict(DEFAULT_PARAMS, **params))}) "
+          f"in {time.time() - started:.1f}s, {index_bytes(index) / 2 ** 20:.1f} MB")
+
+    name, values = sweep
+    for value in values:
+        set_search_params(index, **{name: value})
+        found, qps = timed_search(index, queries, k)
+        print(f"{name + '=' + str(value):>24}: recall@{k} {recall_at_k(found, expected):.3f}, "
+              f"{qps:9.1f} QPS ({qps / flat_qps:.1f}x flat)")
+
+
+def int_list(text):
+    return [int(value) for value in text.split(",")]
+
+
+def index_params(args, names=DEFAULT_PARAMS):
+    # The params an argparse namespace sets explicitly
+    return {name: getattr(args, name) for name in names if getattr(args, name, None) is not None}
+
+
+def add_index_arguments(parser):
+    # Shared with build_vector_index
+    parser.add_argument("--index", choices=INDEX_TYPES, default="flat", help="FAISS index type")
+    parser.add_argument("--nlist", type=int, default=None, help="IVF lists (default ~4 sqrt(n))")
+    parser.add_argument("--pq-m", dest="pq_m", type=int, default=None, help=f"PQ bytes per vector (default {DEFAULT_PARAMS['pq_m']})")
+    parser.add_argument("--hnsw-m", dest="hnsw_m", type=int, default=None, help=f"HNSW links per node (default {DEFAULT_PARAMS['hnsw_m']})")
+    parser.add_argument("--ef-construction", dest="ef_construction", type=int, default=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare FAISS index types against the exact flat index")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    bench_parser = sub.add_parser("bench", help="recall@k, QPS and memory of an index type vs flat")
+    add_index_arguments(bench_parser)
+    bench_parser.add_argument("--nprobe", type=int_list, default=[1, 4, 16, 64], help="IVF lists probed, comma-separated sweep")
+    bench_parser.add_argument("--ef-search", dest="ef_search", type=int_list, default=[16, 32, 64, 128, 256], help="HNSW search depth, comma-separated sweep")
+    bench_parser.add_argument("--queries", type=int, default=1000)
+    bench_parser.add_argument("--k", type=int, default=10)
+    bench_parser.add_argument("--limit", type=int, default=None, help="only use the first N vectors")
+
+    open_parser = sub.add_parser("open", help="time opening the index and its first searches")
+    open_parser.add_argument("--path", default=INDEX_PATH)
+    open_parser.add_argument("--queries", type=int, default=100)
+    open_parser.add_argument("--k", type=int, default=10)
+    open_parser.add_argument("--no-mmap", action="store_true", help="load with a plain faiss.read_index for comparison")
+
+    args = parser.parse_args()
+    if args.command == "open":
+        time_open(args.path, args.queries, args.k, not args.no_mmap)
+        return
+    if args.index == "flat":
+        raise SystemExit("Pick an approximate --index to compare with flat")
+
+    sweep = ("ef_search", args.ef_search) if args.index == "hnsw" else ("nprobe", args.nprobe)
+    bench(args.index, index_params(args, BUILD_PARAMS), sweep, args.queries, args.k, args.limit)
+
+
+if __name__ == "__main__":
+    main()